@@ -0,0 +1,47 @@
+"""
+Wall-clock time of a generation in one call and section by section, against a running server.
+
+Each run of a mode costs one credit of the session's user. The runs of the two
+modes alternate, so that both see the same load on the model.
+
+    python bench_generation_sections.py --url http://localhost:8001 --session-token ... --runs 3
+"""
+import argparse
+import statistics
+import time
+
+import httpx
+
+from bench_generation_stream import REQUEST, summary
+
+MODES = {
+    "single": "/api/generate/conclusion",
+    "sections": "/api/generate/conclusion/sections",
+}
+
+
+def timed_run(client: httpx.Client, url: str, path: str) -> dict:
+    start = time.perf_counter()
+    response = client.post(f"{url}{path}", json=REQUEST)
+    response.raise_for_status()
+    return {"total": time.perf_counter() - start, "chars": len(response.json()["conclusion_text"])}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Durée de la génération en un appel et par sections parallèles")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--session-token", required=True)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    runs = {mode: [] for mode in MODES}
+    with httpx.Client(cookies={"session_token": args.session_token}, timeout=300) as client:
+        for _ in range(args.runs):
+            for mode, path in MODES.items():
+                runs[mode].append(timed_run(client, args.url, path))
+
+    for mode, results in runs.items():
+        print(f"{mode:9} {summary('durée', [r['total'] for r in results])}, "
+              f"{statistics.median(r['chars'] for r in results):.0f} caractères (médiane)")
+    speedup = statistics.median(r["total"] for r in runs["single"]) / statistics.median(r["total"] for r in runs["sections"])
+    print(f"Par sections : {speedup:.2f}x plus rapide que l'appel unique")
@@ -0,0 +1,80 @@
+"""
+Time-to-first-byte and throughput of streamed generation, against a running server.
+
+Each run costs one credit of the session's user and creates a conclusion,
+deleted afterwards. With --compare, the same request is also sent to the
+non-streaming endpoint.
+
+    python bench_generation_stream.py --url http://localhost:8001 --session-token ... --runs 3 --compare
+"""
+import argparse
+import json
+import statistics
+import time
+
+import httpx
+
+REQUEST = {
+    "type": "jaf",
+    "parties": {"tribunal": "Tribunal judiciaire de Lyon", "demandeur": "Mme A", "defendeur": "M. B"},
+    "faits": "Séparation en 2022, deux enfants de 6 et 9 ans, résidence alternée depuis janvier 2023.",
+    "demandes": "Fixation de la résidence habituelle chez la mère et d'une pension alimentaire.",
+}
+
+
+def streamed_run(client: httpx.Client, url: str) -> dict:
+    start = time.perf_counter()
+    timings = {"headers": None, "first_delta": None}
+    chars, conclusion_id, event = 0, None, None
+    with client.stream("POST", f"{url}/api/generate/conclusion/stream", json=REQUEST) as response:
+        response.raise_for_status()
+        timings["headers"] = time.perf_counter() - start
+        for line in response.iter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[5:])
+                if event == "start":
+                    conclusion_id = data["conclusion_id"]
+                elif event == "delta":
+                    if timings["first_delta"] is None:
+                        timings["first_delta"] = time.perf_counter() - start
+                    chars += len(data["text"])
+                elif event == "error":
+                    raise RuntimeError(data["detail"])
+    timings["total"] = time.perf_counter() - start
+    streaming_time = timings["total"] - timings["first_delta"]
+    timings["chars"] = chars
+    timings["chars_per_s"] = chars / streaming_time if streaming_time > 0 else float("inf")
+    if conclusion_id:
+        client.delete(f"{url}/api/conclusions/{conclusion_id}")
+    return timings
+
+
+def blocking_run(client: httpx.Client, url: str) -> float:
+    start = time.perf_counter()
+    client.post(f"{url}/api/generate/conclusion", json=REQUEST).raise_for_status()
+    return time.perf_counter() - start
+
+
+def summary(label: str, values: list, unit: str = "s") -> str:
+    return f"{label} médiane {statistics.median(values):.2f} {unit}, max {max(values):.2f} {unit}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TTFB et débit de la génération en flux (SSE)")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--session-token", required=True)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--compare", action="store_true", help="mesurer aussi l'appel non streamé")
+    args = parser.parse_args()
+
+    with httpx.Client(cookies={"session_token": args.session_token}, timeout=300) as client:
+        runs = [streamed_run(client, args.url) for _ in range(args.runs)]
+        print(f"{args.runs} génération(s) en flux, {statistics.median(r['chars'] for r in runs):.0f} caractères (médiane)")
+        print(summary("En-têtes reçus :", [r["headers"] for r in runs]))
+        print(summary("Premier texte  :", [r["first_delta"] for r in runs]))
+        print(summary("Total          :", [r["total"] for r in runs]))
+        print(summary("Débit          :", [r["chars_per_s"] for r in runs], "car/s"))
+        if args.compare:
+            print(summary("Sans flux, réponse complète :", [blocking_run(client, args.url) for _ in range(args.runs)]))
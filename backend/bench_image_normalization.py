@@ -0,0 +1,102 @@
+"""
+Storage and latency saved by normalizing photographed documents.
+
+Normalizes every photo of --dir (or synthetic 12 Mpx phone-like photos when no
+directory is given), then renders a dossier with the originals and with the
+normalized images, the slowest consumer of stored photos.
+
+    python bench_image_normalization.py --dir ~/photos-pieces
+    python bench_image_normalization.py --synthetic 8 --dpi 200
+"""
+import argparse
+import io
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image, ImageFilter
+
+from dossier import render_dossier
+from normalization import normalize_image, PHOTO_MIME_TYPES
+
+EXTENSIONS = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".heic": "image/heic", ".heif": "image/heif"}
+
+
+def synthetic_photo(index: int) -> bytes:
+    """Sensor-like noise over a blurred page: compresses like a real phone photo"""
+    size = (4032, 3024)
+    page = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(1))
+    image = Image.merge("RGB", (page, page.point(lambda v: v * 0.95), page.point(lambda v: v * 0.9)))
+    exif = Image.Exif()
+    exif[0x0112] = 6 if index % 2 else 1
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=92, exif=exif.tobytes())
+    return output.getvalue()
+
+
+def load_photos(directory, synthetic: int) -> list:
+    if directory:
+        return [
+            (path.name, EXTENSIONS[path.suffix.lower()], path.read_bytes())
+            for path in sorted(Path(directory).iterdir())
+            if EXTENSIONS.get(path.suffix.lower()) in PHOTO_MIME_TYPES
+        ]
+    return [(f"photo_{i}.jpg", "image/jpeg", synthetic_photo(i)) for i in range(synthetic)]
+
+
+def time_dossier(tmp_dir: Path, label: str, contents: list) -> float:
+    pieces = []
+    for numero, content in enumerate(contents, start=1):
+        path = tmp_dir / f"{label}_{numero}.jpg"
+        path.write_bytes(content)
+        pieces.append({
+            "numero": numero, "nom": f"Photo {numero}", "description": "", "original_filename": path.name,
+            "file_size": len(content), "mime_type": "image/jpeg", "sha256": None, "path": str(path),
+        })
+    start = time.perf_counter()
+    render_dossier(str(tmp_dir / f"{label}.pdf"), {"type": "jaf", "conclusion_text": "Bench"}, pieces)
+    return time.perf_counter() - start
+
+
+def bench(photos: list, dpi: int, quality: int):
+    originals, normalized, durations = [], [], []
+    for name, mime_type, content in photos:
+        start = time.perf_counter()
+        result = normalize_image(content, dpi, quality)
+        durations.append(time.perf_counter() - start)
+        originals.append(content)
+        # The upload keeps an original JPEG when normalizing would not shrink it
+        normalized.append(content if mime_type == "image/jpeg" and len(result) >= len(content) else result)
+        print(f"{name:32} {len(content) / 1e6:6.2f} Mo -> {len(normalized[-1]) / 1e6:6.2f} Mo "
+              f"en {durations[-1] * 1000:6.0f} ms")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        dossier_original = time_dossier(tmp_dir, "original", originals)
+        dossier_normalized = time_dossier(tmp_dir, "normalized", normalized)
+        size_original = (tmp_dir / "original.pdf").stat().st_size
+        size_normalized = (tmp_dir / "normalized.pdf").stat().st_size
+
+    total_original, total_normalized = sum(map(len, originals)), sum(map(len, normalized))
+    print(f"\n{len(photos)} photo(s), {dpi} dpi, qualité {quality}")
+    print(f"Stockage : {total_original / 1e6:.1f} Mo -> {total_normalized / 1e6:.1f} Mo "
+          f"({100 * (1 - total_normalized / total_original):.0f} % économisés)")
+    print(f"Normalisation : médiane {statistics.median(durations) * 1000:.0f} ms, "
+          f"max {max(durations) * 1000:.0f} ms par photo")
+    print(f"Dossier PDF : {dossier_original:.2f} s / {size_original / 1e6:.1f} Mo avec les originaux, "
+          f"{dossier_normalized:.2f} s / {size_normalized / 1e6:.1f} Mo normalisé")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gains de la normalisation des photos de pièces")
+    parser.add_argument("--dir", type=Path, help="répertoire de photos JPEG/HEIC réelles")
+    parser.add_argument("--synthetic", type=int, default=6, help="photos générées sans --dir")
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--quality", type=int, default=80)
+    args = parser.parse_args()
+
+    photos = load_photos(args.dir, args.synthetic)
+    if not photos:
+        raise SystemExit("Aucune photo JPEG ou HEIC trouvée")
+    bench(photos, args.dpi, args.quality)
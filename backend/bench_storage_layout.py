@@ -0,0 +1,117 @@
+"""
+Compare stat/open latency of the flat and sharded piece layouts.
+
+Creates N small files in each layout under a scratch directory (on the same
+filesystem as UPLOADS_DIR by default), then times random lookups.
+
+    python bench_storage_layout.py --files 200000 --lookups 20000
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from storage import shard_key
+
+ROOT_DIR = Path(__file__).parent
+
+
+def populate(root: Path, names, sharded: bool):
+    for name in names:
+        key = shard_key(name) if sharded else name
+        path = root / key
+        if sharded:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * 64)
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def time_lookups(root: Path, keys, operation):
+    samples = []
+    for key in keys:
+        path = str(root / key)
+        start = time.perf_counter_ns()
+        operation(path)
+        samples.append((time.perf_counter_ns() - start) / 1000)
+    samples.sort()
+    return statistics.median(samples), percentile(samples, 0.99)
+
+
+def stat_file(path):
+    os.stat(path)
+
+
+def open_file(path):
+    with open(path, "rb") as f:
+        f.read(64)
+
+
+def time_listing(root: Path, sharded: bool):
+    """Time to list one directory: the whole store when flat, a leaf directory when sharded"""
+    if sharded:
+        leaves = random.sample([p for p in root.glob("*/*")], 100)
+    else:
+        leaves = [root]
+    samples = []
+    for leaf in leaves:
+        start = time.perf_counter_ns()
+        with os.scandir(leaf) as entries:
+            for _ in entries:
+                pass
+        samples.append((time.perf_counter_ns() - start) / 1000)
+    return statistics.median(samples)
+
+
+def bench(file_count: int, lookup_count: int, scratch_dir: Path):
+    names = [f"concl_{uuid.uuid4().hex[:12]}_{uuid.uuid4().hex[:8]}.pdf" for _ in range(file_count)]
+    sample = random.sample(names, min(lookup_count, file_count))
+    missing = [f"concl_{uuid.uuid4().hex[:12]}_{uuid.uuid4().hex[:8]}.pdf" for _ in range(len(sample))]
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp:
+        results = {}
+        for layout, sharded in (("flat", False), ("sharded", True)):
+            root = Path(tmp) / layout
+            root.mkdir()
+            start = time.perf_counter()
+            populate(root, names, sharded)
+            create_seconds = time.perf_counter() - start
+
+            keys = [shard_key(n) if sharded else n for n in sample]
+            missing_keys = [shard_key(n) if sharded else n for n in missing]
+            results[layout] = {
+                "create": create_seconds,
+                "stat": time_lookups(root, keys, stat_file),
+                "open": time_lookups(root, keys, open_file),
+                "miss": time_lookups(root, missing_keys, os.path.exists),
+                "list": time_listing(root, sharded),
+            }
+            shutil.rmtree(root)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latence stat/open : arborescence plate contre répartie")
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=10_000)
+    parser.add_argument("--dir", type=Path, default=ROOT_DIR / "uploads")
+    args = parser.parse_args()
+
+    results = bench(args.files, args.lookups, args.dir)
+    print(f"{args.files} fichiers, {args.lookups} accès aléatoires (µs, médiane / p99)")
+    for layout, r in results.items():
+        print(
+            f"{layout:8} création {r['create']:6.1f} s | "
+            f"stat {r['stat'][0]:6.1f} / {r['stat'][1]:7.1f} | "
+            f"open {r['open'][0]:6.1f} / {r['open'][1]:7.1f} | "
+            f"absent {r['miss'][0]:6.1f} / {r['miss'][1]:7.1f} | "
+            f"listage d'un répertoire {r['list']:9.0f}"
+        )
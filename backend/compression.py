@@ -0,0 +1,157 @@
+"""
+Compression at rest of stored pieces.
+
+A piece is stored compressed when its MIME type usually compresses well and a
+quick probe on its first bytes confirms it. pieces.content_encoding records the
+codec (zstd or gzip, NULL for bytes stored as uploaded); the codec names are the
+HTTP content codings, so compressed pieces can be sent as they are to clients
+that accept them. zstd requires the zstandard package, gzip is always available.
+"""
+import zlib
+from pathlib import Path
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Text formats, office files without zip container, raw images. PDFs are left out:
+# compressed pieces cannot serve Range requests, which PDF viewers rely on to load
+# large documents page by page.
+COMPRESSIBLE_MIME_TYPES = {
+    "text/plain", "text/csv", "text/markdown", "text/html", "text/xml", "text/rtf",
+    "application/json", "application/xml", "application/rtf",
+    "application/msword", "application/vnd.ms-excel",
+    "image/tiff", "image/bmp", "image/x-ms-bmp", "image/svg+xml",
+}
+
+ENCODINGS = ("zstd", "gzip")
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+PROBE_SIZE = 64 * 1024
+# Pieces whose probe saves less than this stay uncompressed
+MIN_SAVING = 0.10
+
+DECOMPRESS_READ_SIZE = 64 * 1024
+
+
+def configured_encoding(setting: str) -> Optional[str]:
+    """Codec for new pieces from PIECE_COMPRESSION: off, gzip, zstd or auto (zstd when installed)"""
+    setting = setting.lower()
+    if setting == "off":
+        return None
+    if setting == "auto":
+        return "zstd" if zstandard else "gzip"
+    if setting not in ENCODINGS:
+        raise ValueError(f"PIECE_COMPRESSION inconnu: {setting}")
+    if setting == "zstd" and zstandard is None:
+        raise ValueError("PIECE_COMPRESSION=zstd nécessite le paquet zstandard")
+    return setting
+
+
+class Compressor:
+    """Incremental compression, for uploads written chunk by chunk"""
+
+    def __init__(self, encoding: str):
+        if encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            # wbits 31: gzip container rather than raw zlib
+            self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+
+def decompressor(encoding: str):
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data: bytes, encoding: str) -> bytes:
+    return decompressor(encoding).decompress(data)
+
+
+def worth_compressing(mime_type: Optional[str], sample: bytes, encoding: Optional[str]) -> bool:
+    """True when the piece should be stored compressed, judging by its first bytes"""
+    if encoding is None or mime_type not in COMPRESSIBLE_MIME_TYPES:
+        return False
+    sample = sample[:PROBE_SIZE]
+    if not sample:
+        return False
+    return len(compress(sample, encoding)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def compress_piece(data: bytes, mime_type: Optional[str], encoding: Optional[str]) -> tuple:
+    """(content_encoding, bytes to store) of an uploaded piece held in memory"""
+    if not worth_compressing(mime_type, data, encoding):
+        return None, data
+    return encoding, compress(data, encoding)
+
+
+def compress_piece_file(source: Path, target: Path, mime_type: Optional[str], encoding: Optional[str]) -> Optional[str]:
+    """Write the compressed source to target when worthwhile; returns the content_encoding used"""
+    with open(source, "rb") as src:
+        if not worth_compressing(mime_type, src.read(PROBE_SIZE), encoding):
+            return None
+        src.seek(0)
+        compressor = Compressor(encoding)
+        with open(target, "wb") as dst:
+            for chunk in iter(lambda: src.read(DECOMPRESS_READ_SIZE * 16), b""):
+                dst.write(compressor.compress(chunk))
+            dst.write(compressor.flush())
+    return encoding
+
+
+def iter_decompressed(source, encoding: str, read_size: int = DECOMPRESS_READ_SIZE):
+    """Original bytes of a compressed stored file, chunk by chunk; source is a path or a binary file object"""
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            yield from iter_decompressed(f, encoding, read_size)
+        return
+    obj = decompressor(encoding)
+    for chunk in iter(lambda: source.read(read_size), b""):
+        data = obj.decompress(chunk)
+        if data:
+            yield data
+    if encoding == "gzip":
+        rest = obj.flush()
+        if rest:
+            yield rest
+
+
+def decompress_file(source: Path, target: Path, encoding: str) -> None:
+    with open(target, "wb") as f:
+        for chunk in iter_decompressed(source, encoding):
+            f.write(chunk)
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows a response in this content coding"""
+    if not accept_encoding:
+        return False
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    if encoding in accepted:
+        return accepted[encoding] > 0
+    return accepted.get("*", 0) > 0
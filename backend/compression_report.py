@@ -0,0 +1,113 @@
+"""
+Compression at rest, per MIME type.
+
+Reports the ratio achieved on stored pieces (from the pieces table), and, with
+--sample, the CPU cost of each codec measured on up to N stored pieces of each
+type (their original bytes are recompressed in memory, nothing is written).
+
+    python compression_report.py
+    python compression_report.py --sample 20
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import select, func
+
+from server import SessionLocal, PieceModel, storage
+from compression import ENCODINGS, compress, decompress, zstandard
+
+
+def ratios_by_mime_type() -> list:
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(
+                PieceModel.mime_type,
+                func.count(PieceModel.id),
+                func.count(PieceModel.content_encoding),
+                func.sum(PieceModel.file_size),
+                func.sum(func.coalesce(PieceModel.stored_size, PieceModel.file_size))
+            )
+            .group_by(PieceModel.mime_type)
+            .order_by(func.sum(PieceModel.file_size).desc())
+        ).all()
+    finally:
+        db.close()
+
+
+def sample_pieces(mime_type: str, count: int) -> list:
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(PieceModel.filename, PieceModel.content_encoding)
+            .where(PieceModel.mime_type == mime_type)
+            .order_by(PieceModel.id.desc())
+            .limit(count)
+        ).all()
+    finally:
+        db.close()
+
+
+async def original_bytes(key: str, content_encoding) -> bytes:
+    data = await storage.read(key)
+    return decompress(data, content_encoding) if content_encoding else data
+
+
+def measure_codecs(contents: list) -> dict:
+    """{encoding: (ratio, compression MB/s, decompression MB/s)} over the given contents"""
+    total = sum(len(c) for c in contents)
+    results = {}
+    for encoding in ENCODINGS:
+        if encoding == "zstd" and zstandard is None:
+            continue
+        compressed_size, compress_time, decompress_time = 0, 0.0, 0.0
+        for content in contents:
+            start = time.process_time()
+            packed = compress(content, encoding)
+            compress_time += time.process_time() - start
+            start = time.process_time()
+            decompress(packed, encoding)
+            decompress_time += time.process_time() - start
+            compressed_size += len(packed)
+        megabytes = total / 1e6
+        results[encoding] = (
+            compressed_size / total,
+            megabytes / compress_time if compress_time else float("inf"),
+            megabytes / decompress_time if decompress_time else float("inf"),
+        )
+    return results
+
+
+async def report(sample: int):
+    print(f"{'type MIME':32} {'pièces':>7} {'compr.':>7} {'taille':>10} {'stockée':>10} {'ratio':>6}")
+    rows = ratios_by_mime_type()
+    for mime_type, count, compressed, original_size, stored_size in rows:
+        ratio = stored_size / original_size if original_size else 1.0
+        print(f"{mime_type[:32]:32} {count:7} {compressed:7} {original_size / 1e6:8.1f} Mo "
+              f"{stored_size / 1e6:7.1f} Mo {ratio:6.2f}")
+
+    if not sample:
+        return
+    print(f"\nCoût CPU sur {sample} pièce(s) max. par type (ratio, compression / décompression en Mo/s CPU)")
+    for mime_type, *_ in rows:
+        contents = []
+        for key, content_encoding in sample_pieces(mime_type, sample):
+            try:
+                contents.append(await original_bytes(key, content_encoding))
+            except Exception as e:
+                print(f"  {key} illisible : {e}")
+        contents = [c for c in contents if c]
+        if not contents:
+            continue
+        for encoding, (ratio, compress_speed, decompress_speed) in measure_codecs(contents).items():
+            print(f"{mime_type[:32]:32} {encoding:5} ratio {ratio:5.2f} | "
+                  f"{compress_speed:7.1f} / {decompress_speed:7.1f} Mo/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Taux de compression et coût CPU par type de pièce")
+    parser.add_argument("--sample", type=int, default=0, help="pièces relues par type pour mesurer le coût CPU")
+    args = parser.parse_args()
+
+    asyncio.run(report(args.sample))
@@ -0,0 +1,320 @@
+"""
+Court-ready dossier rendering: conclusions, bordereau de pièces, then every
+PDF or image piece stamped with its number.
+
+These functions run in a process pool: they only take plain data and local
+file paths, and write the result to disk instead of returning it. The dossier
+is written piece by piece (see PdfStreamWriter): memory holds one piece at a
+time, whatever the size of the whole dossier.
+"""
+import io
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+
+from PIL import Image, ImageOps
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import (
+    ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, PdfObject, StreamObject
+)
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+from reportlab.lib.utils import ImageReader, simpleSplit
+from reportlab.pdfgen import canvas
+
+from storage import file_sha256
+
+PDF_MIME_TYPES = {"application/pdf"}
+IMAGE_MIME_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp", "image/tiff", "image/bmp"}
+
+# Page entries tied to the source document's structure (page tree, tagging, article threads)
+EXCLUDED_PAGE_KEYS = {"/Parent", "/StructParents", "/B"}
+
+
+def is_appendable(mime_type: Optional[str]) -> bool:
+    """Whether a piece of this type is merged into the dossier"""
+    return mime_type in PDF_MIME_TYPES or mime_type in IMAGE_MIME_TYPES
+
+
+def format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} o"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} Ko"
+    return f"{size / (1024 * 1024):.1f} Mo"
+
+
+def draw_conclusion(p: canvas.Canvas, conclusion_type: str, conclusion_text: Optional[str]):
+    """Draw the conclusion text, starting on the current page"""
+    width, height = A4
+
+    p.setFont("Helvetica-Bold", 14)
+    y = height - 2*cm
+    p.drawString(2*cm, y, f"CONCLUSIONS - {conclusion_type.upper()}")
+
+    y -= 1.5*cm
+    p.setFont("Helvetica", 10)
+    p.drawString(2*cm, y, f"Généré le {datetime.now(timezone.utc).strftime('%d/%m/%Y')}")
+
+    y -= 2*cm
+    p.setFont("Helvetica", 11)
+
+    text = conclusion_text or ""
+    lines = text.split('\n')
+
+    for line in lines:
+        if y < 3*cm:
+            p.showPage()
+            y = height - 2*cm
+            p.setFont("Helvetica", 11)
+
+        wrapped_lines = simpleSplit(line, "Helvetica", 11, width - 4*cm)
+        for wrapped_line in wrapped_lines:
+            if y < 3*cm:
+                p.showPage()
+                y = height - 2*cm
+                p.setFont("Helvetica", 11)
+            p.drawString(2*cm, y, wrapped_line)
+            y -= 0.5*cm
+
+
+def draw_bordereau(p: canvas.Canvas, pieces: List[dict]):
+    """Draw the bordereau de pièces on a new page"""
+    width, height = A4
+    text_width = width - 4*cm
+
+    p.showPage()
+    y = height - 2*cm
+    p.setFont("Helvetica-Bold", 14)
+    p.drawString(2*cm, y, "BORDEREAU DE PIÈCES COMMUNIQUÉES")
+    y -= 1.5*cm
+
+    if not pieces:
+        p.setFont("Helvetica", 11)
+        p.drawString(2*cm, y, "Aucune pièce communiquée")
+        return
+
+    for piece in pieces:
+        lines = [("Helvetica-Bold", 11, line) for line in simpleSplit(f"Pièce n° {piece['numero']} : {piece['nom']}", "Helvetica-Bold", 11, text_width)]
+        if piece.get("description"):
+            lines += [("Helvetica", 10, line) for line in simpleSplit(piece["description"], "Helvetica", 10, text_width)]
+        details = f"{piece['original_filename']} - {format_size(piece['file_size'])}"
+        if not is_appendable(piece["mime_type"]):
+            details += " - non jointe au dossier"
+        lines.append(("Helvetica", 9, details))
+        lines.append(("Courier", 7, f"SHA-256 : {piece['sha256']}"))
+
+        block_height = sum(size * 0.045*cm for _, size, _ in lines) + 0.5*cm
+        if y - block_height < 2*cm:
+            p.showPage()
+            y = height - 2*cm
+
+        for font, size, line in lines:
+            p.setFont(font, size)
+            p.drawString(2*cm, y, line)
+            y -= size * 0.045*cm
+        y -= 0.5*cm
+
+
+def stamp_overlay(label: str, page_width: float, page_height: float):
+    """One-page PDF carrying the stamp, to be merged over a piece page"""
+    buffer = io.BytesIO()
+    p = canvas.Canvas(buffer, pagesize=(page_width, page_height))
+    p.setFont("Helvetica-Bold", 9)
+    text_width = p.stringWidth(label, "Helvetica-Bold", 9)
+    x = page_width - text_width - 1*cm
+    p.setFillColorRGB(1, 1, 1)
+    p.rect(x - 0.15*cm, 0.6*cm, text_width + 0.3*cm, 0.55*cm, stroke=0, fill=1)
+    p.setFillColorRGB(0, 0, 0)
+    p.drawString(x, 0.75*cm, label)
+    p.save()
+    buffer.seek(0)
+    return PdfReader(buffer).pages[0]
+
+
+def image_to_pdf(path: Path) -> PdfReader:
+    """Fit an image on an A4 page"""
+    width, height = A4
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        scale = min((width - 2*cm) / image.width, (height - 3*cm) / image.height, 1)
+        draw_width, draw_height = image.width * scale, image.height * scale
+
+        buffer = io.BytesIO()
+        p = canvas.Canvas(buffer, pagesize=A4)
+        p.drawImage(ImageReader(image), (width - draw_width) / 2, (height - draw_height) / 2, draw_width, draw_height)
+        p.save()
+    buffer.seek(0)
+    return PdfReader(buffer)
+
+
+def unreadable_piece_page(numero: int) -> PdfReader:
+    buffer = io.BytesIO()
+    p = canvas.Canvas(buffer, pagesize=A4)
+    p.setFont("Helvetica", 11)
+    p.drawString(2*cm, A4[1] - 3*cm, f"Pièce n° {numero} : fichier illisible, communiqué séparément")
+    p.save()
+    buffer.seek(0)
+    return PdfReader(buffer)
+
+
+class PdfStreamWriter:
+    """Minimal PDF writer sending each appended document to the file at once.
+
+    The objects a page uses (contents, fonts, images...) are copied from the
+    reader and written out when the page is appended; only object offsets and
+    page numbers stay in memory until close() writes the page tree and xref.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.offsets: List[int] = []
+        self.page_numbers: List[int] = []
+        file.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        self.pages_number = self._reserve()
+
+    def _reserve(self) -> int:
+        self.offsets.append(0)
+        return len(self.offsets)
+
+    def _write_object(self, number: int, obj: PdfObject):
+        self.offsets[number - 1] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % number)
+        obj.write_to_stream(self.file)
+        self.file.write(b"\nendobj\n")
+
+    def append(self, reader: PdfReader):
+        """Copy every page of reader, with the objects they use, to the end of the file"""
+        numbers = {}
+        pending = []
+
+        def reference(indirect: IndirectObject) -> IndirectObject:
+            key = (indirect.idnum, indirect.generation)
+            if key not in numbers:
+                numbers[key] = self._reserve()
+                pending.append((numbers[key], indirect))
+            return IndirectObject(numbers[key], 0, None)
+
+        def copy(obj):
+            if isinstance(obj, IndirectObject):
+                return reference(obj)
+            if isinstance(obj, StreamObject):
+                stream = StreamObject()
+                stream.update({key: copy(value) for key, value in obj.items() if key != "/Length"})
+                # Stored bytes as read, still encoded with the stream's /Filter
+                stream.set_data(obj._data)
+                return stream
+            if isinstance(obj, DictionaryObject):
+                return DictionaryObject({key: copy(value) for key, value in obj.items()})
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(copy(value) for value in obj)
+            return obj
+
+        # Numbered up front: links from one page to another resolve to the copies
+        pages = list(reader.pages)
+        for page in pages:
+            numbers[(page.indirect_reference.idnum, page.indirect_reference.generation)] = self._reserve()
+
+        for page in pages:
+            number = numbers[(page.indirect_reference.idnum, page.indirect_reference.generation)]
+            # The reader already copied inherited attributes (resources, boxes, rotation) onto its pages
+            copied = DictionaryObject({key: copy(value) for key, value in page.items() if key not in EXCLUDED_PAGE_KEYS})
+            copied[NameObject("/Parent")] = IndirectObject(self.pages_number, 0, None)
+            self._write_object(number, copied)
+            self.page_numbers.append(number)
+            while pending:
+                number, indirect = pending.pop()
+                self._write_object(number, copy(indirect.get_object()))
+
+    def close(self):
+        """Write the page tree, catalog, cross-reference table and trailer"""
+        self._write_object(self.pages_number, DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(IndirectObject(number, 0, None) for number in self.page_numbers),
+            NameObject("/Count"): NumberObject(len(self.page_numbers)),
+        }))
+        root_number = self._reserve()
+        self._write_object(root_number, DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(self.pages_number, 0, None),
+        }))
+
+        xref_offset = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(self.offsets) + 1))
+        for offset in self.offsets:
+            self.file.write(b"%010d 00000 n \n" % offset)
+        self.file.write(b"trailer\n")
+        DictionaryObject({
+            NameObject("/Size"): NumberObject(len(self.offsets) + 1),
+            NameObject("/Root"): IndirectObject(root_number, 0, None),
+        }).write_to_stream(self.file)
+        self.file.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+
+
+def stamped_piece(piece: dict) -> io.BytesIO:
+    """The piece as a PDF whose pages carry its number"""
+    try:
+        if piece["mime_type"] in PDF_MIME_TYPES:
+            reader = PdfReader(piece["path"])
+            if reader.is_encrypted:
+                reader.decrypt("")
+        else:
+            reader = image_to_pdf(Path(piece["path"]))
+        pages = reader.pages
+        page_count = len(pages)
+    except Exception:
+        reader = unreadable_piece_page(piece["numero"])
+        pages = reader.pages
+        page_count = 1
+
+    writer = PdfWriter()
+    # Pages are copied and stamped one at a time
+    for index, page in enumerate(pages, start=1):
+        page = writer.add_page(page)
+        page.transfer_rotation_to_content()
+        box = page.mediabox
+        overlay = stamp_overlay(f"Pièce n° {piece['numero']} - {index}/{page_count}", float(box.width), float(box.height))
+        page.merge_translated_page(overlay, float(box.left), float(box.bottom))
+
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def render_dossier(output_path: str, conclusion: dict, pieces: List[dict]) -> str:
+    """Render the full dossier to output_path.
+
+    conclusion: {"type", "conclusion_text"}
+    pieces: in bordereau order, {"numero", "nom", "description", "original_filename",
+            "file_size", "mime_type", "sha256", "path"}; sha256 may be None
+    """
+    for piece in pieces:
+        if not piece.get("sha256"):
+            piece["sha256"] = file_sha256(Path(piece["path"]))
+
+    buffer = io.BytesIO()
+    p = canvas.Canvas(buffer, pagesize=A4)
+    draw_conclusion(p, conclusion["type"], conclusion.get("conclusion_text"))
+    draw_bordereau(p, pieces)
+    p.save()
+    buffer.seek(0)
+
+    tmp_path = f"{output_path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            writer = PdfStreamWriter(f)
+            writer.append(PdfReader(buffer))
+            for piece in pieces:
+                if is_appendable(piece["mime_type"]):
+                    # Stamped in memory, then written out before the next piece is read
+                    writer.append(PdfReader(stamped_piece(piece)))
+            writer.close()
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
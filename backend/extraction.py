@@ -0,0 +1,50 @@
+"""
+Text extraction from piece contents, for the search index.
+
+Runs in the render process pool, like dossier.py and previews.py.
+"""
+from typing import Optional
+
+import pypdfium2 as pdfium
+
+from dossier import PDF_MIME_TYPES
+
+TEXT_MIME_TYPES = {
+    "text/plain", "text/csv", "text/markdown", "text/html", "text/xml",
+    "application/json", "application/xml", "application/rtf",
+}
+EXTRACTABLE_MIME_TYPES = PDF_MIME_TYPES | TEXT_MIME_TYPES
+
+# Postgres caps a tsvector at 1 MB: longer texts are truncated
+MAX_EXTRACTED_CHARS = 500_000
+
+
+def is_extractable(mime_type: Optional[str]) -> bool:
+    return mime_type in EXTRACTABLE_MIME_TYPES
+
+
+def extract_text(path: str, mime_type: str) -> str:
+    """Plain text of the piece at path, possibly empty (e.g. scanned PDFs)"""
+    if mime_type in PDF_MIME_TYPES:
+        parts = []
+        length = 0
+        pdf = pdfium.PdfDocument(path)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                part = textpage.get_text_bounded()
+                textpage.close()
+                page.close()
+                parts.append(part)
+                length += len(part)
+                if length >= MAX_EXTRACTED_CHARS:
+                    break
+        finally:
+            pdf.close()
+        content = "\n".join(parts)
+    else:
+        with open(path, "rb") as f:
+            content = f.read(MAX_EXTRACTED_CHARS * 4).decode("utf-8", errors="replace")
+
+    # Postgres text columns cannot hold NUL characters
+    return content[:MAX_EXTRACTED_CHARS].replace("\x00", " ").strip()
@@ -0,0 +1,103 @@
+"""
+Local stand-in for the generation model, selected with LLM_BACKEND=fake.
+
+Answers are plain French filler derived from the prompt, so the same prompt
+always gets the same text. Timing follows a simple model: a first-token
+latency, then tokens at a fixed rate, one word per token. Failures can be
+injected at a given rate, as provider errors or as rate limits (HTTP 429, which
+the governor treats like a saturated model).
+
+Settings, from the environment (FakeLlmClient.from_env):
+    FAKE_LLM_LATENCY            seconds before the first token (0.5)
+    FAKE_LLM_TOKENS_PER_SECOND  output rate (50)
+    FAKE_LLM_OUTPUT_TOKENS      answer length (600)
+    FAKE_LLM_FAILURE_RATE       share of calls failing with a provider error (0)
+    FAKE_LLM_RATE_LIMIT_RATE    share of calls refused with HTTP 429 (0)
+    FAKE_LLM_SEED               seed of the failure draws (0)
+"""
+import asyncio
+import hashlib
+import os
+import random
+import re
+from typing import AsyncIterator
+
+from llm import LlmClient
+
+WORDS = (
+    "le tribunal les parties la demande au titre de l'article du code civil en date du "
+    "il convient de relever que la résidence des enfants pension alimentaire madame monsieur "
+    "selon les pièces versées aux débats"
+).split()
+
+# Asked length of summaries ("Résumez en 300 mots au plus ...")
+_ASKED_WORDS = re.compile(r"en (\d+) mots au plus")
+
+
+class FakeLlmError(Exception):
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class FakeLlmClient(LlmClient):
+    requires_api_key = False
+
+    def __init__(self, latency: float = 0.5, tokens_per_second: float = 50.0, output_tokens: int = 600,
+                 failure_rate: float = 0.0, rate_limit_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+
+    @classmethod
+    def from_env(cls) -> "FakeLlmClient":
+        return cls(
+            latency=float(os.environ.get('FAKE_LLM_LATENCY', '0.5')),
+            tokens_per_second=float(os.environ.get('FAKE_LLM_TOKENS_PER_SECOND', '50')),
+            output_tokens=int(os.environ.get('FAKE_LLM_OUTPUT_TOKENS', '600')),
+            failure_rate=float(os.environ.get('FAKE_LLM_FAILURE_RATE', '0')),
+            rate_limit_rate=float(os.environ.get('FAKE_LLM_RATE_LIMIT_RATE', '0')),
+            seed=int(os.environ.get('FAKE_LLM_SEED', '0')),
+        )
+
+    def answer(self, system_prompt: str, user_prompt: str) -> list:
+        """Words of the answer to this prompt, always the same"""
+        asked = _ASKED_WORDS.search(user_prompt)
+        length = min(self.output_tokens, int(asked.group(1))) if asked else self.output_tokens
+        rng = random.Random(hashlib.sha256(f"{system_prompt}\0{user_prompt}".encode()).digest())
+        words = [rng.choice(WORDS) for _ in range(length)]
+        # Sentences of 12 words
+        return [word + (". " if i % 12 == 11 else " ") for i, word in enumerate(words)]
+
+    def _draw_failure(self):
+        self.calls += 1
+        draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            self.failures += 1
+            raise FakeLlmError("429 Too Many Requests (fake rate limit)", status_code=429)
+        if draw < self.rate_limit_rate + self.failure_rate:
+            self.failures += 1
+            raise FakeLlmError("Upstream error (fake failure)")
+
+    async def stream(self, api_key: str, session_id: str, system_prompt: str, user_prompt: str,
+                     model: str) -> AsyncIterator[str]:
+        await asyncio.sleep(self.latency)
+        self._draw_failure()
+        interval = 1 / self.tokens_per_second
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for i, word in enumerate(self.answer(system_prompt, user_prompt)):
+            # Paced on the start time: sleep overruns do not add up
+            delay = started + i * interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield word
+
+    async def complete(self, api_key: str, session_id: str, system_prompt: str, user_prompt: str,
+                       model: str) -> str:
+        return "".join([word async for word in self.stream(api_key, session_id, system_prompt, user_prompt, model)])
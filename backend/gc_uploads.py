@@ -0,0 +1,225 @@
+"""
+Garbage collection of piece storage (local backend).
+
+Three passes, each in bounded batches so that millions of files never sit in memory:
+  1. files: UPLOADS_DIR (both the flat and the sharded layout) is streamed with
+     os.scandir, keys are checked against `pieces` by chunks; files without a row
+     (and older than the grace period, to spare uploads about to commit) are
+     orphans and get removed.
+  2. rows: `pieces` is read in id order by keyset pagination; rows whose file is
+     missing are dangling and get deleted, releasing their storage usage.
+  3. partial: expired resumable uploads are removed from uploads/partial.
+
+Progress is checkpointed after every batch: an interrupted run continues with
+--resume. With --dry-run nothing is changed, mismatches are only reported.
+
+    python gc_uploads.py --dry-run
+    python gc_uploads.py --resume
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import select, delete
+
+from server import (
+    SessionLocal, PieceModel, LegalConclusionModel, UPLOADS_DIR, PARTIAL_UPLOADS_DIR,
+    RESUMABLE_UPLOAD_TTL, storage, LocalPieceStorage, charge_storage_usage
+)
+from storage import alternate_key
+
+STATE_PATH = UPLOADS_DIR.parent / "gc_state.json"
+
+
+def load_state(resume: bool) -> dict:
+    if resume and STATE_PATH.exists():
+        return json.loads(STATE_PATH.read_text())
+    return {"phase": "files", "files_seen": 0, "last_id": 0, "report": {}}
+
+
+def save_state(state: dict):
+    tmp_path = STATE_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(state))
+    os.replace(tmp_path, STATE_PATH)
+
+
+def count(state: dict, name: str, n: int = 1):
+    state["report"][name] = state["report"].get(name, 0) + n
+
+
+def walk_files(directory: str, prefix: str = ""):
+    """(key, DirEntry) of every file below directory, depth first in scandir order"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path, f"{prefix}{entry.name}/")
+            elif entry.is_file(follow_symlinks=False):
+                yield f"{prefix}{entry.name}", entry
+
+
+def iter_file_batches(skip: int, batch_size: int):
+    """Yield lists of (key, DirEntry), skipping the files handled by a previous run.
+
+    scandir order is stable while directories are unchanged. skip counts the files
+    still in place, so the orphans a run removed do not shift the cursor; files added
+    or removed by others in between only shift what is checked, and the next run catches up.
+    """
+    batch = []
+    for index, item in enumerate(walk_files(str(UPLOADS_DIR))):
+        if index < skip:
+            continue
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def collect_orphan_files(state: dict, batch_size: int, grace_seconds: int, dry_run: bool):
+    cutoff = time.time() - grace_seconds
+    for batch in iter_file_batches(state["files_seen"], batch_size):
+        # A row may still hold the flat key of a file already moved to the sharded layout
+        candidates = [key for key, _ in batch] + [alternate_key(key) for key, _ in batch]
+        db = SessionLocal()
+        try:
+            known = set(db.execute(
+                select(PieceModel.filename).where(PieceModel.filename.in_(candidates))
+            ).scalars())
+        finally:
+            db.close()
+
+        removed = 0
+        for key, entry in batch:
+            if key in known or alternate_key(key) in known or key.endswith(".part"):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_mtime > cutoff:
+                continue
+            count(state, "orphan_files")
+            count(state, "orphan_bytes", stat.st_size)
+            print(f"Fichier orphelin : {key} ({stat.st_size} octets)")
+            if not dry_run:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                removed += 1
+
+        state["files_seen"] += len(batch) - removed
+        if not dry_run:
+            save_state(state)
+
+
+def collect_dangling_rows(state: dict, batch_size: int, dry_run: bool):
+    while True:
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(PieceModel.id, PieceModel.piece_id, PieceModel.filename)
+                .where(PieceModel.id > state["last_id"])
+                .order_by(PieceModel.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return
+
+            for row_id, piece_id, filename in rows:
+                if storage.path(filename).exists():
+                    continue
+                count(state, "dangling_rows")
+                print(f"Pièce sans fichier : {piece_id} ({filename})")
+                if dry_run:
+                    continue
+
+                piece = db.query(PieceModel.conclusion_id).filter(PieceModel.id == row_id).first()
+                if piece is None:
+                    continue
+                # Same lock order as the API: conclusion, piece, user
+                db.execute(
+                    select(LegalConclusionModel.id)
+                    .where(LegalConclusionModel.conclusion_id == piece.conclusion_id)
+                    .with_for_update()
+                )
+                deleted = db.execute(
+                    delete(PieceModel)
+                    .where(PieceModel.id == row_id)
+                    .returning(PieceModel.user_id, PieceModel.conclusion_id, PieceModel.file_size)
+                    .execution_options(synchronize_session=False)
+                ).one_or_none()
+                if deleted:
+                    charge_storage_usage(db, deleted.user_id, deleted.conclusion_id, -1, -deleted.file_size)
+                db.commit()
+        finally:
+            db.close()
+
+        state["last_id"] = rows[-1][0]
+        if not dry_run:
+            save_state(state)
+
+
+def collect_expired_partial_uploads(state: dict, dry_run: bool):
+    now = datetime.now(timezone.utc)
+    with os.scandir(PARTIAL_UPLOADS_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as f:
+                    meta = json.load(f)
+                expires_at = datetime.fromisoformat(meta["expires_at"])
+            except (OSError, ValueError, KeyError):
+                continue
+            # Finalized sessions are kept a while so that retried completions stay idempotent
+            if meta.get("piece_id"):
+                expires_at += RESUMABLE_UPLOAD_TTL
+            if expires_at > now:
+                continue
+            count(state, "expired_uploads")
+            print(f"Téléversement expiré : {meta.get('upload_id')}")
+            if not dry_run:
+                for suffix in (".part", ".staged", ".json"):
+                    try:
+                        os.remove(PARTIAL_UPLOADS_DIR / f"{meta['upload_id']}{suffix}")
+                    except FileNotFoundError:
+                        pass
+
+
+def run_gc(batch_size: int, grace_seconds: int, dry_run: bool, resume: bool) -> dict:
+    if not isinstance(storage, LocalPieceStorage):
+        raise SystemExit("Le ramasse-miettes ne s'applique qu'au stockage local (STORAGE_BACKEND=local)")
+
+    state = load_state(resume)
+    if state["phase"] == "files":
+        collect_orphan_files(state, batch_size, grace_seconds, dry_run)
+        state["phase"] = "rows"
+        if not dry_run:
+            save_state(state)
+    if state["phase"] == "rows":
+        collect_dangling_rows(state, batch_size, dry_run)
+        state["phase"] = "partial"
+        if not dry_run:
+            save_state(state)
+    if state["phase"] == "partial":
+        collect_expired_partial_uploads(state, dry_run)
+
+    if not dry_run:
+        STATE_PATH.unlink(missing_ok=True)
+    return state["report"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nettoyage des fichiers et pièces incohérents")
+    parser.add_argument("--dry-run", action="store_true", help="signaler sans rien modifier")
+    parser.add_argument("--resume", action="store_true", help="reprendre une exécution interrompue")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--grace-minutes", type=int, default=60, help="âge minimal d'un fichier orphelin")
+    args = parser.parse_args()
+
+    report = run_gc(args.batch_size, args.grace_minutes * 60, args.dry_run, args.resume)
+    mode = " (simulation)" if args.dry_run else ""
+    print(f"Nettoyage terminé{mode} : {report.get('orphan_files', 0)} fichier(s) orphelin(s), "
+          f"{report.get('dangling_rows', 0)} pièce(s) sans fichier, "
+          f"{report.get('expired_uploads', 0)} téléversement(s) expiré(s)")
@@ -0,0 +1,180 @@
+"""
+Admission control for LLM calls.
+
+Each model has a concurrency cap. A call takes a slot on the primary model,
+or on the fallback model when the primary is full or cooling down after a
+rate limit. When no slot is free, the call waits in a per-user queue; slots
+are handed out round-robin across users, so a user with many requests in
+flight does not starve the others. Beyond the queue limits, calls are
+refused with Saturated and a Retry-After estimate.
+
+The caps are per process: with several instances, divide the provider's
+limit among them.
+"""
+import asyncio
+import math
+import statistics
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Recent queue waits kept for the percentiles of snapshot()
+WAIT_SAMPLES = 1000
+
+
+class Saturated(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Generation queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LlmGovernor:
+    def __init__(self, models: List[Tuple[str, int]], max_queue: int, max_queue_per_user: int,
+                 is_saturation_error: Optional[Callable[[Exception], bool]] = None, cooldown: float = 30.0):
+        """models: (name, concurrency cap) in order of preference, the primary first"""
+        self.models = [name for name, _ in models]
+        self.capacity = dict(models)
+        self.in_flight = {name: 0 for name in self.models}
+        self.cooldown_until = {name: 0.0 for name in self.models}
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.is_saturation_error = is_saturation_error
+        self.cooldown = cooldown
+
+        self.waiting: Dict[str, deque] = {}
+        # Users with waiting calls, in the order they get their next slot
+        self.turns = deque()
+        self.queued = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.fallbacks = 0
+        self.saturations = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        # Moving average of how long a call holds its slot, for Retry-After
+        self.average_hold = 20.0
+
+    def _now(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    def _free_model(self) -> Optional[str]:
+        now = self._now()
+        for name in self.models:
+            if self.in_flight[name] < self.capacity[name] and self.cooldown_until[name] <= now:
+                return name
+        return None
+
+    def retry_after(self) -> int:
+        capacity = sum(self.capacity.values())
+        return max(1, math.ceil(self.average_hold * (self.queued + 1) / capacity))
+
+    def check_admission(self, user_id: str):
+        """Raise Saturated now if a call of user_id would be refused"""
+        if self.queued == 0 and self._free_model():
+            return
+        if self.queued >= self.max_queue or len(self.waiting.get(user_id, ())) >= self.max_queue_per_user:
+            self.rejected += 1
+            raise Saturated(self.retry_after())
+
+    def _take(self, name: str):
+        self.in_flight[name] += 1
+        self.admitted += 1
+        if name != self.models[0]:
+            self.fallbacks += 1
+
+    def _dispatch(self):
+        while self.turns:
+            name = self._free_model()
+            if name is None:
+                return
+            user_id = self.turns.popleft()
+            queue = self.waiting[user_id]
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self.turns.append(user_id)
+            else:
+                del self.waiting[user_id]
+            if future.done():
+                # Cancelled, its task not resumed yet to leave the queue itself
+                continue
+            self._take(name)
+            future.set_result(name)
+
+    def _release(self, name: str):
+        self.in_flight[name] -= 1
+        self._dispatch()
+
+    def mark_saturated(self, name: str):
+        """Send calls elsewhere, or keep them queued, while the model cools down"""
+        self.saturations += 1
+        self.cooldown_until[name] = self._now() + self.cooldown
+        # Nothing may be released meanwhile: look at the queue again once it is over
+        asyncio.get_running_loop().call_later(self.cooldown, self._dispatch)
+
+    def can_fall_back(self, name: str) -> bool:
+        """Whether a call refused by name can be sent again now: another model is not cooling down"""
+        now = self._now()
+        return any(other != name and self.cooldown_until[other] <= now for other in self.models)
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, queue_limit: bool = True):
+        """Wait for a slot and yield the model to call; queue_limit=False waits whatever the queue depth"""
+        started = self._now()
+        name = self._free_model() if self.queued == 0 else None
+        if name is not None:
+            self._take(name)
+        else:
+            if queue_limit:
+                self.check_admission(user_id)
+            future = asyncio.get_running_loop().create_future()
+            self.waiting.setdefault(user_id, deque()).append(future)
+            if user_id not in self.turns:
+                self.turns.append(user_id)
+            self.queued += 1
+            try:
+                name = await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was handed over just as the caller gave up
+                    self._release(future.result())
+                else:
+                    self._forget(user_id, future)
+                raise
+
+        acquired = self._now()
+        self.waits.append(acquired - started)
+        try:
+            yield name
+        except Exception as e:
+            if self.is_saturation_error and self.is_saturation_error(e):
+                self.mark_saturated(name)
+            raise
+        finally:
+            self.average_hold = 0.9 * self.average_hold + 0.1 * (self._now() - acquired)
+            self._release(name)
+
+    def _forget(self, user_id: str, future: asyncio.Future):
+        queue = self.waiting.get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+            self.queued -= 1
+            if not queue:
+                del self.waiting[user_id]
+                self.turns.remove(user_id)
+
+    def snapshot(self) -> dict:
+        waits = sorted(self.waits)
+        return {
+            "in_flight": dict(self.in_flight),
+            "capacity": dict(self.capacity),
+            "queued": self.queued,
+            "queued_users": len(self.waiting),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "fallbacks": self.fallbacks,
+            "saturations": self.saturations,
+            "queue_wait_p50": statistics.median(waits) if waits else 0.0,
+            "queue_wait_p95": waits[math.ceil(0.95 * len(waits)) - 1] if waits else 0.0,
+            "queue_wait_max": waits[-1] if waits else 0.0,
+        }
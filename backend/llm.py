@@ -0,0 +1,116 @@
+"""
+LLM access for conclusion generation.
+
+complete() returns the whole answer through emergentintegrations' LlmChat.
+stream() yields the answer as the model produces it, through litellm (the
+library LlmChat is built on), with the same routing for universal Emergent
+keys. When streaming cannot start, it falls back to one complete() answer.
+Which model a call uses is decided by the governor (governor.py).
+
+Both go through the client chosen by LLM_BACKEND: "emergent" (the default)
+calls the provider, "fake" a local stand-in (fake_llm.py) for tests and load
+tests that spend no credits.
+"""
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+GENERATION_PROVIDER = "gemini"
+GENERATION_MODEL = "gemini-3-flash-preview"
+# Used while the primary model is saturated; empty to only ever queue for the primary
+FALLBACK_MODEL = os.environ.get('GENERATION_FALLBACK_MODEL', 'gemini-2.5-flash')
+
+# Universal keys are served by the Emergent proxy, an OpenAI-compatible endpoint
+INTEGRATION_PROXY_URL = os.environ.get('INTEGRATION_PROXY_URL', 'https://integrations.emergentagent.com')
+
+
+class LlmClient(ABC):
+    """What generation needs from a model"""
+    # Whether calls need EMERGENT_LLM_KEY
+    requires_api_key = True
+
+    @abstractmethod
+    async def complete(self, api_key: str, session_id: str, system_prompt: str, user_prompt: str,
+                       model: str) -> str:
+        ...
+
+    @abstractmethod
+    def stream(self, api_key: str, session_id: str, system_prompt: str, user_prompt: str,
+               model: str) -> AsyncIterator[str]:
+        """Text deltas of the answer, in order"""
+        ...
+
+
+async def complete(api_key: str, session_id: str, system_prompt: str, user_prompt: str,
+                   model: str = GENERATION_MODEL) -> str:
+    return await client.complete(api_key, session_id, system_prompt, user_prompt, model)
+
+
+async def stream(api_key: str, session_id: str, system_prompt: str, user_prompt: str,
+                 model: str = GENERATION_MODEL) -> AsyncIterator[str]:
+    """Text deltas of the answer, in order"""
+    async for delta in client.stream(api_key, session_id, system_prompt, user_prompt, model):
+        yield delta
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """Provider refusals for load (HTTP 429, quota) rather than for the request itself"""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    message = str(error).lower()
+    return "429" in message or "rate limit" in message or "resource_exhausted" in message
+
+
+def litellm_params(api_key: str, model: str) -> dict:
+    params = {"model": f"{GENERATION_PROVIDER}/{model}", "api_key": api_key}
+    if api_key.startswith("sk-emergent-"):
+        params.update(api_base=f"{INTEGRATION_PROXY_URL}/llm", custom_llm_provider="openai")
+    return params
+
+
+class EmergentClient(LlmClient):
+    async def complete(self, api_key: str, session_id: str, system_prompt: str, user_prompt: str,
+                       model: str) -> str:
+        from emergentintegrations.llm.chat import LlmChat, UserMessage
+        chat = LlmChat(api_key=api_key, session_id=session_id, system_message=system_prompt)
+        chat.with_model(GENERATION_PROVIDER, model)
+        return await chat.send_message(UserMessage(text=user_prompt))
+
+    async def stream(self, api_key: str, session_id: str, system_prompt: str, user_prompt: str,
+                     model: str) -> AsyncIterator[str]:
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
+        started = False
+        try:
+            import litellm
+            response = await litellm.acompletion(messages=messages, stream=True, **litellm_params(api_key, model))
+            async for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    started = True
+                    yield delta
+        except Exception as e:
+            # Once text went out it cannot be replaced by another answer
+            if started:
+                raise
+            logger.warning(f"Streaming unavailable, falling back to a complete answer: {e}")
+            yield await self.complete(api_key, session_id, system_prompt, user_prompt, model)
+
+
+def client_from_env() -> LlmClient:
+    backend = os.environ.get('LLM_BACKEND', 'emergent')
+    if backend == 'fake':
+        from fake_llm import FakeLlmClient
+        logger.warning("LLM_BACKEND=fake: generations are written by a local stand-in, not by a model")
+        return FakeLlmClient.from_env()
+    if backend != 'emergent':
+        raise ValueError(f"Unknown LLM_BACKEND: {backend}")
+    return EmergentClient()
+
+
+client = client_from_env()
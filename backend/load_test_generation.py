@@ -0,0 +1,180 @@
+"""
+Load test of the generation path, with the local stand-in model (fake_llm.py).
+
+The whole FastAPI app runs in this process, on the database of DATABASE_URL:
+authentication, admission, credit reservation, governor and database writes
+are the real ones, only the model is replaced. For each concurrency level,
+as many clients as the level send requests in a loop; the script reports
+throughput, latency percentiles, refusals (429) and how full the database
+connection pool was. No credits are spent: the test users are created with
+their own credits and deleted afterwards, with what they generated.
+
+    python load_test_generation.py --concurrency 1 4 16 64 --requests 200 --latency 0.5 --tokens-per-second 80
+
+The governor limits apply (GENERATION_MAX_CONCURRENCY, GENERATION_MAX_QUEUE, ...):
+set them in the environment to try other values.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import httpx
+
+REQUEST = {
+    "type": "jaf",
+    "parties": {"tribunal": "Tribunal judiciaire de Lyon", "demandeur": "Mme A", "defendeur": "M. B"},
+    "faits": "Séparation en 2022, deux enfants de 6 et 9 ans, résidence alternée depuis janvier 2023.",
+    "demandes": "Fixation de la résidence habituelle chez la mère et d'une pension alimentaire.",
+}
+
+ENDPOINTS = {
+    "conclusion": "/api/generate/conclusion",
+    "stream": "/api/generate/conclusion/stream",
+    "sections": "/api/generate/conclusion/sections",
+}
+
+POOL_SAMPLE_INTERVAL = 0.01
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def create_users(server, count: int) -> list:
+    """(user_id, auth headers) of test users with enough credits for the whole test"""
+    db = server.SessionLocal()
+    users = []
+    for _ in range(count):
+        user_id = f"loadtest-{uuid.uuid4().hex[:12]}"
+        token = f"loadtest_{uuid.uuid4().hex}"
+        db.add(server.UserModel(user_id=user_id, email=f"{user_id}@example.com", name="Load test", credits=10**6))
+        db.add(server.UserSessionModel(
+            user_id=user_id, session_token=token, expires_at=datetime.now(timezone.utc) + timedelta(days=1)
+        ))
+        users.append((user_id, {"Authorization": f"Bearer {token}"}))
+    db.commit()
+    db.close()
+    return users
+
+
+def delete_users(server, users: list):
+    db = server.SessionLocal()
+    user_ids = [user_id for user_id, _ in users]
+    for model in (server.LegalConclusionModel, server.CreditReservationModel, server.IdempotencyRecordModel,
+                  server.UserSessionModel, server.UserModel):
+        db.query(model).filter(model.user_id.in_(user_ids)).delete(synchronize_session=False)
+    db.commit()
+    db.close()
+
+
+async def sample_pool(server, samples: list, stop: asyncio.Event):
+    while not stop.is_set():
+        samples.append(server.engine.pool.checkedout())
+        await asyncio.sleep(POOL_SAMPLE_INTERVAL)
+
+
+async def run_level(server, client: httpx.AsyncClient, path: str, users: list, concurrency: int, requests: int) -> dict:
+    latencies, statuses = [], {}
+    remaining = requests
+
+    async def worker(headers: dict):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            response = await client.post(path, json=REQUEST, headers=headers)
+            if response.status_code == 200 and "event: error" in response.text:
+                statuses["erreur flux"] = statuses.get("erreur flux", 0) + 1
+                continue
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - start)
+
+    pool_samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_pool(server, pool_samples, stop))
+    start = time.perf_counter()
+    # One user per client: the per-user queue limit of the governor does not get in the way
+    await asyncio.gather(*(worker(users[i][1]) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await sampler
+
+    capacity = server.DB_POOL_SIZE + server.DB_MAX_OVERFLOW
+    return {
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "statuses": statuses,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50) if latencies else 0.0,
+        "p95": percentile(latencies, 95) if latencies else 0.0,
+        "p99": percentile(latencies, 99) if latencies else 0.0,
+        "pool_peak": max(pool_samples, default=0),
+        "pool_mean": statistics.mean(pool_samples) if pool_samples else 0.0,
+        "pool_saturated": sum(1 for n in pool_samples if n >= capacity) / len(pool_samples) if pool_samples else 0.0,
+        "pool_capacity": capacity,
+    }
+
+
+def report(result: dict) -> str:
+    refused = ", ".join(f"{status}: {count}" for status, count in result["statuses"].items() if status != 200)
+    return (
+        f"{result['concurrency']:>5} | {result['ok']:>4} ok | {result['throughput']:7.2f} req/s | "
+        f"p50 {result['p50']:6.2f} s  p95 {result['p95']:6.2f} s  p99 {result['p99']:6.2f} s | "
+        f"pool {result['pool_peak']}/{result['pool_capacity']} (moyenne {result['pool_mean']:.1f}, "
+        f"saturé {result['pool_saturated']:.0%})" + (f" | refus {refused}" if refused else "")
+    )
+
+
+async def main(args):
+    # The stand-in model is chosen when llm is first imported
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY"] = str(args.latency)
+    os.environ["FAKE_LLM_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+    os.environ["FAKE_LLM_OUTPUT_TOKENS"] = str(args.output_tokens)
+    os.environ["FAKE_LLM_FAILURE_RATE"] = str(args.failure_rate)
+    os.environ["FAKE_LLM_RATE_LIMIT_RATE"] = str(args.rate_limit_rate)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("server").setLevel(logging.CRITICAL)
+
+    users = create_users(server, max(args.concurrency))
+    path = ENDPOINTS[args.endpoint]
+    print(f"Charge sur {path}, modèle simulé : {args.latency} s avant le premier token, "
+          f"{args.tokens_per_second} tokens/s, {args.output_tokens} tokens par réponse")
+    print(" conc | réussies   | débit        | latence                                | pool de connexions")
+    try:
+        # Failed requests are counted by status, as a client would see them
+        transport = httpx.ASGITransport(app=server.app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+            for concurrency in args.concurrency:
+                print(report(await run_level(server, client, path, users, concurrency, args.requests)))
+                # Streamed generations finish in the background
+                while server.generation_tasks:
+                    await asyncio.sleep(0.1)
+    finally:
+        delete_users(server, users)
+    print(f"Appels au modèle simulé : {server.llm.client.calls}, échecs injectés : {server.llm.client.failures}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test de charge de la génération, avec un modèle simulé")
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS), default="conclusion")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests", type=int, default=50, help="requêtes par niveau de concurrence")
+    parser.add_argument("--latency", type=float, default=0.5, help="secondes avant le premier token")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--output-tokens", type=int, default=600)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="part d'appels en erreur")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="part d'appels refusés (429)")
+    asyncio.run(main(parser.parse_args()))
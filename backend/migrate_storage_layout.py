@@ -0,0 +1,89 @@
+"""
+Move pieces stored in the former flat layout (uploads/pieces/{name}) to the
+sharded layout (uploads/pieces/ab/cd/{name}), while the application runs.
+
+Each batch renames the files first, then points their rows at the new keys in
+one UPDATE. In between, LocalPieceStorage.path finds a file in either layout,
+so downloads keep working. A row deleted meanwhile is harmless: the cleanup
+worker resolves its key the same way. Progress lives in the table itself (rows
+with a flat key), so the tool can be stopped and run again at any time.
+
+    python migrate_storage_layout.py --dry-run
+    python migrate_storage_layout.py --batch-size 500
+"""
+import argparse
+import os
+
+from sqlalchemy import select, update, bindparam
+
+from server import SessionLocal, PieceModel, storage, LocalPieceStorage
+from storage import shard_key
+
+
+def migrate_batch(batch_size: int, after_id: int, dry_run: bool):
+    """Move one batch; returns (moved, last id seen or None when done)"""
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(PieceModel.id, PieceModel.filename)
+            .where(PieceModel.id > after_id, PieceModel.filename.notlike("%/%"))
+            .order_by(PieceModel.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return 0, None
+
+        moved = []
+        for row_id, filename in rows:
+            new_key = shard_key(filename)
+            if dry_run:
+                moved.append({"row_id": row_id, "old_key": filename, "new_key": new_key})
+                continue
+            source = storage.key_path(filename)
+            target = storage.key_path(new_key)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.replace(source, target)
+            except FileNotFoundError:
+                # Already moved by an interrupted run, or missing (left to gc_uploads.py)
+                if not target.exists():
+                    continue
+            moved.append({"row_id": row_id, "old_key": filename, "new_key": new_key})
+
+        if moved and not dry_run:
+            # Core executemany: only rows still holding the old key are repointed
+            pieces = PieceModel.__table__
+            db.connection().execute(
+                update(pieces)
+                .where(pieces.c.id == bindparam("row_id"), pieces.c.filename == bindparam("old_key"))
+                .values(filename=bindparam("new_key")),
+                moved
+            )
+            db.commit()
+        return len(moved), rows[-1][0]
+    finally:
+        db.close()
+
+
+def migrate(batch_size: int, dry_run: bool) -> int:
+    if not isinstance(storage, LocalPieceStorage):
+        raise SystemExit("La migration ne concerne que le stockage local (STORAGE_BACKEND=local)")
+
+    total = 0
+    last_id = 0
+    while True:
+        moved, last_id = migrate_batch(batch_size, last_id, dry_run)
+        if last_id is None:
+            return total
+        total += moved
+        print(f"{total} fichier(s) {'à déplacer' if dry_run else 'déplacé(s)'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migration des pièces vers l'arborescence répartie")
+    parser.add_argument("--dry-run", action="store_true", help="compter sans rien déplacer")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    total = migrate(args.batch_size, args.dry_run)
+    print(f"Migration terminée : {total} fichier(s) {'à déplacer' if args.dry_run else 'déplacé(s)'}")
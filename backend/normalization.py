@@ -0,0 +1,64 @@
+"""
+Normalization of photographed documents at upload.
+
+Phone photos are decoded, rotated upright from their EXIF orientation, scaled
+down to what an A4 page needs at the target DPI and saved again as JPEG
+without their metadata (EXIF, GPS, maker notes). Runs in the render process
+pool, like previews.py.
+"""
+import io
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+try:
+    from pillow_heif import register_heif_opener
+except ImportError:
+    # Without pillow-heif, HEIC photos are stored as uploaded
+    register_heif_opener = None
+else:
+    register_heif_opener()
+
+PHOTO_MIME_TYPES = {"image/jpeg", "image/heic", "image/heif"}
+NORMALIZED_MIME_TYPE = "image/jpeg"
+NORMALIZED_EXTENSION = ".jpg"
+
+# A photo is assumed to show one A4 page
+A4_INCHES = (8.27, 11.69)
+
+
+def is_photo(mime_type: Optional[str]) -> bool:
+    return mime_type in PHOTO_MIME_TYPES
+
+
+def target_size(dpi: int, landscape: bool) -> tuple:
+    short_side, long_side = (round(side * dpi) for side in A4_INCHES)
+    return (long_side, short_side) if landscape else (short_side, long_side)
+
+
+def normalize_image(content: bytes, dpi: int, quality: int) -> bytes:
+    """JPEG bytes of the upright, downscaled photo, without metadata"""
+    with Image.open(io.BytesIO(content)) as source:
+        # JPEG decoders can scale by 1/2, 1/4 or 1/8 while decoding: much faster on 12 Mpx photos
+        long_side = max(target_size(dpi, False))
+        source.draft("RGB", (long_side, long_side))
+        image = ImageOps.exif_transpose(source)
+        image.load()
+        icc_profile = source.info.get("icc_profile")
+
+    image.thumbnail(target_size(dpi, image.width > image.height), Image.Resampling.LANCZOS)
+
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+        image = background
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+    # No exif argument: EXIF, GPS and maker notes are dropped; the color profile is kept
+    image.save(
+        output, "JPEG", quality=quality, optimize=True, progressive=True,
+        dpi=(dpi, dpi), icc_profile=icc_profile
+    )
+    return output.getvalue()
@@ -0,0 +1,47 @@
+"""
+Piece previews: Pillow thumbnails for images, rasterized first page for PDFs.
+
+Like dossier.py, these functions run in the render process pool and write
+their result to disk.
+"""
+import os
+from typing import Optional
+
+import pypdfium2 as pdfium
+from PIL import Image, ImageOps
+
+from dossier import PDF_MIME_TYPES, IMAGE_MIME_TYPES
+
+PREVIEW_SIZE = (320, 320)
+PREVIEW_MEDIA_TYPE = "image/webp"
+
+
+def has_preview(mime_type: Optional[str]) -> bool:
+    return mime_type in PDF_MIME_TYPES or mime_type in IMAGE_MIME_TYPES
+
+
+def render_preview(source_path: str, mime_type: str, output_path: str, size=PREVIEW_SIZE) -> str:
+    """Write a WebP preview of the piece at source_path to output_path"""
+    if mime_type in PDF_MIME_TYPES:
+        pdf = pdfium.PdfDocument(source_path)
+        try:
+            page = pdf[0]
+            # Render at twice the preview size, then downsample for sharper text
+            scale = 2 * max(size) / max(page.get_size())
+            image = page.render(scale=scale).to_pil()
+        finally:
+            pdf.close()
+    else:
+        with Image.open(source_path) as source:
+            source.draft("RGB", (size[0] * 2, size[1] * 2))
+            image = ImageOps.exif_transpose(source)
+            image.load()
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    image.thumbnail(size, Image.Resampling.LANCZOS)
+
+    tmp_path = f"{output_path}.tmp"
+    image.save(tmp_path, "WEBP", quality=80)
+    os.replace(tmp_path, output_path)
+    return output_path
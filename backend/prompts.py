@@ -0,0 +1,446 @@
+"""
+System prompts for conclusion generation.
+
+A system prompt depends only on the conclusion type and the Code civil
+articles quoted in it, so it is compiled once per (type, article-set version)
+and kept in a small LRU cache. Each compiled prompt carries a version
+identifier built from hashes of the template and of the articles: stored
+with the conclusions it produced, it says exactly which prompt wrote them.
+
+Prompts are kept under a token budget: facts too long for it are condensed
+by condense(), which summarizes them chunk by chunk in parallel (map) and
+joins the summaries, summarizing again while they are still too long (reduce).
+
+A conclusion can also be written section by section: every section is asked
+for separately, with the same context, so the sections are written in
+parallel and one of them can be written again on its own.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+SYSTEM_PROMPT_TEMPLATES = {
+    "jaf": """Vous êtes un assistant pédagogique spécialisé en rédaction d'écrits juridiques en droit de la famille français.
+
+IMPORTANT : Vous NE FOURNISSEZ PAS de conseil juridique. Vous aidez uniquement à structurer et rédiger de manière claire.
+
+Votre rôle :
+1. Structurer le document selon les usages du barreau
+2. Améliorer la clarté et le vocabulaire
+3. Rendre le texte plus factuel et moins émotionnel
+
+Vous NE devez PAS :
+- Donner des conseils sur la stratégie juridique
+- Interpréter les textes de loi
+- Dire ce qui va se passer au tribunal
+- Garantir un résultat
+
+Structure standard d'un écrit en JAF :
+1. EN-TÊTE : Tribunal, numéro, parties
+2. EXPOSÉ DES FAITS : Présentation chronologique factuelle
+3. ARGUMENTATION : Exposition des demandes avec références aux textes
+4. DISPOSITIF : Demandes précises et numérotées
+5. Formule de clôture et signature
+
+Articles du Code Civil souvent cités dans ce type d'affaires :
+{articles_context}
+
+Rédigez un document structuré en aidant l'utilisateur à présenter ses faits et demandes de manière claire.""",
+    "penal": """Vous êtes un assistant pédagogique spécialisé en rédaction d'écrits juridiques en droit pénal français.
+
+IMPORTANT : Vous NE FOURNISSEZ PAS de conseil juridique. Vous aidez uniquement à structurer et rédiger de manière claire.
+
+Votre rôle :
+1. Structurer le document selon les usages
+2. Améliorer la clarté et le vocabulaire juridique approprié
+3. Rendre le texte factuel et argumenté
+
+Vous NE devez PAS :
+- Conseiller sur la défense à adopter
+- Prédire l'issue du procès
+- Interpréter les faits juridiquement
+- Garantir un résultat
+
+Structure standard d'un écrit pénal :
+1. EN-TÊTE : Juridiction, numéro, parties
+2. RAPPEL DES FAITS : Présentation factuelle
+3. ARGUMENTATION : Discussion des éléments
+4. DEMANDES : Ce qui est sollicité
+5. Formule de clôture
+
+Articles souvent cités :
+{articles_context}
+
+Aidez l'utilisateur à présenter ses éléments de manière structurée et claire.""",
+}
+
+USER_PROMPT_TEMPLATE = """Aidez-moi à structurer un document pour une {type_label}.
+
+RAPPEL : Vous êtes un assistant pédagogique. Ne donnez PAS de conseil juridique.
+Aidez uniquement à structurer et clarifier la rédaction.
+
+PARTIES:
+{parties}
+
+{faits_heading}:
+{faits}
+
+DEMANDES (telles que formulées par l'utilisateur):
+{demandes}
+
+Produisez un document structuré qui aide l'utilisateur à présenter ces éléments de manière claire et organisée.
+Ajoutez des [NOTES PÉDAGOGIQUES] pour expliquer chaque section si nécessaire."""
+
+FAITS_HEADING = "FAITS (tels que décrits par l'utilisateur)"
+SUMMARIZED_FAITS_HEADING = "FAITS (résumé fidèle du récit de l'utilisateur, trop long pour être repris en entier)"
+
+SUMMARY_SYSTEM_PROMPT = """Vous résumez le récit des faits rédigé par une partie en vue d'un écrit judiciaire.
+
+Conservez fidèlement les dates, les noms, les lieux, les montants et l'ordre chronologique.
+N'ajoutez aucun fait, n'interprétez pas, ne donnez aucun conseil juridique.
+Répondez uniquement par le résumé, en texte continu."""
+
+# Sections of a conclusion in document order: key, title
+SECTIONS = {
+    "jaf": [
+        ("en_tete", "EN-TÊTE"),
+        ("faits", "EXPOSÉ DES FAITS"),
+        ("argumentation", "ARGUMENTATION"),
+        ("dispositif", "DISPOSITIF"),
+    ],
+    "penal": [
+        ("en_tete", "EN-TÊTE"),
+        ("faits", "RAPPEL DES FAITS"),
+        ("argumentation", "ARGUMENTATION"),
+        ("dispositif", "DEMANDES"),
+    ],
+}
+
+SECTION_CONTENTS = {
+    "en_tete": "la juridiction, le numéro de l'affaire s'il est connu et les parties",
+    "faits": "la présentation chronologique et factuelle des faits",
+    "argumentation": "l'exposé des demandes, avec les références aux textes",
+    "dispositif": "les demandes précises et numérotées, suivies de la formule de clôture et de la signature",
+}
+
+SECTION_PROMPT_TEMPLATE = """{user_prompt}
+
+Le document est rédigé section par section. Rédigez UNIQUEMENT la section « {title} » : {contents}.
+Les autres sections ({others}) sont rédigées séparément : ne les reproduisez pas.
+N'écrivez pas le titre de la section, il est ajouté au document."""
+
+SECTION_REWRITE_TEMPLATE = """
+
+Voici le document actuel. Seule la section « {title} » est à réécrire, en restant cohérent avec le reste :
+{document}"""
+
+SECTION_REMARKS_TEMPLATE = """
+
+Remarques de l'utilisateur sur cette section :
+{remarks}"""
+
+TYPE_LABELS = {"jaf": "Juge aux Affaires Familiales (JAF)", "penal": "affaire pénale"}
+
+# Every type other than jaf is written as a penal case
+ARTICLE_CATEGORIES = {"jaf": "famille", "penal": "penal"}
+ARTICLES_PER_PROMPT = 5
+
+PROMPT_CACHE_SIZE = 32
+
+
+def _hash(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()[:8]
+
+
+# Changes with any edit of the templates
+TEMPLATES_VERSION = _hash(
+    *(SYSTEM_PROMPT_TEMPLATES[t] for t in sorted(SYSTEM_PROMPT_TEMPLATES)),
+    USER_PROMPT_TEMPLATE, SUMMARIZED_FAITS_HEADING, SUMMARY_SYSTEM_PROMPT,
+    json.dumps(SECTIONS, ensure_ascii=False), json.dumps(SECTION_CONTENTS, ensure_ascii=False),
+    SECTION_PROMPT_TEMPLATE, SECTION_REWRITE_TEMPLATE, SECTION_REMARKS_TEMPLATE
+)
+
+# Facts are cut into chunks of at most this many tokens to be summarized
+SUMMARY_CHUNK_TOKENS = 6000
+# Shortest summary asked for one chunk, however small the budget
+MIN_SUMMARY_TOKENS = 200
+# Reduce rounds before giving up on reaching the budget
+MAX_CONDENSE_ROUNDS = 3
+# Share of a document excerpt kept for the section being rewritten, see document_excerpt
+REWRITTEN_SECTION_SHARE = 0.5
+TRUNCATION_MARK = "[…]"
+
+_WORDS = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count, without a tokenizer.
+
+    Punctuation marks count as one token each and words as one token per 4
+    characters (French averages a little over one token per word on Gemini and
+    GPT tokenizers), which errs on the high side for a budget.
+    """
+    return sum(1 + (len(token) - 1) // 4 for token in _WORDS.findall(text))
+
+
+def _split_words(sentence: str, max_tokens: int) -> List[str]:
+    """Pieces of at most max_tokens of a sentence too long for one chunk, cut between words.
+
+    A word over the limit on its own (a pasted URL or table without spaces) is cut every
+    max_tokens characters: no character counts for more than one token.
+    """
+    pieces, current, current_tokens = [], [], 0
+    for word in sentence.split():
+        tokens = estimate_tokens(word)
+        if tokens > max_tokens:
+            parts = [word[start:start + max_tokens] for start in range(0, len(word), max_tokens)]
+            word = parts.pop()
+            tokens = estimate_tokens(word)
+            if current:
+                pieces.append(" ".join(current))
+                current, current_tokens = [], 0
+            pieces.extend(parts)
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += tokens
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def split_chunks(text: str, max_tokens: int) -> List[str]:
+    """Consecutive pieces of text of at most max_tokens, cut between paragraphs or sentences,
+    or between words when a sentence alone is over the limit"""
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if estimate_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for sentence in _SENTENCE_END.split(paragraph):
+            if estimate_tokens(sentence) <= max_tokens:
+                pieces.append(sentence)
+            else:
+                pieces.extend(_split_words(sentence, max_tokens))
+
+    chunks, current, current_tokens = [], [], 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def summary_prompt(chunk: str, index: int, total: int, max_tokens: int) -> str:
+    # About 0.75 word per token
+    max_words = max(50, int(max_tokens * 0.75))
+    part = f" (partie {index} sur {total})" if total > 1 else ""
+    return f"Résumez en {max_words} mots au plus le récit suivant{part} :\n\n{chunk}"
+
+
+async def condense(text: str, max_tokens: int,
+                   summarize: Callable[[str, int], Awaitable[str]]) -> Tuple[str, int]:
+    """(text within about max_tokens, number of summarize calls).
+
+    summarize(prompt, max_tokens) returns the model's summary for a summary_prompt().
+    """
+    calls = 0
+    for _ in range(MAX_CONDENSE_ROUNDS):
+        if estimate_tokens(text) <= max_tokens:
+            break
+        chunks = split_chunks(text, SUMMARY_CHUNK_TOKENS)
+        share = max(MIN_SUMMARY_TOKENS, max_tokens // len(chunks))
+        summaries = await asyncio.gather(*(
+            summarize(summary_prompt(chunk, index, len(chunks), share), share)
+            for index, chunk in enumerate(chunks, start=1)
+        ))
+        calls += len(chunks)
+        text = "\n\n".join(summary.strip() for summary in summaries)
+    return text, calls
+
+
+def prompt_type(conclusion_type: str) -> str:
+    return "jaf" if conclusion_type == "jaf" else "penal"
+
+
+def articles_version(articles: Iterable) -> str:
+    """Hash of the articles as quoted in the prompt"""
+    return _hash(*(f"{art.numero}|{art.titre}|{art.contenu}" for art in articles))
+
+
+def build_user_prompt(type_label: str, parties: dict, faits: str, demandes: str, summarized: bool = False) -> str:
+    return USER_PROMPT_TEMPLATE.format(
+        type_label=type_label,
+        parties=json.dumps(parties, ensure_ascii=False, indent=2),
+        faits_heading=SUMMARIZED_FAITS_HEADING if summarized else FAITS_HEADING,
+        faits=faits,
+        demandes=demandes,
+    )
+
+
+def section_prompt(kind: str, key: str, user_prompt: str, document: Optional[str] = None,
+                   remarks: Optional[str] = None) -> str:
+    """User prompt for one section; with the current document and the user's remarks to rewrite it"""
+    titles = dict(SECTIONS[kind])
+    prompt = SECTION_PROMPT_TEMPLATE.format(
+        user_prompt=user_prompt,
+        title=titles[key],
+        contents=SECTION_CONTENTS[key],
+        others=", ".join(title for other, title in SECTIONS[kind] if other != key),
+    )
+    if document:
+        prompt += SECTION_REWRITE_TEMPLATE.format(title=titles[key], document=document)
+    if remarks:
+        prompt += SECTION_REMARKS_TEMPLATE.format(remarks=remarks)
+    return prompt
+
+
+def assemble_sections(kind: str, texts: dict) -> str:
+    """The sections under their titles, in document order"""
+    return "\n\n".join(f"{title}\n\n{texts[key].strip()}" for key, title in SECTIONS[kind])
+
+
+def _heading(line: str) -> str:
+    """A line as a section title: markup, numbering and accents removed"""
+    line = re.sub(r"^[\s#*_]*(?:(?:\d+|[IVX]+)\s*[.)\-]\s*)?", "", line)
+    line = re.sub(r"[\s:*_]*$", "", line)
+    return unicodedata.normalize("NFKD", line).encode("ascii", "ignore").decode().upper()
+
+
+def section_spans(kind: str, text: str) -> dict:
+    """{key: (start, end)} of the body of each section found in text, below its title line.
+
+    Titles are matched as whole lines, in document order, whether the text was written
+    section by section or in one call ("2. EXPOSÉ DES FAITS :", "## Exposé des faits").
+    """
+    headings = {_heading(title): key for key, title in SECTIONS[kind]}
+    order = [key for key, _ in SECTIONS[kind]]
+    found = []
+    position = 0
+    for line in text.splitlines(keepends=True):
+        key = headings.get(_heading(line))
+        # Titles out of order are taken for text mentioning them
+        if key and (not found or order.index(key) > order.index(found[-1][0])):
+            found.append((key, position, position + len(line)))
+        position += len(line)
+
+    spans = {}
+    for index, (key, _, body_start) in enumerate(found):
+        body_end = found[index + 1][1] if index + 1 < len(found) else len(text)
+        spans[key] = (body_start, body_end)
+    return spans
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """text cut between words to at most max_tokens, the cut marked with TRUNCATION_MARK"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    kept, tokens = [], estimate_tokens(TRUNCATION_MARK)
+    for word in text.split():
+        tokens += estimate_tokens(word)
+        if tokens > max_tokens:
+            break
+        kept.append(word)
+    return " ".join(kept + [TRUNCATION_MARK])
+
+
+def document_excerpt(kind: str, document: str, key: str, max_tokens: int) -> str:
+    """The document shown to rewrite section key, within about max_tokens.
+
+    A document over the limit is given section by section under the titles: the
+    section to rewrite keeps REWRITTEN_SECTION_SHARE of the budget, the others share
+    the rest, each cut at its end.
+    """
+    if estimate_tokens(document) <= max_tokens:
+        return document
+    spans = section_spans(kind, document)
+    titles = dict(SECTIONS[kind])
+    # Titles count too
+    max_tokens -= sum(estimate_tokens(titles[other]) for other in spans)
+    own = int(max_tokens * REWRITTEN_SECTION_SHARE) if len(spans) > 1 else max_tokens
+    others = (max_tokens - own) // max(1, len(spans) - 1)
+    return "\n\n".join(
+        f"{titles[other]}\n\n{truncate_tokens(document[start:end].strip(), own if other == key else others)}"
+        for other, (start, end) in spans.items()
+    )
+
+
+def replace_section(kind: str, text: str, key: str, section_text: str) -> Optional[str]:
+    """text with the body of section key replaced, None when the section cannot be found"""
+    span = section_spans(kind, text).get(key)
+    if span is None:
+        return None
+    start, end = span
+    before = text[:start] if text[:start].endswith("\n") else text[:start] + "\n"
+    after = "\n\n" + text[end:] if end < len(text) else ""
+    return f"{before}\n{section_text.strip()}{after}"
+
+
+class CompiledPrompt:
+    def __init__(self, version: str, system_prompt: str, type_label: str):
+        self.version = version
+        self.system_prompt = system_prompt
+        self.type_label = type_label
+
+
+def compile_system_prompt(conclusion_type: str, articles: list) -> CompiledPrompt:
+    kind = prompt_type(conclusion_type)
+    articles_context = "\n".join(
+        f"Article {art.numero} - {art.titre}:\n{art.contenu}" for art in articles
+    )
+    return CompiledPrompt(
+        version=f"{kind}-{TEMPLATES_VERSION}-{articles_version(articles)}",
+        system_prompt=SYSTEM_PROMPT_TEMPLATES[kind].format(articles_context=articles_context),
+        type_label=TYPE_LABELS[kind],
+    )
+
+
+class PromptCache:
+    """Bounded LRU of compiled prompts; used from the event loop and from worker threads"""
+
+    def __init__(self, maxsize: int = PROMPT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[CompiledPrompt]:
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return compiled
+
+    def put(self, key, compiled: CompiledPrompt):
+        with self._lock:
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -3,10 +3,13 @@ from fastapi.responses import StreamingResponse, FileResponse, RedirectResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
-from sqlalchemy import create_engine, Column, String, Integer, Text, DateTime, Float, ForeignKey, JSON
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, Column, String, Integer, BigInteger, Text, DateTime, Float, ForeignKey, JSON, Index, inspect, text
+from sqlalchemy import func, and_, or_, select, insert, update, delete, values, column, literal, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from contextlib import contextmanager
+from sqlalchemy.orm import sessionmaker, Session, aliased
+from contextlib import asynccontextmanager, closing, contextmanager
 import os
 import logging
 from pathlib import Path
@@ -16,20 +19,49 @@ import uuid
 from datetime import datetime, timezone, timedelta
 import httpx
 from authlib.integrations.starlette_client import OAuth
-from emergentintegrations.llm.chat import LlmChat, UserMessage
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
-from reportlab.lib.units import cm
-from reportlab.lib.utils import simpleSplit
 import io
 import json
+import asyncio
+import re
+import hashlib
+from urllib.parse import quote
 import aiofiles
 import secrets
+import tempfile
+import multiprocessing
+from collections import deque
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from storage import build_storage, file_sha256, shard_key, LocalPieceStorage, ObjectExistsError, StorageError, PRESIGNED_URL_EXPIRES
+from dossier import draw_conclusion, render_dossier
+from previews import has_preview, render_preview, PREVIEW_MEDIA_TYPE
+from extraction import extract_text, EXTRACTABLE_MIME_TYPES
+from normalization import normalize_image, is_photo, NORMALIZED_MIME_TYPE, NORMALIZED_EXTENSION
+import llm
+from governor import LlmGovernor, Saturated
+from prompts import (
+    compile_system_prompt, build_user_prompt, prompt_type, condense, estimate_tokens, PromptCache,
+    section_prompt, assemble_sections, section_spans, replace_section, document_excerpt,
+    ARTICLE_CATEGORIES, ARTICLES_PER_PROMPT, MIN_SUMMARY_TOKENS, SECTIONS, SUMMARY_SYSTEM_PROMPT, TYPE_LABELS
+)
+from compression import (
+    Compressor, configured_encoding, worth_compressing, compress_piece, compress_piece_file,
+    decompress, decompress_file, iter_decompressed, accepts_encoding
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 # Create uploads directory
 UPLOADS_DIR = ROOT_DIR / 'uploads' / 'pieces'
 UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
@@ -37,15 +69,58 @@ UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
 # Max file size: 10 MB
 MAX_FILE_SIZE = 10 * 1024 * 1024
 
+# Resumable uploads are appended chunk by chunk on disk, so they may be larger
+PARTIAL_UPLOADS_DIR = ROOT_DIR / 'uploads' / 'partial'
+PARTIAL_UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+MAX_RESUMABLE_FILE_SIZE = int(os.environ.get('MAX_RESUMABLE_FILE_SIZE', 100 * 1024 * 1024))
+RESUMABLE_UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+RESUMABLE_UPLOAD_TTL = timedelta(hours=24)
+
+# Per-user storage quota, checked before transfers and enforced again when pieces are inserted
+STORAGE_QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', 1024 * 1024 * 1024))
+STORAGE_QUOTA_FILES = int(os.environ.get('STORAGE_QUOTA_FILES', '5000'))
+
+# Batch uploads: files per request, and how many are written to storage at once
+MAX_BATCH_FILES = 50
+BATCH_UPLOAD_CONCURRENCY = int(os.environ.get('BATCH_UPLOAD_CONCURRENCY', '4'))
+BATCH_UPLOAD_READ_SIZE = 256 * 1024
+
+# Compression at rest of text-like pieces: off, gzip, zstd or auto (zstd when installed)
+PIECE_COMPRESSION = configured_encoding(os.environ.get('PIECE_COMPRESSION', 'auto'))
+
+# Photographed documents (JPEG, HEIC) are normalized at upload unless the user keeps the original; 0 disables
+IMAGE_NORMALIZE_DPI = int(os.environ.get('IMAGE_NORMALIZE_DPI', '200'))
+IMAGE_NORMALIZE_QUALITY = int(os.environ.get('IMAGE_NORMALIZE_QUALITY', '80'))
+
+# Merged dossier PDFs, rendered in worker processes and cached until the conclusion or a piece changes
+DOSSIERS_DIR = ROOT_DIR / 'uploads' / 'dossiers'
+DOSSIERS_DIR.mkdir(parents=True, exist_ok=True)
+
+# Piece previews, cached by content hash so identical files share one preview
+PREVIEWS_DIR = ROOT_DIR / 'uploads' / 'previews'
+PREVIEWS_DIR.mkdir(parents=True, exist_ok=True)
+
 # Session secret key
 SESSION_SECRET = os.environ.get('SESSION_SECRET', secrets.token_hex(32))
 
+# Piece storage backend (STORAGE_BACKEND=local|s3)
+storage = build_storage(UPLOADS_DIR, SESSION_SECRET)
+
+# Signs pending direct uploads between upload-url and complete
+upload_signer = URLSafeTimedSerializer(SESSION_SECRET, salt="piece-upload")
+
+# Worker processes for CPU-bound rendering (dossiers, previews); spawn avoids forking the event loop and DB pool
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', '2'))
+render_executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
 # PostgreSQL Database Setup
 DATABASE_URL = os.environ.get('DATABASE_URL')
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, pool_size=5, max_overflow=10)
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -59,6 +134,9 @@ class UserModel(Base):
     name = Column(String(255), nullable=True)
     picture = Column(Text, nullable=True)
     credits = Column(Integer, default=0)
+    # Stored pieces, maintained with the pieces rows and fixed by reconcile_storage_usage
+    storage_bytes = Column(BigInteger, nullable=False, default=0, server_default="0")
+    storage_files = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
 class UserSessionModel(Base):
@@ -82,6 +160,12 @@ class LegalConclusionModel(Base):
     demandes = Column(Text, nullable=True)
     conclusion_text = Column(Text, nullable=True)
     status = Column(String(50), default="draft")
+    # Last piece number handed out, incremented atomically by allocate_piece_numbers
+    piece_counter = Column(Integer, nullable=False, default=0, server_default="0")
+    pieces_bytes = Column(BigInteger, nullable=False, default=0, server_default="0")
+    pieces_files = Column(Integer, nullable=False, default=0, server_default="0")
+    # Version of the system prompt the text was generated with (see prompts.py)
+    prompt_version = Column(String(64), nullable=True)
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
@@ -93,14 +177,137 @@ class PieceModel(Base):
     conclusion_id = Column(String(50), index=True, nullable=False)
     user_id = Column(String(50), index=True, nullable=False)
     numero = Column(Integer, nullable=False)
+    # Sparse ordering key: the numero shown to users is the rank by position, computed at read time
+    position = Column(BigInteger, nullable=True)
     nom = Column(String(255), nullable=False)
     description = Column(Text, nullable=True)
     filename = Column(String(255), nullable=False)
     original_filename = Column(String(255), nullable=False)
     file_size = Column(Integer, nullable=False)
     mime_type = Column(String(100), nullable=False)
+    sha256 = Column(String(64), nullable=True)
+    # Codec of the stored bytes (zstd, gzip), NULL when stored as uploaded; file_size stays the original size
+    content_encoding = Column(String(20), nullable=True)
+    stored_size = Column(Integer, nullable=True)
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    
+    __table_args__ = (
+        Index("ix_pieces_conclusion_position", "conclusion_id", "position"),
+        Index("uq_pieces_conclusion_numero", "conclusion_id", "numero", unique=True),
+        Index("ix_pieces_sha256", "sha256"),
+        Index("ix_pieces_filename", "filename"),
+    )
+
+class PieceTextModel(Base):
+    """Text extracted from piece contents, shared by all pieces with the same SHA-256"""
+    __tablename__ = "piece_texts"
+    
+    sha256 = Column(String(64), primary_key=True)
+    content = Column(Text, nullable=False, default="")
+    # extracted, empty (nothing to extract, e.g. scans) or failed
+    status = Column(String(20), nullable=False)
+    extracted_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    
+    __table_args__ = (
+        Index("ix_piece_texts_search", text("to_tsvector('french', content)"), postgresql_using="gin"),
+    )
+
+class StorageCleanupModel(Base):
+    """Stored files waiting to be removed by the background cleanup worker"""
+    __tablename__ = "storage_cleanup_queue"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String(255), nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text, nullable=True)
+    # Claimed by a worker until then; the row is deleted once the file is gone
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    enqueued_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+class GenerationJobModel(Base):
+    """Conclusion generations queued for the generation workers"""
+    __tablename__ = "generation_jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String(50), unique=True, index=True, nullable=False)
+    user_id = Column(String(50), index=True, nullable=False)
+    conclusion_id = Column(String(50), nullable=False)
+    request = Column(JSON, nullable=False)
+    # queued, running, succeeded or failed
+    status = Column(String(20), nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    run_after = Column(DateTime(timezone=True), nullable=False)
+    # A running job whose lease expired lost its worker and is claimed again
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    # Token estimates and summarization time of the successful run
+    usage = Column(JSON, nullable=True)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    
+    __table_args__ = (
+        Index("ix_generation_jobs_claim", "status", "run_after"),
+    )
+
+class GenerationEventModel(Base):
+    """One row per generation that reached the model, for latency and usage reports (append-only)"""
+    __tablename__ = "generation_events"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    user_id = Column(String(50), nullable=False)
+    conclusion_id = Column(String(50), nullable=True)
+    # conclusion, sections, section, stream or job
+    kind = Column(String(20), nullable=False)
+    type = Column(String(50), nullable=False)
+    model = Column(String(100), nullable=True)
+    prompt_version = Column(String(64), nullable=True)
+    # succeeded, failed, timeout, busy or cancelled
+    outcome = Column(String(20), nullable=False)
+    error = Column(Text, nullable=True)
+    credits_charged = Column(Integer, nullable=False, default=0)
+    # Seconds: whole generation, waiting for a governor slot, model call
+    duration_seconds = Column(Float, nullable=False)
+    queue_seconds = Column(Float, nullable=True)
+    upstream_seconds = Column(Float, nullable=True)
+    first_token_seconds = Column(Float, nullable=True)
+    # Estimates (prompts.estimate_tokens)
+    prompt_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    summary_calls = Column(Integer, nullable=False, default=0)
+    summarization_seconds = Column(Float, nullable=False, default=0.0)
+
+class CreditReservationModel(Base):
+    """Credits held by generations in progress: already taken from users.credits, given back unless committed"""
+    __tablename__ = "credit_reservations"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    reservation_id = Column(String(50), unique=True, index=True, nullable=False)
+    user_id = Column(String(50), index=True, nullable=False)
+    amount = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    expires_at = Column(DateTime(timezone=True), index=True, nullable=False)
+
+class IdempotencyRecordModel(Base):
+    """Generation requests sent with an Idempotency-Key: in progress, then their response for replay"""
+    __tablename__ = "idempotency_records"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String(50), nullable=False)
+    idempotency_key = Column(String(255), nullable=False)
+    # Hash of the endpoint and the request body: a reused key with another body is another request
+    request_hash = Column(String(64), nullable=False)
+    # in_progress or completed
+    status = Column(String(20), nullable=False)
+    response = Column(JSON, nullable=True)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    expires_at = Column(DateTime(timezone=True), index=True, nullable=False)
+    
+    __table_args__ = (
+        Index("uq_idempotency_records_request", "user_id", "idempotency_key", "request_hash", unique=True),
+    )
 
 class PaymentTransactionModel(Base):
     __tablename__ = "payment_transactions"
@@ -127,6 +334,13 @@ class CodeCivilArticleModel(Base):
     contenu = Column(Text, nullable=False)
     categorie = Column(String(100), nullable=True)
 
+class PromptSourceVersionModel(Base):
+    """Change counters of the tables generation prompts are built from, bumped by triggers"""
+    __tablename__ = "prompt_source_versions"
+    
+    source = Column(String(100), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
 class ConclusionTemplateModel(Base):
     __tablename__ = "conclusion_templates"
     
@@ -143,6 +357,80 @@ class ConclusionTemplateModel(Base):
 # Create all tables
 Base.metadata.create_all(bind=engine)
 
+# Gap between consecutive piece ordering keys, leaves room to move pieces in between
+PIECE_POSITION_GAP = 1 << 16
+
+# Columns added after the first deployment: create_all never alters existing tables
+SCHEMA_UPGRADES = [
+    ("pieces", "sha256", "VARCHAR(64)"),
+    ("pieces", "position", "BIGINT"),
+    ("pieces", "content_encoding", "VARCHAR(20)"),
+    ("pieces", "stored_size", "INTEGER"),
+    ("legal_conclusions", "piece_counter", "INTEGER NOT NULL DEFAULT 0"),
+    ("legal_conclusions", "prompt_version", "VARCHAR(64)"),
+    ("legal_conclusions", "pieces_bytes", "BIGINT NOT NULL DEFAULT 0"),
+    ("legal_conclusions", "pieces_files", "INTEGER NOT NULL DEFAULT 0"),
+    ("users", "storage_bytes", "BIGINT NOT NULL DEFAULT 0"),
+    ("users", "storage_files", "INTEGER NOT NULL DEFAULT 0"),
+    ("generation_jobs", "usage", "JSON"),
+    ("storage_cleanup_queue", "locked_until", "TIMESTAMP WITH TIME ZONE"),
+]
+
+# Idempotent statements run after the columns exist (backfills, indexes on old tables)
+SCHEMA_UPGRADE_STATEMENTS = [
+    f"UPDATE pieces SET position = numero * {PIECE_POSITION_GAP} WHERE position IS NULL",
+    "CREATE INDEX IF NOT EXISTS ix_pieces_conclusion_position ON pieces (conclusion_id, position)",
+    # Numbers duplicated by the former read-then-insert allocation are reassigned in display order
+    """UPDATE pieces SET numero = ranked.rn
+    FROM (
+        SELECT id, row_number() OVER (PARTITION BY conclusion_id ORDER BY position, id) AS rn
+        FROM pieces
+        WHERE conclusion_id IN (
+            SELECT conclusion_id FROM pieces GROUP BY conclusion_id, numero HAVING count(*) > 1
+        )
+    ) AS ranked
+    WHERE pieces.id = ranked.id""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_pieces_conclusion_numero ON pieces (conclusion_id, numero)",
+    "CREATE INDEX IF NOT EXISTS ix_pieces_sha256 ON pieces (sha256)",
+    "CREATE INDEX IF NOT EXISTS ix_pieces_filename ON pieces (filename)",
+    # The counter must stay above every number and ordering slot already used
+    f"""UPDATE legal_conclusions SET piece_counter = used.last_slot
+    FROM (
+        SELECT conclusion_id, max(GREATEST(numero, position / {PIECE_POSITION_GAP})) AS last_slot
+        FROM pieces GROUP BY conclusion_id
+    ) AS used
+    WHERE legal_conclusions.conclusion_id = used.conclusion_id
+    AND legal_conclusions.piece_counter < used.last_slot""",
+    # Articles are also loaded by scripts and by hand: cached prompts follow any change
+    """CREATE OR REPLACE FUNCTION bump_prompt_source_version() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO prompt_source_versions (source, version) VALUES (TG_TABLE_NAME, 1)
+        ON CONFLICT (source) DO UPDATE SET version = prompt_source_versions.version + 1;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'code_civil_articles_prompt_version') THEN
+            CREATE TRIGGER code_civil_articles_prompt_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON code_civil_articles
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_prompt_source_version();
+        END IF;
+    END $$""",
+]
+
+def upgrade_schema():
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table, column_name, ddl in SCHEMA_UPGRADES:
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            if column_name not in existing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column_name} {ddl}"))
+                logger.info(f"Schema upgrade: added {table}.{column_name}")
+        for statement in SCHEMA_UPGRADE_STATEMENTS:
+            conn.execute(text(statement))
+
+upgrade_schema()
+
 app = FastAPI()
 
 # Add session middleware for OAuth
@@ -160,12 +448,6 @@ oauth.register(
     client_kwargs={'scope': 'openid email profile'}
 )
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
 # Pydantic Models for API
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -186,6 +468,7 @@ class LegalConclusion(BaseModel):
     demandes: str
     conclusion_text: str
     status: str = "draft"
+    prompt_version: Optional[str] = None
     created_at: datetime
     updated_at: datetime
 
@@ -194,6 +477,8 @@ class ConclusionCreateRequest(BaseModel):
     parties: Dict[str, Any]
     faits: str
     demandes: str
+    # Returned by /generate/conclusion, for a conclusion created from its text
+    prompt_version: Optional[str] = None
 
 class ConclusionUpdateRequest(BaseModel):
     conclusion_text: Optional[str] = None
@@ -205,6 +490,12 @@ class GenerateConclusionRequest(BaseModel):
     faits: str
     demandes: str
 
+class GenerateSectionRequest(BaseModel):
+    conclusion_id: str
+    # Key of the section: en_tete, faits, argumentation or dispositif
+    section: str
+    remarks: Optional[str] = None
+
 class ConclusionTemplate(BaseModel):
     model_config = ConfigDict(extra="ignore")
     template_id: str
@@ -238,6 +529,28 @@ class PieceUpdateRequest(BaseModel):
 class PieceReorderRequest(BaseModel):
     piece_ids: List[str]
 
+class PieceMoveRequest(BaseModel):
+    # Piece to place this one after, None moves it to the top
+    after_piece_id: Optional[str] = None
+
+class PieceUploadUrlRequest(BaseModel):
+    nom: str
+    description: str = ""
+    filename: str
+    content_type: str = "application/octet-stream"
+    file_size: Optional[int] = None
+
+class PieceUploadCompleteRequest(BaseModel):
+    upload_token: str
+
+class ResumableUploadCreateRequest(BaseModel):
+    nom: str
+    description: str = ""
+    filename: str
+    content_type: str = "application/octet-stream"
+    file_size: int
+    sha256: str
+
 class CheckoutRequest(BaseModel):
     package_id: str
     origin_url: str
@@ -260,6 +573,255 @@ def get_db():
     finally:
         db.close()
 
+async def local_piece_path(key: str, tmp_dir: str, content_encoding: Optional[str] = None) -> str:
+    """Path of a stored piece on the local disk, for worker processes.
+
+    Remote objects are fetched, and compressed pieces decompressed, into tmp_dir first.
+    """
+    path = str(Path(tmp_dir) / Path(key).name)
+    if isinstance(storage, LocalPieceStorage):
+        if not content_encoding:
+            return str(storage.path(key))
+        await run_in_threadpool(decompress_file, storage.path(key), path, content_encoding)
+        return path
+    data = await storage.read(key)
+    if content_encoding:
+        data = await run_in_threadpool(decompress, data, content_encoding)
+    async with aiofiles.open(path, 'wb') as f:
+        await f.write(data)
+    return path
+
+def make_piece_key(conclusion_id: str, original_filename: Optional[str]) -> str:
+    """Storage key of a new piece: ab/cd/{conclusion_id}_{uuid8}{ext}, see shard_key"""
+    file_ext = Path(original_filename).suffix if original_filename else ""
+    return shard_key(f"{conclusion_id}_{uuid.uuid4().hex[:8]}{file_ext}")
+
+def allocate_piece_numbers(db: Session, conclusion_id: str, user_id: str, count: int = 1) -> Optional[int]:
+    """Reserve `count` consecutive numbers on the conclusion counter and return the first one.
+
+    None when the conclusion does not exist or belongs to someone else.
+    """
+    last = db.execute(
+        update(LegalConclusionModel)
+        .where(
+            LegalConclusionModel.conclusion_id == conclusion_id,
+            LegalConclusionModel.user_id == user_id
+        )
+        .values(piece_counter=LegalConclusionModel.piece_counter + count)
+        .returning(LegalConclusionModel.piece_counter)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    return None if last is None else last - count + 1
+
+def check_storage_quota(db: Session, user_id: str, incoming_bytes: int, incoming_files: int = 1):
+    """Refuse a transfer early when it cannot fit in the user's quota"""
+    usage = db.query(UserModel.storage_bytes, UserModel.storage_files).filter(UserModel.user_id == user_id).one()
+    if usage.storage_bytes + incoming_bytes > STORAGE_QUOTA_BYTES or usage.storage_files + incoming_files > STORAGE_QUOTA_FILES:
+        raise HTTPException(status_code=413, detail="Quota de stockage dépassé")
+
+def charge_storage_usage(db: Session, user_id: str, conclusion_id: Optional[str], file_count: int, byte_count: int) -> bool:
+    """Add usage to the conclusion and user counters, or release it with negative counts.
+
+    Increases are refused (False, nothing changed) when they would exceed the quota.
+    The conclusion row is updated first, the order insert_pieces locks rows in.
+    """
+    if conclusion_id:
+        db.execute(
+            update(LegalConclusionModel)
+            .where(LegalConclusionModel.conclusion_id == conclusion_id)
+            .values(
+                pieces_files=LegalConclusionModel.pieces_files + file_count,
+                pieces_bytes=LegalConclusionModel.pieces_bytes + byte_count
+            )
+            .execution_options(synchronize_session=False)
+        )
+    
+    user_usage = update(UserModel).where(UserModel.user_id == user_id)
+    if file_count > 0 or byte_count > 0:
+        user_usage = user_usage.where(
+            UserModel.storage_files + file_count <= STORAGE_QUOTA_FILES,
+            UserModel.storage_bytes + byte_count <= STORAGE_QUOTA_BYTES
+        )
+    charged = db.execute(
+        user_usage.values(
+            storage_files=UserModel.storage_files + file_count,
+            storage_bytes=UserModel.storage_bytes + byte_count
+        ).execution_options(synchronize_session=False)
+    ).rowcount
+    return charged > 0
+
+def insert_pieces(db: Session, conclusion_id: str, user_id: str, pieces: List[dict]) -> List[PieceModel]:
+    """Number, append and commit new pieces of a conclusion in one transaction.
+
+    The counter UPDATE locks the conclusion row until the commit that follows it:
+    callers must store the files first, with no await between this call and its commit.
+    """
+    first_numero = allocate_piece_numbers(db, conclusion_id, user_id, len(pieces))
+    if first_numero is None:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="Conclusion non trouvée")
+    
+    if not charge_storage_usage(db, user_id, conclusion_id, len(pieces), sum(p["file_size"] for p in pieces)):
+        db.rollback()
+        raise HTTPException(status_code=413, detail="Quota de stockage dépassé")
+    
+    now = datetime.now(timezone.utc)
+    new_pieces = [
+        PieceModel(
+            piece_id=f"piece_{uuid.uuid4().hex[:12]}",
+            conclusion_id=conclusion_id,
+            user_id=user_id,
+            numero=first_numero + idx,
+            position=(first_numero + idx) * PIECE_POSITION_GAP,
+            created_at=now,
+            updated_at=now,
+            **fields
+        )
+        for idx, fields in enumerate(pieces)
+    ]
+    try:
+        db.add_all(new_pieces)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return new_pieces
+
+def piece_display_numero(db: Session, piece: PieceModel) -> int:
+    """Rank of the piece in its conclusion, i.e. the numero shown on the bordereau"""
+    before = db.query(func.count(PieceModel.id)).filter(
+        PieceModel.conclusion_id == piece.conclusion_id,
+        or_(
+            PieceModel.position < piece.position,
+            and_(PieceModel.position == piece.position, PieceModel.id < piece.id)
+        )
+    ).scalar()
+    return before + 1
+
+def rebalance_piece_positions(db: Session, conclusion_id: str):
+    """Spread the ordering keys of a conclusion evenly again, in one statement"""
+    ranked = select(
+        PieceModel.id,
+        (func.row_number().over(order_by=(PieceModel.position, PieceModel.id)) * PIECE_POSITION_GAP).label("position")
+    ).where(PieceModel.conclusion_id == conclusion_id).subquery()
+    
+    db.execute(
+        update(PieceModel)
+        .where(PieceModel.id == ranked.c.id)
+        .values(position=ranked.c.position)
+        .execution_options(synchronize_session=False)
+    )
+    db.expire_all()
+
+def piece_to_schema(piece: PieceModel, numero: int) -> Piece:
+    return Piece(
+        piece_id=piece.piece_id,
+        conclusion_id=piece.conclusion_id,
+        user_id=piece.user_id,
+        numero=numero,
+        nom=piece.nom,
+        description=piece.description or "",
+        filename=piece.filename,
+        original_filename=piece.original_filename,
+        file_size=piece.file_size,
+        mime_type=piece.mime_type,
+        created_at=piece.created_at,
+        updated_at=piece.updated_at
+    )
+
+def absolute_url(request: Request, url: str) -> str:
+    """Prefix API-relative URLs (local storage) with the public backend URL"""
+    if url.startswith("/"):
+        base_url = os.environ.get('BACKEND_URL', str(request.base_url).rstrip('/'))
+        return f"{base_url}{url}"
+    return url
+
+class KeyedLocks:
+    """One asyncio lock per key (upload session, conclusion...), kept only while requests use it"""
+
+    def __init__(self):
+        # key -> (lock, requests holding or waiting for it)
+        self.entries: Dict[str, list] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self.entries.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.entries[key]
+
+# Piece files never change once stored: browsers may keep them for a year
+PIECE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+def parse_byte_range(range_header: str, file_size: int):
+    """Return (start, end) inclusive for a single 'bytes=' range, None to serve the whole file.
+
+    Raises ValueError when the range cannot be satisfied (416).
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    # Malformed or multi-range requests are answered with the full file
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    
+    first, last = match.groups()
+    if first == "":
+        suffix_length = int(last)
+        if suffix_length == 0 or file_size == 0:
+            raise ValueError("Plage non satisfiable")
+        return max(0, file_size - suffix_length), file_size - 1
+    
+    start = int(first)
+    end = int(last) if last else file_size - 1
+    if last and end < start:
+        return None
+    if start >= file_size:
+        raise ValueError("Plage non satisfiable")
+    return start, min(end, file_size - 1)
+
+def stored_file_response(file_path: Path, content_encoding: str, send_encoded: bool, media_type: str, headers: dict):
+    """Response for a compressed stored file: as stored with Content-Encoding, or decompressed on the fly"""
+    if send_encoded:
+        headers = {**headers, "Content-Encoding": content_encoding}
+        return FileResponse(path=str(file_path), media_type=media_type, headers=headers)
+    # Sync generator: Starlette iterates it in the threadpool
+    return StreamingResponse(iter_decompressed(file_path, content_encoding), media_type=media_type, headers=headers)
+
+def iter_remote_decompressed(key: str, content_encoding: str):
+    """Original bytes of a compressed remote object; a sync generator, iterated in the threadpool"""
+    with closing(storage.open_read(key)) as body:
+        yield from iter_decompressed(body, content_encoding)
+
+async def iter_file_range(path: Path, start: int, length: int):
+    async with aiofiles.open(path, 'rb') as f:
+        await f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
 # Authentication Helper
 def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
     session_token = request.cookies.get("session_token")
@@ -293,7 +855,7 @@ def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
     if not user:
         raise HTTPException(status_code=404, detail="Utilisateur non trouvé")
     
-    return User(
+    current_user = User(
         user_id=user.user_id,
         email=user.email,
         name=user.name or "",
@@ -301,6 +863,26 @@ def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
         credits=user.credits,
         created_at=user.created_at
     )
+    # Ends the read transaction, so the connection goes back to the pool while the request waits
+    # for the event loop. Kept, the connections of requests waiting for the loop could fill the
+    # pool while the loop itself blocks for one in an async endpoint (16 concurrent streams did)
+    db.rollback()
+    return current_user
+
+# Operational endpoints (metrics): scrapers send METRICS_TOKEN in X-Metrics-Token,
+# people sign in with an account listed in OPERATOR_EMAILS (comma-separated)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+OPERATOR_EMAILS = {email.strip().lower() for email in os.environ.get('OPERATOR_EMAILS', '').split(',') if email.strip()}
+
+def require_operator(request: Request, db: Session = Depends(get_db)):
+    token = request.headers.get("x-metrics-token")
+    if token and METRICS_TOKEN and secrets.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return
+    if token:
+        raise HTTPException(status_code=401, detail="Jeton invalide")
+    user = get_current_user(request, db)
+    if user.email.lower() not in OPERATOR_EMAILS:
+        raise HTTPException(status_code=403, detail="Accès réservé aux opérateurs")
 
 # Auth Routes - Google OAuth
 @api_router.get("/auth/google/login")
@@ -654,6 +1236,7 @@ async def create_conclusion(data: ConclusionCreateRequest, current_user: User =
         demandes=data.demandes,
         conclusion_text="",
         status="draft",
+        prompt_version=data.prompt_version,
         created_at=now,
         updated_at=now
     )
@@ -670,6 +1253,7 @@ async def create_conclusion(data: ConclusionCreateRequest, current_user: User =
         demandes=new_conclusion.demandes or "",
         conclusion_text=new_conclusion.conclusion_text or "",
         status=new_conclusion.status,
+        prompt_version=new_conclusion.prompt_version,
         created_at=new_conclusion.created_at,
         updated_at=new_conclusion.updated_at
     )
@@ -690,6 +1274,7 @@ async def get_conclusions(current_user: User = Depends(get_current_user), db: Se
             demandes=c.demandes or "",
             conclusion_text=c.conclusion_text or "",
             status=c.status,
+            prompt_version=c.prompt_version,
             created_at=c.created_at,
             updated_at=c.updated_at
         )
@@ -715,6 +1300,7 @@ async def get_conclusion(conclusion_id: str, current_user: User = Depends(get_cu
         demandes=conclusion.demandes or "",
         conclusion_text=conclusion.conclusion_text or "",
         status=conclusion.status,
+        prompt_version=conclusion.prompt_version,
         created_at=conclusion.created_at,
         updated_at=conclusion.updated_at
     )
@@ -752,34 +1338,50 @@ async def update_conclusion(
         demandes=conclusion.demandes or "",
         conclusion_text=conclusion.conclusion_text or "",
         status=conclusion.status,
+        prompt_version=conclusion.prompt_version,
         created_at=conclusion.created_at,
         updated_at=conclusion.updated_at
     )
 
 @api_router.delete("/conclusions/{conclusion_id}")
 async def delete_conclusion(conclusion_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Locked first, like insert_pieces does, before the user counters
     conclusion = db.query(LegalConclusionModel).filter(
         LegalConclusionModel.conclusion_id == conclusion_id,
         LegalConclusionModel.user_id == current_user.user_id
-    ).first()
+    ).with_for_update().first()
     
     if not conclusion:
         raise HTTPException(status_code=404, detail="Conclusion non trouvée")
     
-    # Delete all pieces associated with this conclusion
-    pieces = db.query(PieceModel).filter(
+    # Queue the files and delete all pieces in set-based statements, whatever their number
+    conclusion_pieces = and_(
         PieceModel.conclusion_id == conclusion_id,
         PieceModel.user_id == current_user.user_id
-    ).all()
-    
-    for piece in pieces:
-        file_path = UPLOADS_DIR / piece.filename
-        if file_path.exists():
-            file_path.unlink()
-        db.delete(piece)
+    )
+    now = datetime.now(timezone.utc)
+    db.execute(
+        insert(StorageCleanupModel).from_select(
+            ["key", "attempts", "enqueued_at"],
+            select(PieceModel.filename, literal(0), literal(now)).where(conclusion_pieces)
+        )
+    )
+    # Released from the rows themselves, which stay exact even if the conclusion counters drifted
+    db.execute(
+        update(UserModel)
+        .where(UserModel.user_id == current_user.user_id)
+        .values(
+            storage_files=UserModel.storage_files - select(func.count(PieceModel.id)).where(conclusion_pieces).scalar_subquery(),
+            storage_bytes=UserModel.storage_bytes - select(func.coalesce(func.sum(PieceModel.file_size), 0)).where(conclusion_pieces).scalar_subquery()
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(delete(PieceModel).where(conclusion_pieces).execution_options(synchronize_session=False))
     
     db.delete(conclusion)
     db.commit()
+    storage_cleanup_wakeup.set()
+    remove_cached_dossiers(conclusion_id)
     
     return {"message": "Conclusion supprimée"}
 
@@ -790,6 +1392,7 @@ async def upload_piece(
     file: UploadFile = File(...),
     nom: str = Form(...),
     description: str = Form(""),
+    conserver_original: bool = Form(False),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -802,6 +1405,8 @@ async def upload_piece(
     if not conclusion:
         raise HTTPException(status_code=404, detail="Conclusion non trouvée")
     
+    check_storage_quota(db, current_user.user_id, file.size or 0)
+    
     # Read file content
     content = await file.read()
     file_size = len(content)
@@ -810,58 +1415,218 @@ async def upload_piece(
     if file_size > MAX_FILE_SIZE:
         raise HTTPException(status_code=400, detail="Le fichier dépasse la taille maximale de 10 Mo")
     
-    # Get next piece number
-    last_piece = db.query(PieceModel).filter(
-        PieceModel.conclusion_id == conclusion_id
-    ).order_by(PieceModel.numero.desc()).first()
-    
-    next_numero = (last_piece.numero + 1) if last_piece else 1
+    original_filename = file.filename or "fichier"
+    mime_type = file.content_type or "application/octet-stream"
+    if not conserver_original:
+        content, mime_type, original_filename = await normalize_photo(content, mime_type, original_filename)
     
     # Generate unique filename
-    file_ext = Path(file.filename).suffix if file.filename else ""
-    unique_filename = f"{conclusion_id}_{uuid.uuid4().hex[:8]}{file_ext}"
-    file_path = UPLOADS_DIR / unique_filename
+    unique_filename = make_piece_key(conclusion_id, original_filename)
     
     # Save file
-    async with aiofiles.open(file_path, 'wb') as f:
-        await f.write(content)
-    
-    # Create piece record
-    piece_id = f"piece_{uuid.uuid4().hex[:12]}"
-    now = datetime.now(timezone.utc)
+    stored_fields = await store_piece_content(unique_filename, content, mime_type)
     
-    new_piece = PieceModel(
-        piece_id=piece_id,
-        conclusion_id=conclusion_id,
-        user_id=current_user.user_id,
-        numero=next_numero,
-        nom=nom,
-        description=description,
-        filename=unique_filename,
-        original_filename=file.filename or "fichier",
-        file_size=file_size,
-        mime_type=file.content_type or "application/octet-stream",
-        created_at=now,
-        updated_at=now
-    )
-    db.add(new_piece)
-    db.commit()
+    # Create piece record, numbered at the end of the list
+    try:
+        new_piece, = insert_pieces(db, conclusion_id, current_user.user_id, [{
+            "nom": nom,
+            "description": description,
+            "filename": unique_filename,
+            "original_filename": original_filename,
+            "mime_type": mime_type,
+            **stored_fields
+        }])
+    except Exception:
+        await storage.delete(unique_filename)
+        raise
     db.refresh(new_piece)
+    process_new_pieces([new_piece])
     
-    return Piece(
-        piece_id=new_piece.piece_id,
-        conclusion_id=new_piece.conclusion_id,
-        user_id=new_piece.user_id,
-        numero=new_piece.numero,
-        nom=new_piece.nom,
-        description=new_piece.description or "",
-        filename=new_piece.filename,
-        original_filename=new_piece.original_filename,
-        file_size=new_piece.file_size,
-        mime_type=new_piece.mime_type,
-        created_at=new_piece.created_at,
-        updated_at=new_piece.updated_at
-    )
+    return piece_to_schema(new_piece, piece_display_numero(db, new_piece))
+
+async def normalize_photo(content: bytes, mime_type: str, filename: str) -> tuple:
+    """(content, mime_type, filename) to store: photographed documents are normalized in the render pool.
+
+    The upload is kept as is when it is not a photo, cannot be decoded, or is a JPEG that would not get smaller.
+    """
+    if not IMAGE_NORMALIZE_DPI or not is_photo(mime_type):
+        return content, mime_type, filename
+    
+    loop = asyncio.get_running_loop()
+    try:
+        normalized = await loop.run_in_executor(
+            render_executor, normalize_image, content, IMAGE_NORMALIZE_DPI, IMAGE_NORMALIZE_QUALITY
+        )
+    except Exception as e:
+        logger.warning(f"Image normalization failed for {filename}: {e}")
+        return content, mime_type, filename
+    
+    # HEIC is converted even when larger: browsers and the dossier export cannot read it
+    if mime_type == NORMALIZED_MIME_TYPE and len(normalized) >= len(content):
+        return content, mime_type, filename
+    return normalized, NORMALIZED_MIME_TYPE, str(Path(filename).with_suffix(NORMALIZED_EXTENSION))
+
+async def store_piece_content(key: str, content: bytes, mime_type: str) -> dict:
+    """Write a piece held in memory, compressed when its type and first bytes make it worthwhile.
+
+    Returns the file_size, sha256, content_encoding and stored_size fields of the piece.
+    """
+    content_encoding, stored = await run_in_threadpool(compress_piece, content, mime_type, PIECE_COMPRESSION)
+    await storage.write(key, stored)
+    return {
+        "file_size": len(content),
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "content_encoding": content_encoding,
+        "stored_size": len(stored)
+    }
+
+async def store_uploaded_file(upload: UploadFile, key: str) -> dict:
+    """Stream an UploadFile to storage, compressed when the first chunk shows it is worthwhile.
+
+    Returns the file_size, sha256, content_encoding and stored_size fields of the piece.
+    """
+    digest = hashlib.sha256()
+    file_size = 0
+    first_chunk = await upload.read(BATCH_UPLOAD_READ_SIZE)
+    compress = await run_in_threadpool(worth_compressing, upload.content_type, first_chunk, PIECE_COMPRESSION)
+    compressor = Compressor(PIECE_COMPRESSION) if compress else None
+    
+    async def chunks():
+        nonlocal file_size
+        chunk = first_chunk
+        while chunk:
+            digest.update(chunk)
+            file_size += len(chunk)
+            # The limit applies to the original size, not to what is stored
+            if file_size > MAX_FILE_SIZE:
+                raise StorageError("Le fichier dépasse la taille maximale autorisée")
+            if compressor:
+                chunk = await run_in_threadpool(compressor.compress, chunk)
+            if chunk:
+                yield chunk
+            chunk = await upload.read(BATCH_UPLOAD_READ_SIZE)
+        if compressor:
+            yield compressor.flush()
+    
+    stored_size = await storage.write_stream(key, chunks(), MAX_FILE_SIZE)
+    return {
+        "file_size": file_size,
+        "sha256": digest.hexdigest(),
+        "content_encoding": PIECE_COMPRESSION if compressor else None,
+        "stored_size": stored_size
+    }
+
+@api_router.post("/conclusions/{conclusion_id}/pieces/batch", status_code=201)
+async def upload_pieces_batch(
+    conclusion_id: str,
+    files: List[UploadFile] = File(...),
+    noms: List[str] = Form([]),
+    conserver_original: bool = Form(False),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Upload several pieces at once; they are numbered consecutively in the order sent"""
+    conclusion = db.query(LegalConclusionModel).filter(
+        LegalConclusionModel.conclusion_id == conclusion_id,
+        LegalConclusionModel.user_id == current_user.user_id
+    ).first()
+    
+    if not conclusion:
+        raise HTTPException(status_code=404, detail="Conclusion non trouvée")
+    
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"Maximum {MAX_BATCH_FILES} fichiers par envoi")
+    
+    if noms and len(noms) != len(files):
+        raise HTTPException(status_code=400, detail="Le nombre de noms ne correspond pas au nombre de fichiers")
+    
+    check_storage_quota(db, current_user.user_id, sum(upload.size or 0 for upload in files), len(files))
+    
+    semaphore = asyncio.Semaphore(BATCH_UPLOAD_CONCURRENCY)
+    
+    async def store(idx: int, upload: UploadFile) -> dict:
+        key = None
+        original_filename = upload.filename or "fichier"
+        mime_type = upload.content_type or "application/octet-stream"
+        async with semaphore:
+            try:
+                if IMAGE_NORMALIZE_DPI and is_photo(mime_type) and not conserver_original:
+                    # Photos are decoded as a whole, so they are read in memory rather than streamed
+                    content = await upload.read(MAX_FILE_SIZE + 1)
+                    if len(content) > MAX_FILE_SIZE:
+                        raise StorageError("Le fichier dépasse la taille maximale autorisée")
+                    content, mime_type, original_filename = await normalize_photo(content, mime_type, original_filename)
+                    # Key built after normalization, as for single uploads: it carries the stored extension
+                    key = make_piece_key(conclusion_id, original_filename)
+                    stored_fields = await store_piece_content(key, content, mime_type)
+                else:
+                    key = make_piece_key(conclusion_id, original_filename)
+                    stored_fields = await store_uploaded_file(upload, key)
+            except StorageError:
+                if key:
+                    await storage.delete(key)
+                return {"error": "Le fichier dépasse la taille maximale de 10 Mo"}
+            except Exception:
+                logger.exception(f"Batch upload of {upload.filename} failed")
+                if key:
+                    await storage.delete(key)
+                return {"error": "Échec de l'enregistrement du fichier"}
+        
+        return {"piece": {
+            "nom": noms[idx] if noms else Path(original_filename).stem,
+            "description": "",
+            "filename": key,
+            "original_filename": original_filename,
+            "mime_type": mime_type,
+            **stored_fields
+        }}
+    
+    stored = await asyncio.gather(*(store(idx, upload) for idx, upload in enumerate(files)))
+    
+    # One transaction for every file that made it to storage
+    accepted = [entry["piece"] for entry in stored if "piece" in entry]
+    new_pieces, first_numero = [], 1
+    if accepted:
+        try:
+            new_pieces = insert_pieces(db, conclusion_id, current_user.user_id, accepted)
+        except Exception:
+            await asyncio.gather(*(storage.delete(piece["filename"]) for piece in accepted))
+            raise
+        for piece in new_pieces:
+            db.refresh(piece)
+        process_new_pieces(new_pieces)
+        # The new pieces sit together at the end of the list
+        first_numero = piece_display_numero(db, new_pieces[0])
+    
+    created = iter(enumerate(new_pieces, start=first_numero))
+    results = []
+    for idx, (upload, entry) in enumerate(zip(files, stored)):
+        result = {"index": idx, "filename": upload.filename, "success": "piece" in entry}
+        if result["success"]:
+            numero, piece = next(created)
+            result["piece"] = piece_to_schema(piece, numero)
+        else:
+            result["error"] = entry["error"]
+        results.append(result)
+    
+    return {
+        "uploaded": len(accepted),
+        "failed": len(files) - len(accepted),
+        "results": results
+    }
+
+@api_router.get("/usage/storage")
+async def get_storage_usage(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    usage = db.query(UserModel.storage_bytes, UserModel.storage_files).filter(
+        UserModel.user_id == current_user.user_id
+    ).one()
+    
+    return {
+        "bytes": usage.storage_bytes,
+        "files": usage.storage_files,
+        "quota_bytes": STORAGE_QUOTA_BYTES,
+        "quota_files": STORAGE_QUOTA_FILES
+    }
 
 @api_router.get("/conclusions/{conclusion_id}/pieces")
 async def get_pieces(conclusion_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
@@ -877,24 +1642,11 @@ async def get_pieces(conclusion_id: str, current_user: User = Depends(get_curren
     pieces = db.query(PieceModel).filter(
         PieceModel.conclusion_id == conclusion_id,
         PieceModel.user_id == current_user.user_id
-    ).order_by(PieceModel.numero.asc()).all()
+    ).order_by(PieceModel.position.asc(), PieceModel.id.asc()).all()
     
     return [
-        Piece(
-            piece_id=p.piece_id,
-            conclusion_id=p.conclusion_id,
-            user_id=p.user_id,
-            numero=p.numero,
-            nom=p.nom,
-            description=p.description or "",
-            filename=p.filename,
-            original_filename=p.original_filename,
-            file_size=p.file_size,
-            mime_type=p.mime_type,
-            created_at=p.created_at,
-            updated_at=p.updated_at
-        )
-        for p in pieces
+        piece_to_schema(p, numero)
+        for numero, p in enumerate(pieces, start=1)
     ]
 
 @api_router.put("/conclusions/{conclusion_id}/pieces/reorder")
@@ -913,51 +1665,45 @@ async def reorder_pieces(
     if not conclusion:
         raise HTTPException(status_code=404, detail="Conclusion non trouvée")
     
-    # Update piece numbers based on new order
-    for idx, piece_id in enumerate(data.piece_ids, start=1):
-        piece = db.query(PieceModel).filter(
-            PieceModel.piece_id == piece_id,
-            PieceModel.conclusion_id == conclusion_id,
-            PieceModel.user_id == current_user.user_id
-        ).first()
-        if piece:
-            piece.numero = idx
-            piece.updated_at = datetime.now(timezone.utc)
-    
-    db.commit()
+    # Apply the new order with a single UPDATE ... FROM (VALUES ...)
+    piece_ids = list(dict.fromkeys(data.piece_ids))
+    if piece_ids:
+        new_positions = values(
+            column("piece_id", String), column("position", BigInteger), name="new_positions"
+        ).data([(piece_id, idx * PIECE_POSITION_GAP) for idx, piece_id in enumerate(piece_ids, start=1)])
+        
+        db.execute(
+            update(PieceModel)
+            .where(
+                PieceModel.piece_id == new_positions.c.piece_id,
+                PieceModel.conclusion_id == conclusion_id,
+                PieceModel.user_id == current_user.user_id
+            )
+            .values(position=new_positions.c.position, updated_at=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
     
     # Return updated pieces
     pieces = db.query(PieceModel).filter(
         PieceModel.conclusion_id == conclusion_id,
         PieceModel.user_id == current_user.user_id
-    ).order_by(PieceModel.numero.asc()).all()
+    ).order_by(PieceModel.position.asc(), PieceModel.id.asc()).all()
     
     return [
-        Piece(
-            piece_id=p.piece_id,
-            conclusion_id=p.conclusion_id,
-            user_id=p.user_id,
-            numero=p.numero,
-            nom=p.nom,
-            description=p.description or "",
-            filename=p.filename,
-            original_filename=p.original_filename,
-            file_size=p.file_size,
-            mime_type=p.mime_type,
-            created_at=p.created_at,
-            updated_at=p.updated_at
-        )
-        for p in pieces
+        piece_to_schema(p, numero)
+        for numero, p in enumerate(pieces, start=1)
     ]
 
-@api_router.put("/conclusions/{conclusion_id}/pieces/{piece_id}")
-async def update_piece(
+@api_router.put("/conclusions/{conclusion_id}/pieces/{piece_id}/move")
+async def move_piece(
     conclusion_id: str,
     piece_id: str,
-    data: PieceUpdateRequest,
+    data: PieceMoveRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    """Move one piece after another; only the moved row is written"""
     piece = db.query(PieceModel).filter(
         PieceModel.piece_id == piece_id,
         PieceModel.conclusion_id == conclusion_id,
@@ -967,34 +1713,52 @@ async def update_piece(
     if not piece:
         raise HTTPException(status_code=404, detail="Pièce non trouvée")
     
-    if data.nom is not None:
-        piece.nom = data.nom
-    if data.description is not None:
-        piece.description = data.description
-    piece.updated_at = datetime.now(timezone.utc)
+    if data.after_piece_id == piece_id:
+        raise HTTPException(status_code=400, detail="Une pièce ne peut pas être placée après elle-même")
+    
+    for attempt in range(2):
+        lower = 0
+        if data.after_piece_id:
+            after = db.query(PieceModel).filter(
+                PieceModel.piece_id == data.after_piece_id,
+                PieceModel.conclusion_id == conclusion_id,
+                PieceModel.user_id == current_user.user_id
+            ).first()
+            if not after:
+                raise HTTPException(status_code=404, detail="Pièce de référence non trouvée")
+            lower = after.position
+        
+        upper = db.query(func.min(PieceModel.position)).filter(
+            PieceModel.conclusion_id == conclusion_id,
+            PieceModel.position >= lower,
+            PieceModel.id != piece.id,
+            PieceModel.piece_id != data.after_piece_id
+        ).scalar()
+        
+        if upper is None:
+            # Last place: take a fresh slot so that keys stay below the counter's next one
+            new_position = allocate_piece_numbers(db, conclusion_id, current_user.user_id) * PIECE_POSITION_GAP
+            break
+        if upper - lower >= 2:
+            new_position = (lower + upper) // 2
+            break
+        # No room left between the neighbours (or tied keys): spread keys again and retry
+        rebalance_piece_positions(db, conclusion_id)
+    else:
+        raise HTTPException(status_code=409, detail="Impossible de déplacer la pièce, réessayez")
     
+    piece.position = new_position
+    piece.updated_at = datetime.now(timezone.utc)
     db.commit()
     db.refresh(piece)
     
-    return Piece(
-        piece_id=piece.piece_id,
-        conclusion_id=piece.conclusion_id,
-        user_id=piece.user_id,
-        numero=piece.numero,
-        nom=piece.nom,
-        description=piece.description or "",
-        filename=piece.filename,
-        original_filename=piece.original_filename,
-        file_size=piece.file_size,
-        mime_type=piece.mime_type,
-        created_at=piece.created_at,
-        updated_at=piece.updated_at
-    )
+    return piece_to_schema(piece, piece_display_numero(db, piece))
 
-@api_router.delete("/conclusions/{conclusion_id}/pieces/{piece_id}")
-async def delete_piece(
+@api_router.put("/conclusions/{conclusion_id}/pieces/{piece_id}")
+async def update_piece(
     conclusion_id: str,
     piece_id: str,
+    data: PieceUpdateRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -1007,32 +1771,110 @@ async def delete_piece(
     if not piece:
         raise HTTPException(status_code=404, detail="Pièce non trouvée")
     
-    # Delete file
-    file_path = UPLOADS_DIR / piece.filename
-    if file_path.exists():
-        file_path.unlink()
-    
-    # Delete record
-    db.delete(piece)
-    db.commit()
-    
-    # Renumber remaining pieces
-    remaining_pieces = db.query(PieceModel).filter(
-        PieceModel.conclusion_id == conclusion_id,
-        PieceModel.user_id == current_user.user_id
-    ).order_by(PieceModel.numero.asc()).all()
+    if data.nom is not None:
+        piece.nom = data.nom
+    if data.description is not None:
+        piece.description = data.description
+    piece.updated_at = datetime.now(timezone.utc)
+    
+    db.commit()
+    db.refresh(piece)
+    
+    return piece_to_schema(piece, piece_display_numero(db, piece))
+
+@api_router.delete("/conclusions/{conclusion_id}/pieces/{piece_id}")
+async def delete_piece(
+    conclusion_id: str,
+    piece_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Same lock order as insert_pieces and delete_conclusion: conclusion, pieces, user
+    db.execute(
+        select(LegalConclusionModel.id)
+        .where(LegalConclusionModel.conclusion_id == conclusion_id)
+        .with_for_update()
+    )
+    
+    # Numbers are ranks by position, so the remaining pieces need no renumbering
+    deleted = db.execute(
+        delete(PieceModel)
+        .where(
+            PieceModel.piece_id == piece_id,
+            PieceModel.conclusion_id == conclusion_id,
+            PieceModel.user_id == current_user.user_id
+        )
+        .returning(PieceModel.filename, PieceModel.file_size)
+        .execution_options(synchronize_session=False)
+    ).one_or_none()
+    
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="Pièce non trouvée")
     
-    for idx, p in enumerate(remaining_pieces, start=1):
-        if p.numero != idx:
-            p.numero = idx
-            p.updated_at = datetime.now(timezone.utc)
+    charge_storage_usage(db, current_user.user_id, conclusion_id, -1, -deleted.file_size)
     
+    # The file is removed by the cleanup worker once the row is gone
+    db.add(StorageCleanupModel(key=deleted.filename))
     db.commit()
+    storage_cleanup_wakeup.set()
     
     return {"message": "Pièce supprimée"}
 
+# Must match the expression of ix_piece_texts_search for the index to be used
+PIECE_TEXT_SEARCH_VECTOR = func.to_tsvector(literal_column("'french'"), PieceTextModel.content)
+
+@api_router.get("/pieces/search")
+async def search_pieces(
+    q: str,
+    conclusion_id: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Full-text search over piece contents, names and descriptions"""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Recherche vide")
+    
+    query = func.websearch_to_tsquery(literal_column("'french'"), q)
+    label_vector = func.to_tsvector(
+        literal_column("'french'"),
+        PieceModel.nom + " " + func.coalesce(PieceModel.description, "")
+    )
+    snippet = func.ts_headline(
+        literal_column("'french'"),
+        func.coalesce(PieceTextModel.content, ""),
+        query,
+        "MaxFragments=2, MinWords=5, MaxWords=20"
+    )
+    rank = func.coalesce(func.ts_rank(PIECE_TEXT_SEARCH_VECTOR, query), 0) + func.ts_rank(label_vector, query)
+    
+    # Displayed numbers (see piece_display_numero) of all the user's pieces, matching or not
+    numbered = select(
+        PieceModel.id,
+        func.row_number().over(
+            partition_by=PieceModel.conclusion_id, order_by=(PieceModel.position, PieceModel.id)
+        ).label("numero")
+    ).where(PieceModel.user_id == current_user.user_id)
+    if conclusion_id:
+        numbered = numbered.where(PieceModel.conclusion_id == conclusion_id)
+    numbered = numbered.subquery()
+    
+    search = db.query(PieceModel, numbered.c.numero, snippet).join(
+        numbered, numbered.c.id == PieceModel.id
+    ).outerjoin(
+        PieceTextModel, PieceTextModel.sha256 == PieceModel.sha256
+    ).filter(
+        or_(PIECE_TEXT_SEARCH_VECTOR.op("@@")(query), label_vector.op("@@")(query))
+    )
+    
+    results = search.order_by(rank.desc(), PieceModel.id).limit(50).all()
+    
+    return [
+        {"piece": piece_to_schema(piece, numero), "snippet": excerpt}
+        for piece, numero, excerpt in results
+    ]
+
 @api_router.get("/pieces/{piece_id}/download")
-async def download_piece(piece_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def download_piece(piece_id: str, request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     piece = db.query(PieceModel).filter(
         PieceModel.piece_id == piece_id,
         PieceModel.user_id == current_user.user_id
@@ -1041,143 +1883,381 @@ async def download_piece(piece_id: str, current_user: User = Depends(get_current
     if not piece:
         raise HTTPException(status_code=404, detail="Pièce non trouvée")
     
-    file_path = UPLOADS_DIR / piece.filename
+    # Compressed pieces are sent as stored when the client can decode them
+    send_encoded = bool(piece.content_encoding) and accepts_encoding(
+        request.headers.get("accept-encoding"), piece.content_encoding
+    )
+    
+    # Remote stores serve the bytes (and handle Range/ETag) themselves
+    if storage.direct_transfers and (send_encoded or not piece.content_encoding):
+        url = storage.presign_download(
+            piece.filename, piece.original_filename, piece.mime_type, content_encoding=piece.content_encoding
+        )
+        return RedirectResponse(url=url, status_code=307)
+    
+    if storage.direct_transfers:
+        # The store cannot decode the piece for this client: the API decodes it as it streams
+        return StreamingResponse(
+            iter_remote_decompressed(piece.filename, piece.content_encoding),
+            media_type=piece.mime_type,
+            headers={"Content-Disposition": content_disposition(piece.original_filename), "Vary": "Accept-Encoding"}
+        )
+    
+    file_path = storage.path(piece.filename)
     
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="Fichier non trouvé")
     
-    return FileResponse(
-        path=str(file_path),
-        filename=piece.original_filename,
-        media_type=piece.mime_type
+    # Pieces uploaded before content hashing was introduced
+    if not piece.sha256:
+        piece.sha256 = await storage.sha256(piece.filename)
+        db.commit()
+    
+    # Each representation of a compressed piece gets its own strong ETag
+    etag = f'"{piece.sha256}-{piece.content_encoding}"' if send_encoded else f'"{piece.sha256}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": PIECE_CACHE_CONTROL,
+        "Accept-Ranges": "none" if piece.content_encoding else "bytes"
+    }
+    if piece.content_encoding:
+        headers["Vary"] = "Accept-Encoding"
+    
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    headers["Content-Disposition"] = content_disposition(piece.original_filename)
+    
+    # Range requests are not served on compressed pieces: they get the whole file
+    if piece.content_encoding:
+        return stored_file_response(file_path, piece.content_encoding, send_encoded, piece.mime_type, headers)
+    
+    file_size = file_path.stat().st_size
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_byte_range(range_header, file_size)
+        except ValueError:
+            return Response(
+                status_code=416,
+                headers={**headers, "Content-Range": f"bytes */{file_size}"}
+            )
+    
+    if byte_range is None:
+        return FileResponse(path=str(file_path), media_type=piece.mime_type, headers=headers)
+    
+    start, end = byte_range
+    length = end - start + 1
+    headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    headers["Content-Length"] = str(length)
+    
+    return StreamingResponse(
+        iter_file_range(file_path, start, length),
+        status_code=206,
+        media_type=piece.mime_type,
+        headers=headers
     )
 
-# AI Generation Route
-@api_router.post("/generate/conclusion")
-async def generate_conclusion(
-    data: GenerateConclusionRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    user = db.query(UserModel).filter(
-        UserModel.user_id == current_user.user_id
+@api_router.get("/pieces/{piece_id}/download-url")
+async def get_piece_download_url(piece_id: str, request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Short-lived URL to fetch the piece directly from the store"""
+    piece = db.query(PieceModel).filter(
+        PieceModel.piece_id == piece_id,
+        PieceModel.user_id == current_user.user_id
     ).first()
     
-    if not user or user.credits <= 0:
-        raise HTTPException(
-            status_code=403, 
-            detail="Crédits insuffisants. Veuillez acheter des crédits pour générer une conclusion."
-        )
-    
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
-    if not api_key:
-        raise HTTPException(status_code=500, detail="Clé API non configurée")
+    if not piece:
+        raise HTTPException(status_code=404, detail="Pièce non trouvée")
     
-    # Get relevant articles
-    category = "famille" if data.type == "jaf" else "penal"
-    articles = db.query(CodeCivilArticleModel).filter(
-        CodeCivilArticleModel.categorie == category
-    ).limit(5).all()
-    
-    articles_context = "\n".join([
-        f"Article {art.numero} - {art.titre}:\n{art.contenu}"
-        for art in articles
-    ])
-    
-    if data.type == "jaf":
-        type_label = "Juge aux Affaires Familiales (JAF)"
-        system_prompt = f"""Vous êtes un assistant pédagogique spécialisé en rédaction d'écrits juridiques en droit de la famille français.
-
-IMPORTANT : Vous NE FOURNISSEZ PAS de conseil juridique. Vous aidez uniquement à structurer et rédiger de manière claire.
-
-Votre rôle :
-1. Structurer le document selon les usages du barreau
-2. Améliorer la clarté et le vocabulaire
-3. Rendre le texte plus factuel et moins émotionnel
-
-Vous NE devez PAS :
-- Donner des conseils sur la stratégie juridique
-- Interpréter les textes de loi
-- Dire ce qui va se passer au tribunal
-- Garantir un résultat
-
-Structure standard d'un écrit en JAF :
-1. EN-TÊTE : Tribunal, numéro, parties
-2. EXPOSÉ DES FAITS : Présentation chronologique factuelle
-3. ARGUMENTATION : Exposition des demandes avec références aux textes
-4. DISPOSITIF : Demandes précises et numérotées
-5. Formule de clôture et signature
-
-Articles du Code Civil souvent cités dans ce type d'affaires :
-{articles_context}
-
-Rédigez un document structuré en aidant l'utilisateur à présenter ses faits et demandes de manière claire."""
+    if (piece.content_encoding and storage.direct_transfers
+            and not accepts_encoding(request.headers.get("accept-encoding"), piece.content_encoding)):
+        # The store cannot decode the piece for this client: it is fetched through the API
+        url = f"/api/pieces/{piece.piece_id}/download"
     else:
-        type_label = "affaire pénale"
-        system_prompt = f"""Vous êtes un assistant pédagogique spécialisé en rédaction d'écrits juridiques en droit pénal français.
+        url = storage.presign_download(
+            piece.filename, piece.original_filename, piece.mime_type, content_encoding=piece.content_encoding
+        )
+    return {"url": absolute_url(request, url), "expires_in": PRESIGNED_URL_EXPIRES}
 
-IMPORTANT : Vous NE FOURNISSEZ PAS de conseil juridique. Vous aidez uniquement à structurer et rédiger de manière claire.
+# Previews: generated in the background after upload, or on first request
+preview_locks = KeyedLocks()
+preview_tasks = set()
 
-Votre rôle :
-1. Structurer le document selon les usages
-2. Améliorer la clarté et le vocabulaire juridique approprié
-3. Rendre le texte factuel et argumenté
+def preview_path(sha256: str) -> Path:
+    return PREVIEWS_DIR / sha256[:2] / f"{sha256}.webp"
 
-Vous NE devez PAS :
-- Conseiller sur la défense à adopter
-- Prédire l'issue du procès
-- Interpréter les faits juridiquement
-- Garantir un résultat
+async def ensure_piece_preview(key: str, mime_type: str, sha256: str, content_encoding: Optional[str] = None) -> Path:
+    output_path = preview_path(sha256)
+    # Files that cannot be rendered are remembered so they are not retried on every request
+    failed_path = output_path.with_suffix(".failed")
+    async with preview_locks.hold(sha256):
+        if failed_path.exists():
+            raise ValueError("Preview generation already failed for this content")
+        if not output_path.exists():
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=PREVIEWS_DIR) as tmp_dir:
+                source_path = await local_piece_path(key, tmp_dir, content_encoding)
+                loop = asyncio.get_running_loop()
+                try:
+                    await loop.run_in_executor(render_executor, render_preview, source_path, mime_type, str(output_path))
+                except Exception:
+                    failed_path.touch()
+                    raise
+    return output_path
 
-Structure standard d'un écrit pénal :
-1. EN-TÊTE : Juridiction, numéro, parties
-2. RAPPEL DES FAITS : Présentation factuelle
-3. ARGUMENTATION : Discussion des éléments
-4. DEMANDES : Ce qui est sollicité
-5. Formule de clôture
+async def generate_preview(piece_id: str, key: str, mime_type: str, sha256: str, content_encoding: Optional[str]):
+    try:
+        await ensure_piece_preview(key, mime_type, sha256, content_encoding)
+    except Exception:
+        logger.exception(f"Preview generation failed for piece {piece_id}")
+
+def schedule_previews(pieces: List[PieceModel]):
+    """Start preview generation without delaying the upload response"""
+    for piece in pieces:
+        # Pieces uploaded straight to a remote store have no hash yet: their preview is made on demand
+        if has_preview(piece.mime_type) and piece.sha256:
+            task = asyncio.create_task(generate_preview(
+                piece.piece_id, piece.filename, piece.mime_type, piece.sha256, piece.content_encoding
+            ))
+            preview_tasks.add(task)
+            task.add_done_callback(preview_tasks.discard)
 
-Articles souvent cités :
-{articles_context}
+def process_new_pieces(pieces: List[PieceModel]):
+    """Background work following an upload: previews and text extraction"""
+    schedule_previews(pieces)
+    text_extraction_wakeup.set()
 
-Aidez l'utilisateur à présenter ses éléments de manière structurée et claire."""
+@api_router.get("/pieces/{piece_id}/thumbnail")
+async def get_piece_thumbnail(piece_id: str, request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    piece = db.query(PieceModel).filter(
+        PieceModel.piece_id == piece_id,
+        PieceModel.user_id == current_user.user_id
+    ).first()
+    
+    if not piece:
+        raise HTTPException(status_code=404, detail="Pièce non trouvée")
+    
+    if not has_preview(piece.mime_type):
+        raise HTTPException(status_code=404, detail="Aperçu non disponible pour ce type de fichier")
+    
+    if not piece.sha256:
+        piece.sha256 = await storage.sha256(piece.filename)
+        db.commit()
+    
+    # A piece's content never changes: its preview can be cached for good
+    etag = f'"{piece.sha256}-preview"'
+    headers = {"ETag": etag, "Cache-Control": PIECE_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    try:
+        path = await ensure_piece_preview(piece.filename, piece.mime_type, piece.sha256, piece.content_encoding)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Fichier non trouvé")
+    except Exception:
+        logger.exception(f"Preview generation failed for piece {piece_id}")
+        raise HTTPException(status_code=422, detail="Impossible de générer l'aperçu de ce fichier")
     
-    parties_str = json.dumps(data.parties, ensure_ascii=False, indent=2)
-    user_prompt = f"""Aidez-moi à structurer un document pour une {type_label}.
+    return FileResponse(path=str(path), media_type=PREVIEW_MEDIA_TYPE, headers=headers)
 
-RAPPEL : Vous êtes un assistant pédagogique. Ne donnez PAS de conseil juridique.
-Aidez uniquement à structurer et clarifier la rédaction.
+# Direct uploads: the client sends the bytes to the store, the API only records metadata
+@api_router.post("/conclusions/{conclusion_id}/pieces/upload-url")
+async def create_piece_upload_url(
+    conclusion_id: str,
+    data: PieceUploadUrlRequest,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    conclusion = db.query(LegalConclusionModel).filter(
+        LegalConclusionModel.conclusion_id == conclusion_id,
+        LegalConclusionModel.user_id == current_user.user_id
+    ).first()
+    
+    if not conclusion:
+        raise HTTPException(status_code=404, detail="Conclusion non trouvée")
+    
+    if data.file_size is not None and data.file_size > MAX_FILE_SIZE:
+        raise HTTPException(status_code=400, detail="Le fichier dépasse la taille maximale de 10 Mo")
+    
+    check_storage_quota(db, current_user.user_id, data.file_size or 0)
+    
+    key = make_piece_key(conclusion_id, data.filename)
+    mime_type = data.content_type or "application/octet-stream"
+    upload = storage.presign_upload(key, mime_type, MAX_FILE_SIZE)
+    
+    upload_token = upload_signer.dumps({
+        "key": key,
+        "conclusion_id": conclusion_id,
+        "user_id": current_user.user_id,
+        "nom": data.nom,
+        "description": data.description,
+        "original_filename": data.filename or "fichier",
+        "mime_type": mime_type
+    })
+    
+    return {
+        "upload_token": upload_token,
+        "method": upload["method"],
+        "url": absolute_url(request, upload["url"]),
+        "fields": upload["fields"],
+        "headers": upload["headers"],
+        "expires_in": PRESIGNED_URL_EXPIRES
+    }
 
-PARTIES:
-{parties_str}
+@api_router.post("/conclusions/{conclusion_id}/pieces/complete", status_code=201)
+async def complete_piece_upload(
+    conclusion_id: str,
+    data: PieceUploadCompleteRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    try:
+        pending = upload_signer.loads(data.upload_token, max_age=PRESIGNED_URL_EXPIRES * 2)
+    except BadSignature:
+        raise HTTPException(status_code=400, detail="Jeton de téléversement invalide ou expiré")
+    
+    if pending["conclusion_id"] != conclusion_id or pending["user_id"] != current_user.user_id:
+        raise HTTPException(status_code=400, detail="Jeton de téléversement invalide ou expiré")
+    
+    conclusion = db.query(LegalConclusionModel).filter(
+        LegalConclusionModel.conclusion_id == conclusion_id,
+        LegalConclusionModel.user_id == current_user.user_id
+    ).first()
+    
+    if not conclusion:
+        raise HTTPException(status_code=404, detail="Conclusion non trouvée")
+    
+    # Completing twice returns the piece created the first time
+    existing = db.query(PieceModel).filter(PieceModel.filename == pending["key"]).first()
+    if existing:
+        return piece_to_schema(existing, piece_display_numero(db, existing))
+    
+    file_size = await storage.size(pending["key"])
+    if file_size is None:
+        raise HTTPException(status_code=400, detail="Fichier non reçu par le stockage")
+    
+    if file_size > MAX_FILE_SIZE:
+        await storage.delete(pending["key"])
+        raise HTTPException(status_code=400, detail="Le fichier dépasse la taille maximale de 10 Mo")
+    
+    # Hashing a remote object would pull it through the API: done lazily instead
+    sha256 = None if storage.direct_transfers else await storage.sha256(pending["key"])
+    
+    # A concurrent complete of the same token may have inserted the piece during the awaits:
+    # check again under the conclusion row lock, which insert_pieces keeps until its commit
+    db.query(LegalConclusionModel.id).filter(
+        LegalConclusionModel.conclusion_id == conclusion_id
+    ).with_for_update().one()
+    existing = db.query(PieceModel).filter(PieceModel.filename == pending["key"]).first()
+    if existing:
+        db.commit()
+        return piece_to_schema(existing, piece_display_numero(db, existing))
+    
+    new_piece, = insert_pieces(db, conclusion_id, current_user.user_id, [{
+        "nom": pending["nom"],
+        "description": pending["description"],
+        "filename": pending["key"],
+        "original_filename": pending["original_filename"],
+        "file_size": file_size,
+        "mime_type": pending["mime_type"],
+        "sha256": sha256
+    }])
+    db.refresh(new_piece)
+    process_new_pieces([new_piece])
+    
+    return piece_to_schema(new_piece, piece_display_numero(db, new_piece))
 
-FAITS (tels que décrits par l'utilisateur):
-{data.faits}
+# Local storage transfer endpoints, authorized by the signature of the presigned URL
+def get_local_storage() -> LocalPieceStorage:
+    if not isinstance(storage, LocalPieceStorage):
+        raise HTTPException(status_code=404, detail="Non disponible avec ce stockage")
+    return storage
 
-DEMANDES (telles que formulées par l'utilisateur):
-{data.demandes}
+@api_router.put("/storage/{key:path}")
+async def local_storage_upload(key: str, expires: int, max_size: int, sig: str, request: Request):
+    local_storage = get_local_storage()
+    if not local_storage.verify("put", key, expires, sig, str(max_size)):
+        raise HTTPException(status_code=403, detail="URL expirée ou invalide")
+    
+    # Once completed, the object belongs to a piece whose size and hash are recorded:
+    # the URL, still valid, must not replace it
+    try:
+        written = await local_storage.write_stream(key, request.stream(), max_size, exclusive=True)
+    except ObjectExistsError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except StorageError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    
+    return {"size": written}
 
-Produisez un document structuré qui aide l'utilisateur à présenter ces éléments de manière claire et organisée.
-Ajoutez des [NOTES PÉDAGOGIQUES] pour expliquer chaque section si nécessaire."""
+@api_router.get("/storage/{key:path}")
+async def local_storage_download(
+    key: str, expires: int, filename: str, content_type: str, sig: str, request: Request, content_encoding: str = ""
+):
+    local_storage = get_local_storage()
+    signed = (filename, content_type, content_encoding) if content_encoding else (filename, content_type)
+    if not local_storage.verify("get", key, expires, sig, *signed):
+        raise HTTPException(status_code=403, detail="URL expirée ou invalide")
     
-    chat = LlmChat(
-        api_key=api_key,
-        session_id=f"gen_{current_user.user_id}_{uuid.uuid4().hex[:8]}",
-        system_message=system_prompt
-    )
-    chat.with_model("gemini", "gemini-3-flash-preview")
+    file_path = local_storage.path(key)
+    if not file_path.exists():
+        raise HTTPException(status_code=404, detail="Fichier non trouvé")
     
-    user_message = UserMessage(text=user_prompt)
-    response = await chat.send_message(user_message)
+    if content_encoding:
+        send_encoded = accepts_encoding(request.headers.get("accept-encoding"), content_encoding)
+        headers = {"Content-Disposition": content_disposition(filename), "Vary": "Accept-Encoding"}
+        return stored_file_response(file_path, content_encoding, send_encoded, content_type, headers)
     
-    # Deduct credit
-    user.credits -= 1
-    db.commit()
+    return FileResponse(path=str(file_path), filename=filename, media_type=content_type)
+
+# Resumable uploads: create a session, PATCH chunks at the reported offset, then complete
+upload_locks = KeyedLocks()
+
+def resumable_upload_paths(upload_id: str):
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+        raise HTTPException(status_code=404, detail="Téléversement non trouvé")
+    return PARTIAL_UPLOADS_DIR / f"{upload_id}.json", PARTIAL_UPLOADS_DIR / f"{upload_id}.part"
+
+def load_resumable_upload(upload_id: str, user_id: str) -> dict:
+    meta_path, _ = resumable_upload_paths(upload_id)
+    try:
+        meta = json.loads(meta_path.read_text())
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Téléversement non trouvé")
     
-    return {"conclusion_text": response, "credits_used": 1}
+    if meta["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Téléversement non trouvé")
+    if not meta.get("piece_id") and datetime.fromisoformat(meta["expires_at"]) < datetime.now(timezone.utc):
+        raise HTTPException(status_code=410, detail="Téléversement expiré")
+    return meta
 
-# PDF Export Route
-@api_router.get("/conclusions/{conclusion_id}/pdf")
-async def export_pdf(conclusion_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def save_resumable_upload(meta: dict):
+    meta_path, _ = resumable_upload_paths(meta["upload_id"])
+    tmp_path = meta_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(meta))
+    os.replace(tmp_path, meta_path)
+
+def resumable_upload_status(meta: dict, offset: int) -> dict:
+    return {
+        "upload_id": meta["upload_id"],
+        "offset": offset,
+        "file_size": meta["file_size"],
+        "chunk_size": RESUMABLE_UPLOAD_CHUNK_SIZE,
+        "expires_at": meta["expires_at"],
+        "piece_id": meta.get("piece_id")
+    }
+
+@api_router.post("/conclusions/{conclusion_id}/pieces/uploads", status_code=201)
+async def create_resumable_upload(
+    conclusion_id: str,
+    data: ResumableUploadCreateRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
     conclusion = db.query(LegalConclusionModel).filter(
         LegalConclusionModel.conclusion_id == conclusion_id,
         LegalConclusionModel.user_id == current_user.user_id
@@ -1186,63 +2266,1886 @@ async def export_pdf(conclusion_id: str, current_user: User = Depends(get_curren
     if not conclusion:
         raise HTTPException(status_code=404, detail="Conclusion non trouvée")
     
-    buffer = io.BytesIO()
-    p = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
+    if data.file_size <= 0 or data.file_size > MAX_RESUMABLE_FILE_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"La taille du fichier doit être comprise entre 1 octet et {MAX_RESUMABLE_FILE_SIZE // (1024 * 1024)} Mo"
+        )
+    
+    if not re.fullmatch(r"[0-9a-fA-F]{64}", data.sha256):
+        raise HTTPException(status_code=400, detail="Empreinte SHA-256 invalide")
     
-    p.setFont("Helvetica-Bold", 14)
-    y = height - 2*cm
-    p.drawString(2*cm, y, f"CONCLUSIONS - {conclusion.type.upper()}")
+    check_storage_quota(db, current_user.user_id, data.file_size)
     
-    y -= 1.5*cm
-    p.setFont("Helvetica", 10)
-    p.drawString(2*cm, y, f"Généré le {datetime.now(timezone.utc).strftime('%d/%m/%Y')}")
+    now = datetime.now(timezone.utc)
+    meta = {
+        "upload_id": uuid.uuid4().hex,
+        "conclusion_id": conclusion_id,
+        "user_id": current_user.user_id,
+        "nom": data.nom,
+        "description": data.description,
+        "original_filename": data.filename or "fichier",
+        "mime_type": data.content_type or "application/octet-stream",
+        "file_size": data.file_size,
+        "sha256": data.sha256.lower(),
+        "created_at": now.isoformat(),
+        "expires_at": (now + RESUMABLE_UPLOAD_TTL).isoformat()
+    }
+    _, part_path = resumable_upload_paths(meta["upload_id"])
+    part_path.touch()
+    save_resumable_upload(meta)
     
-    y -= 2*cm
-    p.setFont("Helvetica", 11)
+    return resumable_upload_status(meta, 0)
+
+@api_router.get("/uploads/{upload_id}")
+async def get_resumable_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    meta = load_resumable_upload(upload_id, current_user.user_id)
+    _, part_path = resumable_upload_paths(upload_id)
+    offset = part_path.stat().st_size if part_path.exists() else meta["file_size"]
+    return resumable_upload_status(meta, offset)
+
+@api_router.patch("/uploads/{upload_id}")
+async def append_resumable_upload(upload_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    """Append a chunk; the Upload-Offset header must match the bytes already received"""
+    _, part_path = resumable_upload_paths(upload_id)
     
-    text = conclusion.conclusion_text or ""
-    lines = text.split('\n')
+    try:
+        client_offset = int(request.headers.get("upload-offset", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="En-tête Upload-Offset manquant ou invalide")
     
-    for line in lines:
-        if y < 3*cm:
-            p.showPage()
-            y = height - 2*cm
-            p.setFont("Helvetica", 11)
+    async with upload_locks.hold(upload_id):
+        meta = load_resumable_upload(upload_id, current_user.user_id)
+        if meta.get("piece_id") or not part_path.exists():
+            raise HTTPException(status_code=409, detail="Téléversement déjà finalisé")
+        
+        offset = part_path.stat().st_size
+        if client_offset != offset:
+            raise HTTPException(
+                status_code=409,
+                detail="Décalage incorrect, reprenez à l'offset indiqué",
+                headers={"Upload-Offset": str(offset)}
+            )
         
-        wrapped_lines = simpleSplit(line, "Helvetica", 11, width - 4*cm)
-        for wrapped_line in wrapped_lines:
-            if y < 3*cm:
-                p.showPage()
-                y = height - 2*cm
-                p.setFont("Helvetica", 11)
-            p.drawString(2*cm, y, wrapped_line)
-            y -= 0.5*cm
+        received = 0
+        async with aiofiles.open(part_path, 'ab') as f:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if offset + received > meta["file_size"]:
+                    await f.truncate(offset)
+                    raise HTTPException(status_code=413, detail="Données au-delà de la taille annoncée")
+                await f.write(chunk)
     
-    p.save()
-    buffer.seek(0)
+    new_offset = offset + received
+    return {"upload_id": upload_id, "offset": new_offset, "file_size": meta["file_size"]}
+
+@api_router.post("/uploads/{upload_id}/complete", status_code=201)
+async def complete_resumable_upload(upload_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    _, part_path = resumable_upload_paths(upload_id)
     
-    return StreamingResponse(
-        buffer,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename=conclusion_{conclusion_id}.pdf"}
+    async with upload_locks.hold(upload_id):
+        meta = load_resumable_upload(upload_id, current_user.user_id)
+        # A retried complete returns the piece created the first time
+        if meta.get("piece_id"):
+            new_piece = db.query(PieceModel).filter(PieceModel.piece_id == meta["piece_id"]).first()
+            if not new_piece:
+                raise HTTPException(status_code=404, detail="Pièce non trouvée")
+        else:
+            offset = part_path.stat().st_size
+            if offset != meta["file_size"]:
+                raise HTTPException(
+                    status_code=409,
+                    detail="Téléversement incomplet",
+                    headers={"Upload-Offset": str(offset)}
+                )
+            
+            digest = await run_in_threadpool(file_sha256, part_path)
+            if digest != meta["sha256"]:
+                # Corrupted transfer: restart from zero
+                part_path.write_bytes(b"")
+                raise HTTPException(status_code=422, detail="Empreinte SHA-256 différente, fichier corrompu")
+            
+            conclusion = db.query(LegalConclusionModel).filter(
+                LegalConclusionModel.conclusion_id == meta["conclusion_id"],
+                LegalConclusionModel.user_id == current_user.user_id
+            ).first()
+            
+            if not conclusion:
+                raise HTTPException(status_code=404, detail="Conclusion non trouvée")
+            
+            key = make_piece_key(meta["conclusion_id"], meta["original_filename"])
+            # put_file consumes its source: it gets the compressed copy, or a hard link to the
+            # received file, which is kept until the row is committed so that a failed complete can be retried
+            staged_path = part_path.with_suffix(".staged")
+            try:
+                content_encoding = await run_in_threadpool(
+                    compress_piece_file, part_path, staged_path, meta["mime_type"], PIECE_COMPRESSION
+                )
+                if content_encoding:
+                    stored_size = staged_path.stat().st_size
+                else:
+                    stored_size = meta["file_size"]
+                    staged_path.unlink(missing_ok=True)
+                    os.link(part_path, staged_path)
+                await storage.put_file(key, staged_path)
+            finally:
+                staged_path.unlink(missing_ok=True)
+            
+            # The stored file only survives if the row is committed
+            try:
+                new_piece, = insert_pieces(db, meta["conclusion_id"], current_user.user_id, [{
+                    "nom": meta["nom"],
+                    "description": meta["description"],
+                    "filename": key,
+                    "original_filename": meta["original_filename"],
+                    "file_size": meta["file_size"],
+                    "mime_type": meta["mime_type"],
+                    "sha256": digest,
+                    "content_encoding": content_encoding,
+                    "stored_size": stored_size
+                }])
+            except Exception:
+                await storage.delete(key)
+                raise
+            db.refresh(new_piece)
+            process_new_pieces([new_piece])
+            
+            meta["piece_id"] = new_piece.piece_id
+            save_resumable_upload(meta)
+            part_path.unlink()
+    
+    return piece_to_schema(new_piece, piece_display_numero(db, new_piece))
+
+@api_router.delete("/uploads/{upload_id}")
+async def abort_resumable_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    load_resumable_upload(upload_id, current_user.user_id)
+    meta_path, part_path = resumable_upload_paths(upload_id)
+    
+    async with upload_locks.hold(upload_id):
+        part_path.unlink(missing_ok=True)
+        meta_path.unlink(missing_ok=True)
+    
+    return {"message": "Téléversement annulé"}
+
+# AI Generation Route
+# Compiled system prompts, by (prompt type, version of the articles table); the trigger of
+# SCHEMA_UPGRADE_STATEMENTS bumps that version on any change, whoever makes it
+system_prompt_cache = PromptCache()
+
+def compiled_system_prompt(db: Session, conclusion_type: str):
+    kind = prompt_type(conclusion_type)
+    # Read before the articles: a change in between only compiles the newer articles twice
+    articles_revision = db.execute(
+        select(PromptSourceVersionModel.version).where(PromptSourceVersionModel.source == "code_civil_articles")
+    ).scalar() or 0
+    key = (kind, articles_revision)
+    compiled = system_prompt_cache.get(key)
+    if compiled is None:
+        articles = db.query(CodeCivilArticleModel).filter(
+            CodeCivilArticleModel.categorie == ARTICLE_CATEGORIES[kind]
+        ).order_by(CodeCivilArticleModel.id).limit(ARTICLES_PER_PROMPT).all()
+        compiled = compile_system_prompt(kind, articles)
+        system_prompt_cache.put(key, compiled)
+    return compiled
+
+def build_generation_prompts(db: Session, data: GenerateConclusionRequest) -> tuple:
+    """(system_prompt, user_prompt, prompt_version) for a conclusion of data.type"""
+    compiled = compiled_system_prompt(db, data.type)
+    user_prompt = build_user_prompt(compiled.type_label, data.parties, data.faits, data.demandes)
+    return compiled.system_prompt, user_prompt, compiled.version
+
+# Estimated prompt size (system and user prompt) above which the facts are summarized
+# before generation: long pasted facts slow the call, cost more and can overflow the context
+PROMPT_TOKEN_BUDGET = int(os.environ.get('GENERATION_PROMPT_TOKEN_BUDGET', '16000'))
+# Part of the budget the current document may take when one section is written again
+SECTION_DOCUMENT_TOKENS = PROMPT_TOKEN_BUDGET // 2
+
+async def summarize_faits(user_id: str, api_key: str, prompt: str) -> str:
+    # Part of a generation already admitted: waits for its turn whatever the queue depth
+    async with generation_governor.slot(user_id, queue_limit=False) as model:
+        return await llm.complete(
+            api_key, f"sum_{user_id}_{uuid.uuid4().hex[:8]}", SUMMARY_SYSTEM_PROMPT, prompt, model=model
+        )
+
+async def fit_prompt_budget(user_id: str, api_key: str, data: GenerateConclusionRequest,
+                            system_prompt: str, user_prompt: str, usage: dict, extra_tokens: int = 0) -> str:
+    """user_prompt, the facts summarized when the prompts exceed PROMPT_TOKEN_BUDGET.
+
+    extra_tokens: what is sent along with user_prompt (section instructions, the current
+    document of a rewrite). Adds to usage the token estimates of the request and the time
+    spent summarizing.
+    """
+    prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt) + extra_tokens
+    faits_tokens = estimate_tokens(data.faits)
+    usage.update({
+        "prompt_tokens": prompt_tokens,
+        "faits_tokens": faits_tokens,
+        "summarized": False,
+        "summary_calls": 0,
+        "summarization_seconds": 0.0
+    })
+    if prompt_tokens <= PROMPT_TOKEN_BUDGET:
+        return user_prompt
+    
+    # What is left for the facts once the rest of the prompts is in
+    faits_budget = max(MIN_SUMMARY_TOKENS, PROMPT_TOKEN_BUDGET - (prompt_tokens - faits_tokens))
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    faits, calls = await condense(
+        data.faits, faits_budget, lambda prompt, _max_tokens: summarize_faits(user_id, api_key, prompt)
+    )
+    if not calls:
+        # The facts are not what overflows the budget
+        return user_prompt
+    
+    user_prompt = build_user_prompt(
+        TYPE_LABELS[prompt_type(data.type)], data.parties, faits, data.demandes, summarized=True
     )
+    usage.update({
+        "prompt_tokens": estimate_tokens(system_prompt) + estimate_tokens(user_prompt) + extra_tokens,
+        "summarized": True,
+        "summarized_faits_tokens": estimate_tokens(faits),
+        "summary_calls": calls,
+        "summarization_seconds": round(loop.time() - started, 3)
+    })
+    generation_metrics["summarized_prompts"] += 1
+    generation_metrics["summary_calls"] += calls
+    generation_metrics["summarization_seconds"] += usage["summarization_seconds"]
+    return user_prompt
 
-app.include_router(api_router)
+# Credits are reserved before the LLM call: the reservation takes the credit at once, so
+# concurrent generations cannot spend the same one, and gives it back unless committed
+GENERATION_TIMEOUT = 300
+CREDIT_RESERVATION_TTL = GENERATION_TIMEOUT + 60
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
+# LLM calls go through the governor: capped per model and per instance, queued fairly
+# between users, refused with 429 beyond the queue limits (see governor.py)
+GENERATION_MAX_CONCURRENCY = int(os.environ.get('GENERATION_MAX_CONCURRENCY', '8'))
+GENERATION_FALLBACK_CONCURRENCY = int(os.environ.get('GENERATION_FALLBACK_CONCURRENCY', '4'))
+GENERATION_MAX_QUEUE = int(os.environ.get('GENERATION_MAX_QUEUE', '50'))
+GENERATION_MAX_QUEUE_PER_USER = 3
+
+generation_governor = LlmGovernor(
+    [(llm.GENERATION_MODEL, GENERATION_MAX_CONCURRENCY)]
+    + ([(llm.FALLBACK_MODEL, GENERATION_FALLBACK_CONCURRENCY)] if llm.FALLBACK_MODEL else []),
+    max_queue=GENERATION_MAX_QUEUE,
+    max_queue_per_user=GENERATION_MAX_QUEUE_PER_USER,
+    is_saturation_error=llm.is_rate_limited
 )
 
-# Health check endpoint
-@app.get("/api/health")
-async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
+def generation_busy(error: Saturated) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Trop de générations en cours. Veuillez réessayer dans quelques instants.",
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+def admit_generation(user_id: str):
+    """Refuse now, before anything is reserved, a generation that the governor would refuse"""
+    try:
+        generation_governor.check_admission(user_id)
+    except Saturated as e:
+        raise generation_busy(e)
+
+def insufficient_credits() -> HTTPException:
+    return HTTPException(
+        status_code=403, 
+        detail="Crédits insuffisants. Veuillez acheter des crédits pour générer une conclusion."
+    )
+
+def check_generation_allowed(db: Session, user_id: str) -> str:
+    """LLM API key, or the HTTP error preventing a generation; reserves nothing"""
+    user = db.query(UserModel).filter(
+        UserModel.user_id == user_id
+    ).first()
+    
+    if not user or user.credits <= 0:
+        raise insufficient_credits()
+    
+    api_key = os.environ.get('EMERGENT_LLM_KEY')
+    if not api_key and llm.client.requires_api_key:
+        raise HTTPException(status_code=500, detail="Clé API non configurée")
+    return api_key or ""
+
+def reserve_credit(db: Session, user_id: str) -> str:
+    """Move one credit into a new reservation and commit; 403 when none is left"""
+    remaining = db.execute(
+        update(UserModel)
+        .where(UserModel.user_id == user_id, UserModel.credits > 0)
+        .values(credits=UserModel.credits - 1)
+        .returning(UserModel.credits)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    if remaining is None:
+        db.rollback()
+        raise insufficient_credits()
+    
+    reservation_id = f"resv_{uuid.uuid4().hex[:12]}"
+    db.add(CreditReservationModel(
+        reservation_id=reservation_id,
+        user_id=user_id,
+        amount=1,
+        expires_at=datetime.now(timezone.utc) + timedelta(seconds=CREDIT_RESERVATION_TTL)
+    ))
+    db.commit()
+    return reservation_id
+
+def reserve_generation(db: Session, user_id: str) -> tuple:
+    """(LLM API key, credit reservation id), or the HTTP error preventing a generation"""
+    api_key = check_generation_allowed(db, user_id)
+    return api_key, reserve_credit(db, user_id)
+
+def commit_credit_reservation(db: Session, reservation_id: str, user_id: str) -> Optional[int]:
+    """Spend the reserved credit, in the caller's transaction.
+
+    Returns the credits left; None when the reservation had expired and given its
+    credit back, and no credit was left to take again.
+    """
+    spent = db.execute(
+        delete(CreditReservationModel)
+        .where(CreditReservationModel.reservation_id == reservation_id)
+        .returning(CreditReservationModel.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if not spent:
+        return db.execute(
+            update(UserModel)
+            .where(UserModel.user_id == user_id, UserModel.credits > 0)
+            .values(credits=UserModel.credits - 1)
+            .returning(UserModel.credits)
+            .execution_options(synchronize_session=False)
+        ).scalar_one_or_none()
+    return db.execute(select(UserModel.credits).where(UserModel.user_id == user_id)).scalar_one()
+
+def release_credit_reservations(condition) -> int:
+    """Give the credits of the matching reservations back; each one only once"""
+    db = SessionLocal()
+    try:
+        claimed = select(CreditReservationModel.id).where(condition).with_for_update(skip_locked=True)
+        released = db.execute(
+            delete(CreditReservationModel)
+            .where(CreditReservationModel.id.in_(claimed.scalar_subquery()))
+            .returning(CreditReservationModel.user_id, CreditReservationModel.amount)
+            .execution_options(synchronize_session=False)
+        ).all()
+        for user_id, amount in released:
+            db.execute(
+                update(UserModel)
+                .where(UserModel.user_id == user_id)
+                .values(credits=UserModel.credits + amount)
+                .execution_options(synchronize_session=False)
+            )
+        db.commit()
+        return len(released)
+    finally:
+        db.close()
+
+def release_credit_reservation(reservation_id: str) -> bool:
+    return release_credit_reservations(CreditReservationModel.reservation_id == reservation_id) > 0
+
+# Idempotent generation: requests repeating an Idempotency-Key with the same body share one
+# LLM call while it runs (single-flight), then get its response replayed for IDEMPOTENCY_TTL
+IDEMPOTENCY_TTL = 3600
+IDEMPOTENCY_POLL_INTERVAL = 0.5
+
+generation_flights: Dict[str, asyncio.Future] = {}
+
+class GenerationFlightAbandoned(Exception):
+    """The request producing a shared response was cancelled before it ended"""
+# Per process, since the last start; see /api/metrics
+generation_metrics = {
+    "idempotent_requests": 0, "idempotency_replays": 0, "idempotency_coalesced": 0,
+    "summarized_prompts": 0, "summary_calls": 0, "summarization_seconds": 0.0,
+    "events_dropped": 0
+}
+
+def generation_request_hash(endpoint: str, data: BaseModel) -> str:
+    payload = {"endpoint": endpoint, **data.model_dump()}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+def claim_idempotency_record(user_id: str, key: str, request_hash: str) -> Optional[dict]:
+    """None when the caller now owns the request; otherwise the record of whoever does or did"""
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        # Expired: a stale replay, or an instance that died mid-request
+        db.execute(
+            delete(IdempotencyRecordModel)
+            .where(
+                IdempotencyRecordModel.user_id == user_id,
+                IdempotencyRecordModel.idempotency_key == key,
+                IdempotencyRecordModel.request_hash == request_hash,
+                IdempotencyRecordModel.expires_at < now
+            )
+            .execution_options(synchronize_session=False)
+        )
+        claimed = db.execute(
+            pg_insert(IdempotencyRecordModel)
+            .values(
+                user_id=user_id, idempotency_key=key, request_hash=request_hash, status="in_progress",
+                created_at=now, expires_at=now + timedelta(seconds=GENERATION_TIMEOUT + 60)
+            )
+            .on_conflict_do_nothing(index_elements=["user_id", "idempotency_key", "request_hash"])
+            .returning(IdempotencyRecordModel.id)
+        ).first()
+        record = None
+        if not claimed:
+            record = db.execute(
+                select(IdempotencyRecordModel.status, IdempotencyRecordModel.response).where(
+                    IdempotencyRecordModel.user_id == user_id,
+                    IdempotencyRecordModel.idempotency_key == key,
+                    IdempotencyRecordModel.request_hash == request_hash
+                )
+            ).first()
+            # Released between the insert and the select: the next claim will tell
+            record = record._asdict() if record else {"status": "in_progress", "response": None}
+        db.commit()
+        return record
+    finally:
+        db.close()
+
+def finish_idempotency_record(user_id: str, key: str, request_hash: str, response: Optional[dict]):
+    """Keep the response for replay, or forget the request (response None) so that it can run again"""
+    db = SessionLocal()
+    try:
+        record = and_(
+            IdempotencyRecordModel.user_id == user_id,
+            IdempotencyRecordModel.idempotency_key == key,
+            IdempotencyRecordModel.request_hash == request_hash
+        )
+        if response is None:
+            db.execute(delete(IdempotencyRecordModel).where(record).execution_options(synchronize_session=False))
+        else:
+            db.execute(
+                update(IdempotencyRecordModel)
+                .where(record)
+                .values(
+                    status="completed", response=response,
+                    expires_at=datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_TTL)
+                )
+                .execution_options(synchronize_session=False)
+            )
+        db.commit()
+    finally:
+        db.close()
+
+async def run_recorded(user_id: str, key: str, request_hash: str, produce) -> dict:
+    """Replay, wait for another instance, or produce the response and record it"""
+    waiting = False
+    while True:
+        record = await run_in_threadpool(claim_idempotency_record, user_id, key, request_hash)
+        if record is None:
+            break
+        if record["status"] == "completed":
+            if not waiting:
+                generation_metrics["idempotency_replays"] += 1
+            return record["response"]
+        if not waiting:
+            generation_metrics["idempotency_coalesced"] += 1
+            waiting = True
+        await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+    
+    try:
+        response = await produce()
+    except BaseException:
+        await asyncio.shield(run_in_threadpool(finish_idempotency_record, user_id, key, request_hash, None))
+        raise
+    await run_in_threadpool(finish_idempotency_record, user_id, key, request_hash, response)
+    return response
+
+async def run_idempotent(user_id: str, key: Optional[str], endpoint: str, data: BaseModel, produce) -> dict:
+    """produce() once per (user, Idempotency-Key, request); without a key, every call produces"""
+    if not key:
+        return await produce()
+    if len(key) > 255:
+        raise HTTPException(status_code=400, detail="Clé d'idempotence trop longue (255 caractères maximum)")
+    
+    generation_metrics["idempotent_requests"] += 1
+    request_hash = generation_request_hash(endpoint, data)
+    flight_id = f"{user_id}:{key}:{request_hash}"
+    
+    # Same instance: join the call in flight without touching the database
+    flight = generation_flights.get(flight_id)
+    if flight:
+        generation_metrics["idempotency_coalesced"] += 1
+        try:
+            return await asyncio.shield(flight)
+        except GenerationFlightAbandoned:
+            # Not cancelled itself: goes through the database, as a request on another instance would
+            return await run_recorded(user_id, key, request_hash, produce)
+    
+    flight = asyncio.get_running_loop().create_future()
+    # Marks a failure as seen when no other request joined the flight
+    flight.add_done_callback(lambda f: f.cancelled() or f.exception())
+    generation_flights[flight_id] = flight
+    try:
+        response = await run_recorded(user_id, key, request_hash, produce)
+        flight.set_result(response)
+        return response
+    except asyncio.CancelledError:
+        flight.set_exception(GenerationFlightAbandoned(flight_id))
+        raise
+    except Exception as e:
+        flight.set_exception(e)
+        raise
+    finally:
+        del generation_flights[flight_id]
+
+@api_router.post("/generate/conclusion")
+async def generate_conclusion(
+    data: GenerateConclusionRequest,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    async def produce():
+        return await generate_conclusion_text(data, current_user.user_id, db)
+    
+    return await run_idempotent(
+        current_user.user_id, request.headers.get("idempotency-key"), "conclusion", data, produce
+    )
+
+# Every generation that reached the model is recorded as a generation event. Events are buffered
+# in memory and written in batches by generation_event_writer, so recording adds no database
+# round trip to the request; events still buffered when the process dies are lost, and beyond
+# GENERATION_EVENTS_BUFFER the oldest are dropped
+GENERATION_EVENTS_BUFFER = 10000
+GENERATION_EVENTS_BATCH = 1000
+GENERATION_EVENTS_FLUSH_INTERVAL = 2.0
+
+generation_event_buffer = deque(maxlen=GENERATION_EVENTS_BUFFER)
+
+def generation_failure(error: BaseException) -> tuple:
+    """(outcome, error message) of a generation ended by error"""
+    if isinstance(error, asyncio.CancelledError):
+        # Timeout of an outer wait_for, client gone or shutdown
+        return "cancelled", None
+    if isinstance(error, HTTPException):
+        return "failed", str(error.detail)[:500]
+    return "failed", f"{type(error).__name__}: {error}"[:500]
+
+def record_generation_event(user_id: str, event: dict, usage: dict, outcome: str, credits_charged: int,
+                            duration: float, error: Optional[str] = None):
+    """Queue the event for writing; event holds kind, type, prompt_version and optionally conclusion_id"""
+    if len(generation_event_buffer) == generation_event_buffer.maxlen:
+        generation_metrics["events_dropped"] += 1
+    generation_event_buffer.append({
+        "created_at": datetime.now(timezone.utc),
+        "user_id": user_id,
+        "conclusion_id": event.get("conclusion_id"),
+        "kind": event["kind"],
+        # The prompt family, not the type as sent: requests do not restrict it to known values
+        "type": prompt_type(event["type"]),
+        "model": usage.get("model"),
+        "prompt_version": event.get("prompt_version"),
+        "outcome": outcome,
+        "error": error,
+        "credits_charged": credits_charged,
+        "duration_seconds": round(duration, 3),
+        "queue_seconds": usage.get("queue_seconds"),
+        "upstream_seconds": usage.get("upstream_seconds"),
+        "first_token_seconds": usage.get("first_token_seconds"),
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "output_tokens": usage.get("output_tokens"),
+        "summary_calls": usage.get("summary_calls", 0),
+        "summarization_seconds": usage.get("summarization_seconds", 0.0)
+    })
+
+def record_slot(usage: dict, model: str, queue_seconds: float):
+    """Add a model call that got its governor slot; parallel calls keep the longest wait"""
+    models = usage.get("model")
+    usage["model"] = model if not models or model in models.split(",") else f"{models},{model}"
+    usage["queue_seconds"] = round(max(usage.get("queue_seconds", 0.0), queue_seconds), 3)
+
+def record_answer(usage: dict, upstream_seconds: float, text: str):
+    """Add a model answer; parallel calls keep the longest latency and add up their output"""
+    usage["upstream_seconds"] = round(max(usage.get("upstream_seconds", 0.0), upstream_seconds), 3)
+    usage["output_tokens"] = usage.get("output_tokens", 0) + estimate_tokens(text)
+
+def fall_back_after(error: Exception, model: Optional[str]) -> bool:
+    """Whether a call refused for load should be sent once more: its slot cooled the model
+    down, so the next slot goes to another one"""
+    if model is None or not llm.is_rate_limited(error) or not generation_governor.can_fall_back(model):
+        return False
+    logger.warning(f"Model {model} rate limited, sending the call to another model: {error}")
+    return True
+
+async def governed_complete(user_id: str, api_key: str, system_prompt: str, user_prompt: str,
+                            queue_limit: bool = True, usage: Optional[dict] = None) -> str:
+    usage = {} if usage is None else usage
+    loop = asyncio.get_running_loop()
+    model = None
+    for attempt in range(2):
+        queued_at = loop.time()
+        try:
+            # The retry was admitted already: it waits whatever the queue depth
+            async with generation_governor.slot(user_id, queue_limit and not attempt) as model:
+                started = loop.time()
+                record_slot(usage, model, started - queued_at)
+                text = await llm.complete(
+                    api_key, f"gen_{user_id}_{uuid.uuid4().hex[:8]}", system_prompt, user_prompt, model=model
+                )
+            break
+        except Exception as e:
+            if attempt or not fall_back_after(e, model):
+                raise
+    record_answer(usage, loop.time() - started, text)
+    return text
+
+async def budgeted_complete(user_id: str, api_key: str, data: GenerateConclusionRequest,
+                            system_prompt: str, user_prompt: str, usage: dict) -> str:
+    user_prompt = await fit_prompt_budget(user_id, api_key, data, system_prompt, user_prompt, usage)
+    return await governed_complete(user_id, api_key, system_prompt, user_prompt, usage=usage)
+
+async def paid_generation(db: Session, user_id: str, produce, event: dict, store=None) -> tuple:
+    """(await produce(api_key, usage), usage, credits left) with a credit reserved for the duration of the call.
+
+    produce fills usage (see fit_prompt_budget, record_slot). store(result), when given, writes
+    the result in the transaction that spends the credit; an exception from it gives the credit
+    back. The generation is recorded with the fields of event (see record_generation_event).
+    """
+    # Commits: the connection goes back to the pool for the duration of the LLM call
+    api_key, reservation_id = reserve_generation(db, user_id)
+    
+    usage = {}
+    started = asyncio.get_running_loop().time()
+    outcome, error, charged = "failed", None, 0
+    try:
+        try:
+            # The time spent queued and summarizing counts: the reservation must not expire before the call ends
+            result = await asyncio.wait_for(produce(api_key, usage), timeout=GENERATION_TIMEOUT)
+        except Saturated as e:
+            outcome = "busy"
+            await run_in_threadpool(release_credit_reservation, reservation_id)
+            raise generation_busy(e)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            await run_in_threadpool(release_credit_reservation, reservation_id)
+            raise HTTPException(status_code=504, detail="Délai de génération dépassé")
+        except BaseException as e:
+            outcome, error = generation_failure(e)
+            await asyncio.shield(run_in_threadpool(release_credit_reservation, reservation_id))
+            raise
+        
+        try:
+            if store:
+                store(result)
+            remaining = commit_credit_reservation(db, reservation_id, user_id)
+            db.commit()
+        except BaseException as e:
+            outcome, error = generation_failure(e)
+            db.rollback()
+            await asyncio.shield(run_in_threadpool(release_credit_reservation, reservation_id))
+            raise
+        outcome, charged = "succeeded", 0 if remaining is None else 1
+        return result, usage, remaining
+    finally:
+        record_generation_event(
+            user_id, event, usage, outcome, charged, asyncio.get_running_loop().time() - started, error
+        )
+
+async def generate_conclusion_text(data: GenerateConclusionRequest, user_id: str, db: Session) -> dict:
+    admit_generation(user_id)
+    system_prompt, user_prompt, prompt_version = build_generation_prompts(db, data)
+    
+    response, usage, remaining = await paid_generation(
+        db, user_id,
+        lambda api_key, usage: budgeted_complete(user_id, api_key, data, system_prompt, user_prompt, usage),
+        {"kind": "conclusion", "type": data.type, "prompt_version": prompt_version}
+    )
+    return {
+        "conclusion_text": response,
+        "credits_used": 0 if remaining is None else 1,
+        "prompt_version": prompt_version,
+        "usage": usage
+    }
+
+# Section-wise generation: each section of the conclusion is asked for separately with the
+# same context, so they are written in parallel, and one section can be written again alone
+async def generate_sections(user_id: str, api_key: str, kind: str, system_prompt: str, user_prompt: str,
+                            keys: List[str], usage: dict, document: Optional[str] = None,
+                            remarks: Optional[str] = None) -> dict:
+    """{key: text} of the sections, written concurrently; the first failure cancels the others"""
+    async def write(key: str) -> tuple:
+        # Admission was checked for the whole generation: every section waits for its turn
+        text = await governed_complete(
+            user_id, api_key, system_prompt, section_prompt(kind, key, user_prompt, document, remarks),
+            queue_limit=False, usage=usage
+        )
+        if not text.strip():
+            raise ValueError(f"Empty answer from the model for section {key}")
+        return key, text.strip()
+    
+    tasks = [asyncio.create_task(write(key)) for key in keys]
+    try:
+        return dict(await asyncio.gather(*tasks))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@api_router.post("/generate/conclusion/sections")
+async def generate_conclusion_by_sections(
+    data: GenerateConclusionRequest,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Same as /generate/conclusion, the sections being written in parallel; also returns them by key"""
+    async def produce():
+        return await generate_conclusion_sections(data, current_user.user_id, db)
+    
+    return await run_idempotent(
+        current_user.user_id, request.headers.get("idempotency-key"), "sections", data, produce
+    )
+
+async def generate_conclusion_sections(data: GenerateConclusionRequest, user_id: str, db: Session) -> dict:
+    admit_generation(user_id)
+    system_prompt, user_prompt, prompt_version = build_generation_prompts(db, data)
+    kind = prompt_type(data.type)
+    
+    # Every section is asked for with its own instructions around the user prompt
+    extra_tokens = max(estimate_tokens(section_prompt(kind, key, "")) for key, _ in SECTIONS[kind])
+    
+    async def produce(api_key: str, usage: dict) -> dict:
+        prompt = await fit_prompt_budget(user_id, api_key, data, system_prompt, user_prompt, usage, extra_tokens)
+        started = asyncio.get_running_loop().time()
+        sections = await generate_sections(
+            user_id, api_key, kind, system_prompt, prompt, [key for key, _ in SECTIONS[kind]], usage
+        )
+        logger.info(
+            f"Sectioned generation for {user_id}: {len(sections)} sections, "
+            f"{sum(map(len, sections.values()))} chars in {asyncio.get_running_loop().time() - started:.1f}s"
+        )
+        return sections
+    
+    sections, usage, remaining = await paid_generation(
+        db, user_id, produce, {"kind": "sections", "type": data.type, "prompt_version": prompt_version}
+    )
+    return {
+        "conclusion_text": assemble_sections(kind, sections),
+        "sections": sections,
+        "credits_used": 0 if remaining is None else 1,
+        "prompt_version": prompt_version,
+        "usage": usage
+    }
+
+@api_router.post("/generate/section")
+async def generate_section(
+    data: GenerateSectionRequest,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Write one section of an existing conclusion again, the rest of its text kept; costs one credit"""
+    async def produce():
+        return await regenerate_section(data, current_user.user_id, db)
+    
+    return await run_idempotent(
+        current_user.user_id, request.headers.get("idempotency-key"), "section", data, produce
+    )
+
+async def regenerate_section(data: GenerateSectionRequest, user_id: str, db: Session) -> dict:
+    conclusion = db.query(LegalConclusionModel).filter(
+        LegalConclusionModel.conclusion_id == data.conclusion_id,
+        LegalConclusionModel.user_id == user_id
+    ).first()
+    
+    if not conclusion:
+        raise HTTPException(status_code=404, detail="Conclusion non trouvée")
+    if conclusion.status == "generating":
+        raise HTTPException(status_code=409, detail="Une génération est en cours pour cette conclusion")
+    
+    kind = prompt_type(conclusion.type)
+    if data.section not in dict(SECTIONS[kind]):
+        raise HTTPException(status_code=400, detail="Section inconnue")
+    document = conclusion.conclusion_text or ""
+    if data.section not in section_spans(kind, document):
+        raise HTTPException(
+            status_code=422,
+            detail="Section introuvable dans la conclusion. Régénérez la conclusion entière."
+        )
+    
+    admit_generation(user_id)
+    source = GenerateConclusionRequest(
+        type=conclusion.type, parties=conclusion.parties or {},
+        faits=conclusion.faits or "", demandes=conclusion.demandes or ""
+    )
+    system_prompt, user_prompt, prompt_version = build_generation_prompts(db, source)
+    # The document shares the budget with the facts: a long one is shortened, the facts summarized
+    document = document_excerpt(kind, document, data.section, SECTION_DOCUMENT_TOKENS)
+    extra_tokens = estimate_tokens(section_prompt(kind, data.section, "", document, data.remarks))
+    
+    async def produce(api_key: str, usage: dict) -> str:
+        prompt = await fit_prompt_budget(user_id, api_key, source, system_prompt, user_prompt, usage, extra_tokens)
+        sections = await generate_sections(
+            user_id, api_key, kind, system_prompt, prompt, [data.section], usage,
+            document=document, remarks=data.remarks
+        )
+        return sections[data.section]
+    
+    def store(section_text: str):
+        # The text may have been edited during the call: the section is replaced in the latest version.
+        # prompt_version stays that of the whole generation: the section's is in its generation event
+        db.refresh(conclusion, with_for_update=True)
+        conclusion_text = replace_section(kind, conclusion.conclusion_text or "", data.section, section_text)
+        if conclusion_text is None:
+            raise HTTPException(status_code=409, detail="La section a été supprimée pendant la génération")
+        conclusion.conclusion_text = conclusion_text
+        conclusion.updated_at = datetime.now(timezone.utc)
+    
+    section_text, usage, remaining = await paid_generation(db, user_id, produce, {
+        "kind": "section", "type": conclusion.type, "prompt_version": prompt_version,
+        "conclusion_id": data.conclusion_id
+    }, store)
+    return {
+        "conclusion_id": conclusion.conclusion_id,
+        "section": data.section,
+        "section_text": section_text,
+        "conclusion_text": conclusion.conclusion_text,
+        "credits_used": 0 if remaining is None else 1,
+        "prompt_version": prompt_version,
+        "usage": usage
+    }
+
+# Streamed generation: the conclusion is created up front and filled as the model writes, so a
+# dropped connection loses nothing; the credit is only taken once the whole text is in
+GENERATION_SAVE_INTERVAL = 2.0
+SSE_HEARTBEAT_INTERVAL = 15.0
+
+generation_tasks = set()
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def save_generated_text(conclusion_id: str, conclusion_text: str, status: str):
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(LegalConclusionModel)
+            .where(LegalConclusionModel.conclusion_id == conclusion_id)
+            .values(conclusion_text=conclusion_text, status=status, updated_at=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+class GenerationJobTakenOver(Exception):
+    """The lease of a job expired during its run and another worker claimed it"""
+
+def complete_streamed_generation(conclusion_id: str, user_id: str, conclusion_text: str, prompt_version: str,
+                                 reservation_id: str, job: Optional[tuple] = None, usage: Optional[dict] = None) -> Optional[int]:
+    """Store the final text and spend the reserved credit in one transaction.
+
+    job: (job_id, attempt) of a queued generation, marked succeeded in the same transaction,
+    so that a worker dying after the commit cannot run it (and charge it) again.
+    GenerationJobTakenOver when that attempt no longer owns the job: nothing is written.
+
+    Returns the credits left, None when the reservation expired and the last credit
+    was spent meanwhile (the text is kept).
+    """
+    db = SessionLocal()
+    try:
+        if job:
+            job_id, attempt = job
+            # The attempt number fences off a run whose lease expired
+            owned = db.execute(
+                update(GenerationJobModel)
+                .where(
+                    GenerationJobModel.job_id == job_id,
+                    GenerationJobModel.status == "running",
+                    GenerationJobModel.attempts == attempt
+                )
+                .values(
+                    status="succeeded", last_error=None, lease_expires_at=None, usage=usage,
+                    finished_at=datetime.now(timezone.utc)
+                )
+                .returning(GenerationJobModel.id)
+                .execution_options(synchronize_session=False)
+            ).first()
+            if owned is None:
+                raise GenerationJobTakenOver(f"Job {job_id} was claimed again after attempt {attempt}")
+        
+        # Same lock order as everywhere else: job, conclusion, then user
+        db.execute(
+            update(LegalConclusionModel)
+            .where(LegalConclusionModel.conclusion_id == conclusion_id)
+            .values(
+                conclusion_text=conclusion_text, status="draft", prompt_version=prompt_version,
+                updated_at=datetime.now(timezone.utc)
+            )
+            .execution_options(synchronize_session=False)
+        )
+        remaining = commit_credit_reservation(db, reservation_id, user_id)
+        db.commit()
+        return remaining
+    finally:
+        db.close()
+
+async def generate_into_conclusion(conclusion_id: str, user_id: str, api_key: str, reservation_id: str,
+                                   data: GenerateConclusionRequest, system_prompt: str, user_prompt: str,
+                                   prompt_version: str, on_delta=None, kind: str = "stream",
+                                   job: Optional[tuple] = None) -> tuple:
+    """Write the model's answer into the conclusion as it comes, then spend the reserved credit.
+
+    Returns (credits left, see complete_streamed_generation; usage, see fit_prompt_budget).
+    On failure the partial text stays saved, the credit is given back and the exception propagates.
+    The generation is recorded as an event of kind stream or job; job is (job_id, attempt) for a job.
+    """
+    loop = asyncio.get_running_loop()
+    begun = loop.time()
+    first_delta_at = None
+    parts = []
+    usage = {}
+    event = {"kind": kind, "type": data.type, "prompt_version": prompt_version, "conclusion_id": conclusion_id}
+    try:
+        user_prompt = await fit_prompt_budget(user_id, api_key, data, system_prompt, user_prompt, usage)
+        model = None
+        for attempt in range(2):
+            queued_at = loop.time()
+            try:
+                # Admission was checked by the endpoint; a job waits for its turn whatever the queue depth
+                async with generation_governor.slot(user_id, queue_limit=False) as model:
+                    started = last_save = loop.time()
+                    record_slot(usage, model, started - queued_at)
+                    async for delta in llm.stream(
+                        api_key, f"gen_{user_id}_{uuid.uuid4().hex[:8]}", system_prompt, user_prompt, model=model
+                    ):
+                        if first_delta_at is None:
+                            first_delta_at = loop.time()
+                            usage["first_token_seconds"] = round(first_delta_at - started, 3)
+                        parts.append(delta)
+                        if on_delta:
+                            on_delta(delta)
+                        if loop.time() - last_save >= GENERATION_SAVE_INTERVAL:
+                            await run_in_threadpool(save_generated_text, conclusion_id, "".join(parts), "generating")
+                            last_save = loop.time()
+                break
+            except Exception as e:
+                # Once text was shown, another model would not continue it: the generation fails
+                if attempt or parts or not fall_back_after(e, model):
+                    raise
+        
+        conclusion_text = "".join(parts)
+        record_answer(usage, loop.time() - started, conclusion_text)
+        if not conclusion_text.strip():
+            raise ValueError("Empty answer from the model")
+        remaining = await run_in_threadpool(
+            complete_streamed_generation, conclusion_id, user_id, conclusion_text, prompt_version, reservation_id,
+            job, usage
+        )
+    except BaseException as e:
+        # Also on cancellation (timeout, shutdown): keep what was written
+        outcome, error = generation_failure(e)
+        record_generation_event(user_id, event, usage, outcome, 0, loop.time() - begun, error)
+        # A job taken over belongs to the run that claimed it again
+        if not isinstance(e, GenerationJobTakenOver):
+            await asyncio.shield(run_in_threadpool(save_generated_text, conclusion_id, "".join(parts), "generation_failed"))
+        await asyncio.shield(run_in_threadpool(release_credit_reservation, reservation_id))
+        raise
+    
+    record_generation_event(
+        user_id, event, usage, "succeeded", 0 if remaining is None else 1, loop.time() - begun
+    )
+    elapsed = loop.time() - started
+    logger.info(
+        f"Generation {conclusion_id} ({model}, queued {started - queued_at:.2f}s): first text after {first_delta_at - started:.2f}s, "
+        f"{len(conclusion_text)} chars in {elapsed:.1f}s ({len(conclusion_text) / elapsed:.0f} chars/s), "
+        f"prompt ~{usage['prompt_tokens']} tokens"
+        + (f" after summarizing the facts in {usage['summarization_seconds']:.1f}s" if usage["summarized"] else "")
+    )
+    if remaining is None:
+        logger.warning(f"Conclusion {conclusion_id} generated after the last credit of {user_id} was spent")
+    return remaining, usage
+
+async def run_streamed_generation(conclusion_id: str, user_id: str, api_key: str, reservation_id: str,
+                                  data: GenerateConclusionRequest, prompts: tuple, events: asyncio.Queue):
+    """Produce the text into events and the database; keeps going if the client disconnects"""
+    try:
+        remaining, usage = await asyncio.wait_for(generate_into_conclusion(
+            conclusion_id, user_id, api_key, reservation_id, data, *prompts,
+            on_delta=lambda delta: events.put_nowait(("delta", {"text": delta}))
+        ), timeout=GENERATION_TIMEOUT)
+    except Exception:
+        logger.exception(f"Streamed generation failed for conclusion {conclusion_id}")
+        events.put_nowait(("error", {"detail": "Erreur lors de la génération de la conclusion"}))
+        return
+    
+    events.put_nowait(("done", {
+        "conclusion_id": conclusion_id,
+        "credits_used": 0 if remaining is None else 1,
+        "credits_remaining": remaining or 0,
+        "usage": usage
+    }))
+
+def add_generating_conclusion(db: Session, user_id: str, data: GenerateConclusionRequest) -> str:
+    """Add (without committing) the conclusion a generation will fill"""
+    conclusion_id = f"concl_{uuid.uuid4().hex[:12]}"
+    now = datetime.now(timezone.utc)
+    db.add(LegalConclusionModel(
+        conclusion_id=conclusion_id,
+        user_id=user_id,
+        type=data.type,
+        parties=data.parties,
+        faits=data.faits,
+        demandes=data.demandes,
+        conclusion_text="",
+        status="generating",
+        created_at=now,
+        updated_at=now
+    ))
+    return conclusion_id
+
+@api_router.post("/generate/conclusion/stream")
+async def stream_conclusion_generation(
+    data: GenerateConclusionRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Server-sent events: start (conclusion_id), delta (text) as it is written, then done or error"""
+    admit_generation(current_user.user_id)
+    prompts = build_generation_prompts(db, data)
+    api_key, reservation_id = reserve_generation(db, current_user.user_id)
+    conclusion_id = add_generating_conclusion(db, current_user.user_id, data)
+    db.commit()
+    
+    events = asyncio.Queue()
+    task = asyncio.create_task(run_streamed_generation(
+        conclusion_id, current_user.user_id, api_key, reservation_id, data, prompts, events
+    ))
+    generation_tasks.add(task)
+    task.add_done_callback(generation_tasks.discard)
+    
+    async def event_stream():
+        yield sse_event("start", {"conclusion_id": conclusion_id})
+        while True:
+            try:
+                event, payload = await asyncio.wait_for(events.get(), timeout=SSE_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                # Comment line: keeps proxies from closing a connection idle while the model thinks
+                yield ": keepalive\n\n"
+                continue
+            yield sse_event(event, payload)
+            if event != "delta":
+                return
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Queued generation: the request returns a job at once, GENERATION_WORKERS tasks per instance
+# run the jobs (see generation_worker), polled through GET /generate/jobs/{job_id}
+GENERATION_WORKERS = int(os.environ.get('GENERATION_WORKERS', '4'))
+GENERATION_JOB_MAX_ATTEMPTS = 3
+GENERATION_JOB_RETRY_DELAY = 30
+GENERATION_JOB_POLL_INTERVAL = 5
+
+generation_jobs_wakeup = asyncio.Event()
+
+@api_router.post("/generate/jobs", status_code=202)
+async def submit_generation_job(
+    data: GenerateConclusionRequest,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """A repeated Idempotency-Key returns the job of the first submission"""
+    async def produce():
+        # Checked again when the job runs; refusing here spares a job that cannot succeed
+        check_generation_allowed(db, current_user.user_id)
+        conclusion_id = add_generating_conclusion(db, current_user.user_id, data)
+        job = GenerationJobModel(
+            job_id=f"job_{uuid.uuid4().hex[:12]}",
+            user_id=current_user.user_id,
+            conclusion_id=conclusion_id,
+            request=data.model_dump(),
+            status="queued",
+            run_after=datetime.now(timezone.utc)
+        )
+        db.add(job)
+        db.commit()
+        generation_jobs_wakeup.set()
+        return {"job_id": job.job_id, "conclusion_id": conclusion_id, "status": "queued"}
+    
+    return await run_idempotent(
+        current_user.user_id, request.headers.get("idempotency-key"), "job", data, produce
+    )
+
+@api_router.get("/generate/jobs/{job_id}")
+async def get_generation_job(job_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    job = db.query(GenerationJobModel).filter(
+        GenerationJobModel.job_id == job_id,
+        GenerationJobModel.user_id == current_user.user_id
+    ).first()
+    
+    if not job:
+        raise HTTPException(status_code=404, detail="Tâche de génération non trouvée")
+    
+    conclusion_text = db.query(LegalConclusionModel.conclusion_text).filter(
+        LegalConclusionModel.conclusion_id == job.conclusion_id
+    ).scalar() or ""
+    
+    result = {
+        "job_id": job.job_id,
+        "conclusion_id": job.conclusion_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": GENERATION_JOB_MAX_ATTEMPTS,
+        "error": job.last_error,
+        "progress_chars": len(conclusion_text),
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "usage": job.usage
+    }
+    if job.status == "queued":
+        result["queue_position"] = db.query(func.count(GenerationJobModel.id)).filter(
+            GenerationJobModel.status == "queued",
+            GenerationJobModel.id < job.id
+        ).scalar() + 1
+        if job.attempts:
+            result["retry_at"] = job.run_after.isoformat()
+    elif job.status == "succeeded":
+        result["conclusion_text"] = conclusion_text
+    return result
+
+# PDF Export Route
+@api_router.get("/conclusions/{conclusion_id}/pdf")
+async def export_pdf(conclusion_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    conclusion = db.query(LegalConclusionModel).filter(
+        LegalConclusionModel.conclusion_id == conclusion_id,
+        LegalConclusionModel.user_id == current_user.user_id
+    ).first()
+    
+    if not conclusion:
+        raise HTTPException(status_code=404, detail="Conclusion non trouvée")
+    
+    buffer = io.BytesIO()
+    p = canvas.Canvas(buffer, pagesize=A4)
+    draw_conclusion(p, conclusion.type, conclusion.conclusion_text)
+    p.save()
+    buffer.seek(0)
+    
+    return StreamingResponse(
+        buffer,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename=conclusion_{conclusion_id}.pdf"}
+    )
+
+dossier_locks = KeyedLocks()
+
+def dossier_fingerprint(conclusion: LegalConclusionModel, pieces: List[PieceModel]) -> str:
+    """Changes whenever the conclusion or any piece (content, metadata or order) changes"""
+    h = hashlib.sha256()
+    h.update(f"{conclusion.conclusion_id}|{conclusion.updated_at.isoformat()}".encode())
+    for piece in pieces:
+        h.update(f"|{piece.piece_id}:{piece.filename}:{piece.updated_at.isoformat()}".encode())
+    return h.hexdigest()[:32]
+
+def remove_cached_dossiers(conclusion_id: str, keep: Optional[Path] = None):
+    for path in DOSSIERS_DIR.glob(f"{conclusion_id}_*.pdf"):
+        if path != keep:
+            path.unlink(missing_ok=True)
+
+async def build_dossier(conclusion: LegalConclusionModel, pieces: List[PieceModel], output_path: Path):
+    conclusion_data = {"type": conclusion.type, "conclusion_text": conclusion.conclusion_text}
+    piece_data = [
+        {
+            "numero": numero,
+            "nom": piece.nom,
+            "description": piece.description,
+            "original_filename": piece.original_filename,
+            "file_size": piece.file_size,
+            "mime_type": piece.mime_type,
+            "sha256": piece.sha256
+        }
+        for numero, piece in enumerate(pieces, start=1)
+    ]
+    
+    with tempfile.TemporaryDirectory(dir=DOSSIERS_DIR) as tmp_dir:
+        for data, piece in zip(piece_data, pieces):
+            data["path"] = await local_piece_path(piece.filename, tmp_dir, piece.content_encoding)
+        
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(render_executor, render_dossier, str(output_path), conclusion_data, piece_data)
+
+@api_router.get("/conclusions/{conclusion_id}/dossier")
+async def export_dossier(conclusion_id: str, request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Conclusions, bordereau de pièces and every PDF or image piece merged in one file"""
+    conclusion = db.query(LegalConclusionModel).filter(
+        LegalConclusionModel.conclusion_id == conclusion_id,
+        LegalConclusionModel.user_id == current_user.user_id
+    ).first()
+    
+    if not conclusion:
+        raise HTTPException(status_code=404, detail="Conclusion non trouvée")
+    
+    pieces = db.query(PieceModel).filter(
+        PieceModel.conclusion_id == conclusion_id
+    ).order_by(PieceModel.position, PieceModel.id).all()
+    
+    fingerprint = dossier_fingerprint(conclusion, pieces)
+    etag = f'"{fingerprint}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    output_path = DOSSIERS_DIR / f"{conclusion_id}_{fingerprint}.pdf"
+    async with dossier_locks.hold(conclusion_id):
+        if not output_path.exists():
+            try:
+                await build_dossier(conclusion, pieces, output_path)
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail="Fichier d'une pièce non trouvé sur le serveur")
+            remove_cached_dossiers(conclusion_id, keep=output_path)
+    
+    return FileResponse(
+        path=str(output_path),
+        filename=f"dossier_{conclusion_id}.pdf",
+        media_type="application/pdf",
+        headers=headers
+    )
+
+# Background storage cleanup: files of deleted pieces are removed outside of requests
+STORAGE_CLEANUP_BATCH_SIZE = 100
+STORAGE_CLEANUP_INTERVAL = 30
+STORAGE_CLEANUP_MAX_ATTEMPTS = 5
+STORAGE_CLEANUP_LEASE = timedelta(minutes=5)
+
+storage_cleanup_wakeup = asyncio.Event()
+background_tasks: List[asyncio.Task] = []
+
+def claim_storage_cleanup_batch() -> list:
+    """Lease a batch of queued keys; SKIP LOCKED lets several instances drain the queue.
+
+    Rows stay queued until their file is gone: the keys of a worker that dies are
+    claimed again once the lease expires.
+    """
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        claimed = select(StorageCleanupModel.id).where(
+            StorageCleanupModel.attempts < STORAGE_CLEANUP_MAX_ATTEMPTS,
+            or_(StorageCleanupModel.locked_until.is_(None), StorageCleanupModel.locked_until < now)
+        ).order_by(StorageCleanupModel.id).limit(STORAGE_CLEANUP_BATCH_SIZE).with_for_update(skip_locked=True)
+        
+        rows = db.execute(
+            update(StorageCleanupModel)
+            .where(StorageCleanupModel.id.in_(claimed.scalar_subquery()))
+            .values(locked_until=now + STORAGE_CLEANUP_LEASE, attempts=StorageCleanupModel.attempts + 1)
+            .returning(StorageCleanupModel.id, StorageCleanupModel.key)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.commit()
+        return rows
+    finally:
+        db.close()
+
+def finish_storage_cleanup(removed_ids: list, failures: list):
+    """Drop the rows of removed files; failed ones are released for a later pass"""
+    db = SessionLocal()
+    try:
+        if removed_ids:
+            db.execute(
+                delete(StorageCleanupModel)
+                .where(StorageCleanupModel.id.in_(removed_ids))
+                .execution_options(synchronize_session=False)
+            )
+        for row_id, error in failures:
+            db.execute(
+                update(StorageCleanupModel)
+                .where(StorageCleanupModel.id == row_id)
+                .values(locked_until=None, last_error=error)
+                .execution_options(synchronize_session=False)
+            )
+        db.commit()
+    finally:
+        db.close()
+
+def drop_exhausted_storage_cleanups() -> list:
+    """Remove the rows out of attempts and return their keys and last errors"""
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        rows = db.execute(
+            delete(StorageCleanupModel)
+            .where(
+                StorageCleanupModel.attempts >= STORAGE_CLEANUP_MAX_ATTEMPTS,
+                or_(StorageCleanupModel.locked_until.is_(None), StorageCleanupModel.locked_until < now)
+            )
+            .returning(StorageCleanupModel.key, StorageCleanupModel.last_error)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.commit()
+        return rows
+    finally:
+        db.close()
+
+async def drain_storage_cleanup_queue() -> int:
+    for key, error in await run_in_threadpool(drop_exhausted_storage_cleanups):
+        # Left to the garbage collector (gc_uploads.py), which finds files without a piece
+        logger.error(f"Storage cleanup gave up on {key} after {STORAGE_CLEANUP_MAX_ATTEMPTS} attempts: {error}")
+    
+    removed = 0
+    while True:
+        rows = await run_in_threadpool(claim_storage_cleanup_batch)
+        if not rows:
+            return removed
+        
+        removed_ids, failures = [], []
+        for row_id, key in rows:
+            try:
+                await storage.delete(key)
+                removed_ids.append(row_id)
+            except Exception as e:
+                logger.warning(f"Storage cleanup failed for {key}: {e}")
+                failures.append((row_id, str(e)))
+        
+        await run_in_threadpool(finish_storage_cleanup, removed_ids, failures)
+        removed += len(removed_ids)
+        if failures:
+            return removed
+
+async def storage_cleanup_worker():
+    while True:
+        try:
+            removed = await drain_storage_cleanup_queue()
+            if removed:
+                logger.info(f"Storage cleanup: {removed} file(s) removed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Storage cleanup worker error: {e}", exc_info=True)
+        
+        storage_cleanup_wakeup.clear()
+        try:
+            await asyncio.wait_for(storage_cleanup_wakeup.wait(), timeout=STORAGE_CLEANUP_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+# Background text extraction: fills piece_texts for every new content hash
+TEXT_EXTRACTION_BATCH_SIZE = 20
+TEXT_EXTRACTION_INTERVAL = 60
+
+text_extraction_wakeup = asyncio.Event()
+
+def pending_text_extractions(after_id: int) -> list:
+    """Extractable pieces whose content has no text yet (or no hash yet), from after_id on"""
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(
+                PieceModel.id, PieceModel.piece_id, PieceModel.filename, PieceModel.mime_type,
+                PieceModel.sha256, PieceModel.content_encoding
+            )
+            .outerjoin(PieceTextModel, PieceTextModel.sha256 == PieceModel.sha256)
+            .where(
+                PieceModel.id > after_id,
+                PieceModel.mime_type.in_(EXTRACTABLE_MIME_TYPES),
+                PieceTextModel.sha256.is_(None)
+            )
+            .order_by(PieceModel.id)
+            .limit(TEXT_EXTRACTION_BATCH_SIZE)
+        ).all()
+    finally:
+        db.close()
+
+def save_piece_text(piece_id: str, sha256: str, content: str, status: str):
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(PieceModel)
+            .where(PieceModel.piece_id == piece_id, PieceModel.sha256.is_(None))
+            .values(sha256=sha256)
+            .execution_options(synchronize_session=False)
+        )
+        # Another instance may have extracted the same content meanwhile
+        db.execute(
+            pg_insert(PieceTextModel)
+            .values(sha256=sha256, content=content, status=status, extracted_at=datetime.now(timezone.utc))
+            .on_conflict_do_nothing(index_elements=["sha256"])
+        )
+        db.commit()
+    finally:
+        db.close()
+
+async def extract_piece_text(piece_id: str, key: str, mime_type: str, sha256: Optional[str], content_encoding: Optional[str]):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_path = await local_piece_path(key, tmp_dir, content_encoding)
+        if not sha256:
+            sha256 = await run_in_threadpool(file_sha256, Path(source_path))
+        
+        loop = asyncio.get_running_loop()
+        try:
+            content = await loop.run_in_executor(render_executor, extract_text, source_path, mime_type)
+            status = "extracted" if content else "empty"
+        except Exception as e:
+            logger.warning(f"Text extraction failed for piece {piece_id}: {e}")
+            content, status = "", "failed"
+    
+    await run_in_threadpool(save_piece_text, piece_id, sha256, content, status)
+
+async def drain_text_extractions() -> int:
+    extracted = 0
+    # Keyset cursor: pieces that could not be read are passed over, and retried on the next run,
+    # instead of filling every batch
+    last_id = 0
+    while True:
+        rows = await run_in_threadpool(pending_text_extractions, last_id)
+        if not rows:
+            return extracted
+        
+        done = set()
+        for row_id, piece_id, key, mime_type, sha256, content_encoding in rows:
+            last_id = row_id
+            # Identical contents are extracted once
+            if sha256 and sha256 in done:
+                continue
+            try:
+                await extract_piece_text(piece_id, key, mime_type, sha256, content_encoding)
+            except Exception as e:
+                # Typically a file deleted meanwhile
+                logger.warning(f"Text extraction skipped for piece {piece_id}: {e}")
+                continue
+            done.add(sha256)
+            extracted += 1
+
+async def text_extraction_worker():
+    while True:
+        try:
+            extracted = await drain_text_extractions()
+            if extracted:
+                logger.info(f"Text extraction: {extracted} piece(s) indexed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Text extraction worker error: {e}", exc_info=True)
+        
+        text_extraction_wakeup.clear()
+        try:
+            await asyncio.wait_for(text_extraction_wakeup.wait(), timeout=TEXT_EXTRACTION_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+# Storage usage reconciliation: counters are recomputed from the pieces rows if they drifted
+STORAGE_RECONCILE_INTERVAL = 6 * 3600
+
+USER_USAGE_DRIFT = text("""
+    SELECT users.user_id FROM users
+    LEFT JOIN (
+        SELECT user_id, count(*) AS files, sum(file_size) AS bytes FROM pieces GROUP BY user_id
+    ) AS actual ON actual.user_id = users.user_id
+    WHERE (users.storage_files, users.storage_bytes)
+        IS DISTINCT FROM (coalesce(actual.files, 0), coalesce(actual.bytes, 0))
+""")
+
+CONCLUSION_USAGE_DRIFT = text("""
+    SELECT legal_conclusions.conclusion_id FROM legal_conclusions
+    LEFT JOIN (
+        SELECT conclusion_id, count(*) AS files, sum(file_size) AS bytes FROM pieces GROUP BY conclusion_id
+    ) AS actual ON actual.conclusion_id = legal_conclusions.conclusion_id
+    WHERE (legal_conclusions.pieces_files, legal_conclusions.pieces_bytes)
+        IS DISTINCT FROM (coalesce(actual.files, 0), coalesce(actual.bytes, 0))
+""")
+
+def reconcile_storage_usage() -> int:
+    """Fix drifted counters, one row at a time.
+
+    Each row is locked before its pieces are counted: uploads and deletions in flight
+    either committed already or wait for the lock, and then apply their own change.
+    """
+    fixed = 0
+    db = SessionLocal()
+    try:
+        for conclusion_id in db.execute(CONCLUSION_USAGE_DRIFT).scalars().all():
+            conclusion = db.query(LegalConclusionModel).filter(
+                LegalConclusionModel.conclusion_id == conclusion_id
+            ).with_for_update().first()
+            if conclusion:
+                conclusion.pieces_files, conclusion.pieces_bytes = db.query(
+                    func.count(PieceModel.id), func.coalesce(func.sum(PieceModel.file_size), 0)
+                ).filter(PieceModel.conclusion_id == conclusion_id).one()
+                fixed += 1
+            db.commit()
+        
+        for user_id in db.execute(USER_USAGE_DRIFT).scalars().all():
+            user = db.query(UserModel).filter(UserModel.user_id == user_id).with_for_update().first()
+            if user:
+                user.storage_files, user.storage_bytes = db.query(
+                    func.count(PieceModel.id), func.coalesce(func.sum(PieceModel.file_size), 0)
+                ).filter(PieceModel.user_id == user_id).one()
+                fixed += 1
+            db.commit()
+    finally:
+        db.close()
+    return fixed
+
+async def storage_usage_reconciler():
+    while True:
+        try:
+            fixed = await run_in_threadpool(reconcile_storage_usage)
+            if fixed:
+                logger.warning(f"Storage usage: {fixed} drifted counter(s) fixed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Storage usage reconciliation error: {e}", exc_info=True)
+        
+        await asyncio.sleep(STORAGE_RECONCILE_INTERVAL)
+
+# Expired idempotency records are also replaced on demand; this keeps the table small
+IDEMPOTENCY_PURGE_INTERVAL = 600
+
+def purge_idempotency_records() -> int:
+    db = SessionLocal()
+    try:
+        purged = db.execute(
+            delete(IdempotencyRecordModel)
+            .where(IdempotencyRecordModel.expires_at < datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        return purged
+    finally:
+        db.close()
+
+async def idempotency_purger():
+    while True:
+        try:
+            await run_in_threadpool(purge_idempotency_records)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Idempotency purge error: {e}", exc_info=True)
+        
+        await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL)
+
+# Reservations outlive their generation only if the instance died mid-call
+CREDIT_RESERVATION_REAP_INTERVAL = 60
+
+async def credit_reservation_reaper():
+    while True:
+        try:
+            released = await run_in_threadpool(
+                release_credit_reservations, CreditReservationModel.expires_at < datetime.now(timezone.utc)
+            )
+            if released:
+                logger.warning(f"Credit reservations: {released} expired reservation(s) released")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Credit reservation reaper error: {e}", exc_info=True)
+        
+        await asyncio.sleep(CREDIT_RESERVATION_REAP_INTERVAL)
+
+def insert_generation_events(rows: list):
+    db = SessionLocal()
+    try:
+        db.execute(insert(GenerationEventModel), rows)
+        db.commit()
+    finally:
+        db.close()
+
+async def flush_generation_events():
+    while generation_event_buffer:
+        rows = [generation_event_buffer.popleft() for _ in range(min(GENERATION_EVENTS_BATCH, len(generation_event_buffer)))]
+        try:
+            await run_in_threadpool(insert_generation_events, rows)
+        except Exception as e:
+            # Telemetry: not worth holding up the next batches
+            generation_metrics["events_dropped"] += len(rows)
+            logger.error(f"Generation events: {len(rows)} event(s) lost: {e}", exc_info=True)
+            return
+
+async def generation_event_writer():
+    try:
+        while True:
+            await asyncio.sleep(GENERATION_EVENTS_FLUSH_INTERVAL)
+            await flush_generation_events()
+    finally:
+        # Shutdown: write what is left
+        await asyncio.shield(flush_generation_events())
+
+# Generation workers: each runs one job at a time, so GENERATION_WORKERS bounds the
+# LLM calls of an instance; no database session stays open during a call
+def claim_generation_job():
+    """Take the oldest runnable job, or one whose worker died; SKIP LOCKED lets workers and instances share the queue"""
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        
+        # Lost jobs without attempts left fail instead of running again
+        lost = db.execute(
+            update(GenerationJobModel)
+            .where(
+                GenerationJobModel.status == "running",
+                GenerationJobModel.lease_expires_at < now,
+                GenerationJobModel.attempts >= GENERATION_JOB_MAX_ATTEMPTS
+            )
+            .values(status="failed", last_error="Délai de génération dépassé", finished_at=now)
+            .returning(GenerationJobModel.conclusion_id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        if lost:
+            db.execute(
+                update(LegalConclusionModel)
+                .where(LegalConclusionModel.conclusion_id.in_(lost))
+                .values(status="generation_failed", updated_at=now)
+                .execution_options(synchronize_session=False)
+            )
+        
+        # Users with the fewest jobs running go first: a long queue of one user does not hold up the others
+        running = aliased(GenerationJobModel)
+        running_for_user = select(func.count(running.id)).where(
+            running.user_id == GenerationJobModel.user_id, running.status == "running"
+        ).correlate(GenerationJobModel).scalar_subquery()
+        claimed = select(GenerationJobModel.id).where(
+            or_(
+                and_(GenerationJobModel.status == "queued", GenerationJobModel.run_after <= now),
+                and_(GenerationJobModel.status == "running", GenerationJobModel.lease_expires_at < now)
+            ),
+            GenerationJobModel.attempts < GENERATION_JOB_MAX_ATTEMPTS
+        ).order_by(running_for_user, GenerationJobModel.id).limit(1).with_for_update(skip_locked=True)
+        
+        job = db.execute(
+            update(GenerationJobModel)
+            .where(GenerationJobModel.id.in_(claimed.scalar_subquery()))
+            .values(
+                status="running",
+                attempts=GenerationJobModel.attempts + 1,
+                started_at=now,
+                lease_expires_at=now + timedelta(seconds=GENERATION_TIMEOUT + 60)
+            )
+            .returning(
+                GenerationJobModel.job_id, GenerationJobModel.user_id, GenerationJobModel.conclusion_id,
+                GenerationJobModel.request, GenerationJobModel.attempts
+            )
+            .execution_options(synchronize_session=False)
+        ).first()
+        db.commit()
+        return job
+    finally:
+        db.close()
+
+def prepare_generation_job(user_id: str, request: dict) -> tuple:
+    """(api_key, reservation_id, system_prompt, user_prompt, prompt_version); HTTPException when the job cannot run"""
+    db = SessionLocal()
+    try:
+        prompts = build_generation_prompts(db, GenerateConclusionRequest(**request))
+        return reserve_generation(db, user_id) + prompts
+    finally:
+        db.close()
+
+def finish_generation_job(job, status: str, error: Optional[str] = None, retry_at: Optional[datetime] = None) -> bool:
+    """Record the outcome of a run that did not succeed: failed, or queued again at retry_at.
+
+    Successful runs are recorded by complete_streamed_generation. False when the lease
+    expired and another worker claimed the job meanwhile: it is left alone.
+    """
+    db = SessionLocal()
+    try:
+        values = {"status": status, "last_error": error, "lease_expires_at": None}
+        if retry_at:
+            values["run_after"] = retry_at
+        else:
+            values["finished_at"] = datetime.now(timezone.utc)
+        owned = db.execute(
+            update(GenerationJobModel)
+            .where(
+                GenerationJobModel.job_id == job.job_id,
+                GenerationJobModel.status == "running",
+                GenerationJobModel.attempts == job.attempts
+            )
+            .values(**values)
+            .returning(GenerationJobModel.id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        db.commit()
+        return owned is not None
+    finally:
+        db.close()
+
+async def requeue_generation_job(job, error: Optional[str], retry_at: datetime):
+    if await run_in_threadpool(finish_generation_job, job, "queued", error, retry_at):
+        # The next attempt writes the conclusion from the start
+        await run_in_threadpool(save_generated_text, job.conclusion_id, "", "generating")
+
+async def run_generation_job(job):
+    try:
+        api_key, reservation_id, *prompts = await run_in_threadpool(prepare_generation_job, job.user_id, job.request)
+    except HTTPException as e:
+        # No credits or no key: retrying would not help
+        if await run_in_threadpool(finish_generation_job, job, "failed", e.detail):
+            await run_in_threadpool(save_generated_text, job.conclusion_id, "", "generation_failed")
+        return
+    
+    try:
+        # Marks the job succeeded when it commits the conclusion
+        await asyncio.wait_for(
+            generate_into_conclusion(
+                job.conclusion_id, job.user_id, api_key, reservation_id,
+                GenerateConclusionRequest(**job.request), *prompts, kind="job", job=(job.job_id, job.attempts)
+            ),
+            timeout=GENERATION_TIMEOUT
+        )
+    except GenerationJobTakenOver:
+        logger.warning(f"Generation job {job.job_id} was claimed again during attempt {job.attempts}; result dropped")
+        return
+    except asyncio.CancelledError:
+        # Shutdown: hand the job back rather than waiting for its lease to expire
+        await asyncio.shield(requeue_generation_job(job, None, datetime.now(timezone.utc)))
+        raise
+    except Exception as e:
+        error = "Délai de génération dépassé" if isinstance(e, asyncio.TimeoutError) else f"{type(e).__name__}: {e}"[:500]
+        if job.attempts < GENERATION_JOB_MAX_ATTEMPTS:
+            delay = GENERATION_JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            logger.warning(f"Generation job {job.job_id} failed (attempt {job.attempts}), retry in {delay}s: {error}")
+            await requeue_generation_job(job, error, datetime.now(timezone.utc) + timedelta(seconds=delay))
+        else:
+            logger.error(f"Generation job {job.job_id} failed after {job.attempts} attempts: {error}")
+            await run_in_threadpool(finish_generation_job, job, "failed", error)
+
+async def generation_worker():
+    while True:
+        generation_jobs_wakeup.clear()
+        try:
+            job = await run_in_threadpool(claim_generation_job)
+            if job:
+                await run_generation_job(job)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Generation worker error: {e}", exc_info=True)
+        
+        try:
+            await asyncio.wait_for(generation_jobs_wakeup.wait(), timeout=GENERATION_JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+app.include_router(api_router)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Health check endpoint
+@app.get("/api/health")
+async def health_check():
+    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
+
+@app.get("/api/metrics", dependencies=[Depends(require_operator)])
+async def metrics():
+    """Counters of this process since it started"""
+    requests_with_key = generation_metrics["idempotent_requests"]
+    return {
+        "generation": {
+            **generation_metrics,
+            "idempotency_hit_rate": generation_metrics["idempotency_replays"] / requests_with_key if requests_with_key else 0.0,
+            "idempotency_coalescing_rate": generation_metrics["idempotency_coalesced"] / requests_with_key if requests_with_key else 0.0,
+            "prompt_cache_hits": system_prompt_cache.hits,
+            "prompt_cache_misses": system_prompt_cache.misses,
+            "prompt_cache_size": len(system_prompt_cache)
+        },
+        "llm": generation_governor.snapshot(),
+        "db_pool": {
+            "capacity": DB_POOL_SIZE + DB_MAX_OVERFLOW,
+            "checked_out": engine.pool.checkedout()
+        }
+    }
+
+def percentile(p: float, column):
+    return func.percentile_cont(p).within_group(column)
+
+# The report aggregates up to GENERATION_REPORT_MAX_DAYS of events: it is computed in a worker
+# thread, at most once per GENERATION_REPORT_CACHE_SECONDS for each number of days
+GENERATION_REPORT_MAX_DAYS = 90
+GENERATION_REPORT_CACHE_SECONDS = 60
+
+# days -> (loop time computed, report)
+generation_report_cache: Dict[int, tuple] = {}
+generation_report_locks = KeyedLocks()
+
+@app.get("/api/metrics/generations", dependencies=[Depends(require_operator)])
+async def generation_report(days: int = 7):
+    """Generations of the last days per UTC day and conclusion type: outcomes, credits,
+    latency percentiles (of succeeded generations) and token estimates"""
+    days = max(1, min(days, GENERATION_REPORT_MAX_DAYS))
+    loop = asyncio.get_running_loop()
+    # Callers arriving while the report is computed wait for it rather than compute it again
+    async with generation_report_locks.hold(str(days)):
+        cached = generation_report_cache.get(days)
+        if cached and loop.time() - cached[0] < GENERATION_REPORT_CACHE_SECONDS:
+            return cached[1]
+        report = await run_in_threadpool(compute_generation_report, days)
+        generation_report_cache[days] = (loop.time(), report)
+        return report
+
+def compute_generation_report(days: int) -> dict:
+    db = SessionLocal()
+    try:
+        since = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+        event = GenerationEventModel
+        day = func.date(func.timezone("UTC", event.created_at))
+        succeeded = event.outcome == "succeeded"
+
+        rows = db.query(
+            day.label("day"),
+            event.type,
+            func.count(event.id).label("generations"),
+            func.sum(event.credits_charged).label("credits_charged"),
+            func.count(event.id).filter(event.summary_calls > 0).label("summarized"),
+            percentile(0.5, event.duration_seconds).filter(succeeded).label("duration_p50"),
+            percentile(0.95, event.duration_seconds).filter(succeeded).label("duration_p95"),
+            percentile(0.99, event.duration_seconds).filter(succeeded).label("duration_p99"),
+            percentile(0.5, event.queue_seconds).filter(succeeded).label("queue_p50"),
+            percentile(0.95, event.queue_seconds).filter(succeeded).label("queue_p95"),
+            percentile(0.5, event.upstream_seconds).filter(succeeded).label("upstream_p50"),
+            percentile(0.95, event.upstream_seconds).filter(succeeded).label("upstream_p95"),
+            percentile(0.5, event.first_token_seconds).filter(succeeded).label("first_token_p50"),
+            func.avg(event.prompt_tokens).label("prompt_tokens_avg"),
+            func.max(event.prompt_tokens).label("prompt_tokens_max"),
+            func.avg(event.output_tokens).filter(succeeded).label("output_tokens_avg")
+        ).filter(event.created_at >= since).group_by(day, event.type).order_by(day.desc(), event.type).all()
+
+        outcomes = {}
+        for row in db.query(day.label("day"), event.type, event.outcome, func.count(event.id)).filter(
+            event.created_at >= since
+        ).group_by(day, event.type, event.outcome):
+            outcomes.setdefault((row.day, row.type), {})[row.outcome] = row[3]
+
+        report = []
+        for row in rows:
+            entry = {
+                key: round(float(value), 3) if isinstance(value, (float, Decimal)) else value
+                for key, value in row._mapping.items() if key != "day"
+            }
+            report.append({"day": row.day.isoformat(), **entry, "outcomes": outcomes.get((row.day, row.type), {})})
+        return {"days": days, "report": report}
+    finally:
+        db.close()
+
+@app.on_event("startup")
+async def start_background_tasks():
+    background_tasks.append(asyncio.create_task(storage_cleanup_worker()))
+    background_tasks.append(asyncio.create_task(text_extraction_worker()))
+    background_tasks.append(asyncio.create_task(storage_usage_reconciler()))
+    background_tasks.append(asyncio.create_task(idempotency_purger()))
+    background_tasks.append(asyncio.create_task(credit_reservation_reaper()))
+    background_tasks.append(asyncio.create_task(generation_event_writer()))
+    for _ in range(GENERATION_WORKERS):
+        background_tasks.append(asyncio.create_task(generation_worker()))
 
 @app.on_event("shutdown")
 async def shutdown_db():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    render_executor.shutdown(wait=False, cancel_futures=True)
     engine.dispose()
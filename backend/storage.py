@@ -0,0 +1,363 @@
+"""
+Storage backends for uploaded pieces.
+
+A piece is addressed by an opaque key (the ``filename`` column of ``pieces``).
+The local backend keeps files under UPLOADS_DIR and signs its own transfer URLs;
+the S3 backend works with any S3-compatible store (AWS, MinIO, Scaleway...) and
+hands out presigned URLs so that bytes never go through the API server.
+"""
+import hashlib
+import hmac
+import os
+import shutil
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlencode, quote
+
+import aiofiles
+import aiofiles.os
+from starlette.concurrency import run_in_threadpool
+
+# Presigned URLs lifetime (seconds)
+PRESIGNED_URL_EXPIRES = int(os.environ.get('PRESIGNED_URL_EXPIRES', '900'))
+
+# Read size when hashing stored files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class StorageError(Exception):
+    pass
+
+
+class ObjectExistsError(StorageError):
+    pass
+
+
+def shard_key(name: str) -> str:
+    """Two-level hashed layout: ab/cd/name, 65,536 directories holding a few files each"""
+    digest = hashlib.sha256(name.encode()).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}/{name}"
+
+
+def alternate_key(key: str) -> str:
+    """Same object in the other layout: flat keys predate sharding"""
+    if "/" in key:
+        return key.rsplit("/", 1)[1]
+    return shard_key(key)
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PieceStorage(ABC):
+    """Common interface of piece storage backends"""
+
+    name = "base"
+    # True when presigned URLs point to the store itself rather than to the API
+    direct_transfers = False
+
+    @abstractmethod
+    async def write(self, key: str, data: bytes) -> None:
+        ...
+
+    async def write_stream(self, key: str, chunks, max_size: int, exclusive: bool = False) -> int:
+        """Write an async iterable of chunks, refusing anything above max_size.
+
+        exclusive: raise ObjectExistsError rather than replace an existing object
+        """
+        if exclusive and await self.size(key) is not None:
+            raise ObjectExistsError("Fichier déjà téléversé")
+        buffer = bytearray()
+        async for chunk in chunks:
+            buffer += chunk
+            if len(buffer) > max_size:
+                raise StorageError("Le fichier dépasse la taille maximale autorisée")
+        await self.write(key, bytes(buffer))
+        return len(buffer)
+
+    @abstractmethod
+    async def put_file(self, key: str, path: Path) -> None:
+        """Store a file from the local disk; the source file is consumed"""
+        ...
+
+    @abstractmethod
+    async def read(self, key: str) -> bytes:
+        ...
+
+    @abstractmethod
+    def open_read(self, key: str):
+        """Binary file object reading the stored object; blocking, for worker threads"""
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def size(self, key: str) -> Optional[int]:
+        """Size in bytes of the stored object, None if it does not exist"""
+        ...
+
+    @abstractmethod
+    async def sha256(self, key: str) -> str:
+        """Hex SHA-256 of the stored object"""
+        ...
+
+    @abstractmethod
+    def presign_upload(self, key: str, content_type: str, max_size: int, expires_in: int = PRESIGNED_URL_EXPIRES) -> dict:
+        """Return {"method", "url", "fields", "headers"} describing how the client uploads the object"""
+        ...
+
+    @abstractmethod
+    def presign_download(self, key: str, filename: str, content_type: str, expires_in: int = PRESIGNED_URL_EXPIRES,
+                         content_encoding: Optional[str] = None) -> str:
+        """URL serving the object; content_encoding is the codec of compressed pieces"""
+        ...
+
+
+class LocalPieceStorage(PieceStorage):
+    """Files on the local disk, transfer URLs signed with HMAC and served by /api/storage"""
+
+    name = "local"
+
+    def __init__(self, root: Path, secret: str, url_prefix: str = "/api/storage"):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.root = self.root.resolve()
+        self.secret = secret.encode()
+        self.url_prefix = url_prefix
+
+    def key_path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root not in path.parents:
+            raise StorageError(f"Clé de stockage invalide: {key}")
+        return path
+
+    def path(self, key: str) -> Path:
+        """Location of the object, in whichever layout it currently is.
+
+        While files are being moved to the sharded layout, a row may still hold the
+        flat key of a file that has already moved (or the reverse).
+        """
+        path = self.key_path(key)
+        if not path.exists():
+            alternate = self.key_path(alternate_key(key))
+            if alternate.exists():
+                return alternate
+        return path
+
+    async def write(self, key: str, data: bytes) -> None:
+        path = self.key_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        async with aiofiles.open(path, 'wb') as f:
+            await f.write(data)
+
+    async def write_stream(self, key: str, chunks, max_size: int, exclusive: bool = False) -> int:
+        path = self.key_path(key)
+        if exclusive and self.path(key).exists():
+            raise ObjectExistsError("Fichier déjà téléversé")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Own temporary name: concurrent writes of a key do not mix their bytes
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.part")
+        written = 0
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                async for chunk in chunks:
+                    written += len(chunk)
+                    if written > max_size:
+                        raise StorageError("Le fichier dépasse la taille maximale autorisée")
+                    await f.write(chunk)
+            if exclusive:
+                # link() fails if the key was created meanwhile, where replace() would overwrite it
+                try:
+                    await aiofiles.os.link(tmp_path, path)
+                except FileExistsError:
+                    raise ObjectExistsError("Fichier déjà téléversé")
+            else:
+                await aiofiles.os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return written
+
+    async def put_file(self, key: str, path: Path) -> None:
+        target = self.key_path(key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        await run_in_threadpool(shutil.move, str(path), str(target))
+
+    async def read(self, key: str) -> bytes:
+        async with aiofiles.open(self.path(key), 'rb') as f:
+            return await f.read()
+
+    def open_read(self, key: str):
+        return open(self.path(key), 'rb')
+
+    async def delete(self, key: str) -> None:
+        try:
+            await aiofiles.os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    async def size(self, key: str) -> Optional[int]:
+        try:
+            return (await aiofiles.os.stat(self.path(key))).st_size
+        except FileNotFoundError:
+            return None
+
+    async def sha256(self, key: str) -> str:
+        return await run_in_threadpool(file_sha256, self.path(key))
+
+    def sign(self, op: str, key: str, expires: int, *extra: str) -> str:
+        message = "\n".join([op, key, str(expires), *extra]).encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def verify(self, op: str, key: str, expires: int, signature: str, *extra: str) -> bool:
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self.sign(op, key, expires, *extra), signature)
+
+    def presign_upload(self, key, content_type, max_size, expires_in=PRESIGNED_URL_EXPIRES):
+        expires = int(time.time()) + expires_in
+        params = {
+            "expires": expires,
+            "max_size": max_size,
+            "sig": self.sign("put", key, expires, str(max_size)),
+        }
+        return {
+            "method": "PUT",
+            "url": f"{self.url_prefix}/{quote(key)}?{urlencode(params)}",
+            "fields": {},
+            "headers": {"Content-Type": content_type},
+        }
+
+    def presign_download(self, key, filename, content_type, expires_in=PRESIGNED_URL_EXPIRES, content_encoding=None):
+        expires = int(time.time()) + expires_in
+        signed = (filename, content_type, content_encoding) if content_encoding else (filename, content_type)
+        params = {
+            "expires": expires,
+            "filename": filename,
+            "content_type": content_type,
+            "sig": self.sign("get", key, expires, *signed),
+        }
+        # The download endpoint decompresses for clients that do not accept the encoding
+        if content_encoding:
+            params["content_encoding"] = content_encoding
+        return f"{self.url_prefix}/{quote(key)}?{urlencode(params)}"
+
+
+class S3PieceStorage(PieceStorage):
+    """Objects in an S3-compatible bucket, transfers go straight to the bucket"""
+
+    name = "s3"
+    direct_transfers = True
+
+    def __init__(self, bucket: str, prefix: str = "pieces/", client=None, **client_kwargs):
+        if client is None:
+            import boto3
+            client = boto3.client("s3", **client_kwargs)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    async def write(self, key: str, data: bytes) -> None:
+        await run_in_threadpool(
+            self.client.put_object, Bucket=self.bucket, Key=self.object_key(key), Body=data
+        )
+
+    async def put_file(self, key: str, path: Path) -> None:
+        # upload_file switches to multipart uploads for large files
+        await run_in_threadpool(self.client.upload_file, str(path), self.bucket, self.object_key(key))
+        os.remove(path)
+
+    async def read(self, key: str) -> bytes:
+        response = await run_in_threadpool(
+            self.client.get_object, Bucket=self.bucket, Key=self.object_key(key)
+        )
+        return await run_in_threadpool(response["Body"].read)
+
+    def open_read(self, key: str):
+        return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))["Body"]
+
+    async def delete(self, key: str) -> None:
+        await run_in_threadpool(
+            self.client.delete_object, Bucket=self.bucket, Key=self.object_key(key)
+        )
+
+    async def size(self, key: str) -> Optional[int]:
+        from botocore.exceptions import ClientError
+        try:
+            head = await run_in_threadpool(
+                self.client.head_object, Bucket=self.bucket, Key=self.object_key(key)
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return head["ContentLength"]
+
+    async def sha256(self, key: str) -> str:
+        def digest():
+            body = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))["Body"]
+            h = hashlib.sha256()
+            for chunk in body.iter_chunks(HASH_CHUNK_SIZE):
+                h.update(chunk)
+            return h.hexdigest()
+        return await run_in_threadpool(digest)
+
+    def presign_upload(self, key, content_type, max_size, expires_in=PRESIGNED_URL_EXPIRES):
+        # Presigned POST lets the bucket itself enforce the size limit
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=self.object_key(key),
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                {"Content-Type": content_type},
+                ["content-length-range", 0, max_size],
+            ],
+            ExpiresIn=expires_in,
+        )
+        return {"method": "POST", "url": post["url"], "fields": post["fields"], "headers": {}}
+
+    def presign_download(self, key, filename, content_type, expires_in=PRESIGNED_URL_EXPIRES, content_encoding=None):
+        params = {
+            "Bucket": self.bucket,
+            "Key": self.object_key(key),
+            "ResponseContentType": content_type,
+            "ResponseContentDisposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+        }
+        # Compressed pieces are stored as such: the client decodes them
+        if content_encoding:
+            params["ResponseContentEncoding"] = content_encoding
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=expires_in)
+
+
+def build_storage(uploads_dir: Path, secret: str) -> PieceStorage:
+    """Instantiate the backend selected by STORAGE_BACKEND (local or s3)"""
+    backend = os.environ.get('STORAGE_BACKEND', 'local').lower()
+
+    if backend == "local":
+        return LocalPieceStorage(uploads_dir, secret)
+
+    if backend == "s3":
+        bucket = os.environ.get('S3_BUCKET')
+        if not bucket:
+            raise ValueError("S3_BUCKET environment variable is required when STORAGE_BACKEND=s3")
+        client_kwargs = {}
+        if os.environ.get('S3_ENDPOINT_URL'):
+            client_kwargs["endpoint_url"] = os.environ['S3_ENDPOINT_URL']
+        if os.environ.get('S3_REGION'):
+            client_kwargs["region_name"] = os.environ['S3_REGION']
+        return S3PieceStorage(bucket, prefix=os.environ.get('S3_PREFIX', 'pieces/'), **client_kwargs)
+
+    raise ValueError(f"STORAGE_BACKEND inconnu: {backend}")
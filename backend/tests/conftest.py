@@ -0,0 +1,101 @@
+"""
+Shared setup of the test suites: the backend modules are imported from the parent
+directory, and the suites testing through server.py need the PostgreSQL database of
+DATABASE_URL (server.py refuses to load without it). Those are listed in
+DATABASE_TEST_MODULES and skipped whole when DATABASE_URL is not set: a marker could
+not do it, as pytest only reads markers once the module is imported.
+"""
+import asyncio
+import os
+import sys
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+DATABASE_TEST_MODULES = {
+    "test_credit_reservations.py",
+    "test_gc_uploads.py",
+    "test_generation_events.py",
+    "test_generation_jobs.py",
+    "test_generation_stream.py",
+    "test_idempotency.py",
+    "test_section_rewrite.py",
+    "test_storage_cleanup.py",
+}
+
+
+class DatabaseModule(pytest.Module):
+    """Test module skipped, before it is imported, when DATABASE_URL is not set"""
+
+    def collect(self):
+        if not os.environ.get("DATABASE_URL"):
+            pytest.skip("DATABASE_URL not set")
+        return super().collect()
+
+
+def pytest_pycollect_makemodule(module_path, parent):
+    if module_path.name in DATABASE_TEST_MODULES:
+        return DatabaseModule.from_parent(parent, path=module_path)
+
+
+@pytest.fixture
+def make_account(monkeypatch):
+    """Factory of users with a session: make_account(credits) -> (user_id, headers).
+
+    The users are removed afterwards with their conclusions, jobs, events and reservations.
+    """
+    import server
+    monkeypatch.setenv("EMERGENT_LLM_KEY", "test-key")
+    user_ids = []
+
+    def make(credits: int = 1) -> tuple:
+        user_id = f"test-user-{uuid.uuid4().hex[:12]}"
+        token = f"test_session_{uuid.uuid4().hex}"
+        db = server.SessionLocal()
+        db.add(server.UserModel(user_id=user_id, email=f"{user_id}@example.com", name="Test", credits=credits))
+        db.add(server.UserSessionModel(
+            user_id=user_id, session_token=token, expires_at=datetime.now(timezone.utc) + timedelta(hours=1)
+        ))
+        db.commit()
+        db.close()
+        user_ids.append(user_id)
+        return user_id, {"Authorization": f"Bearer {token}"}
+
+    yield make
+
+    # Buffered generation events would otherwise be written after the cleanup
+    asyncio.run(server.flush_generation_events())
+    db = server.SessionLocal()
+    for model in (server.GenerationEventModel, server.GenerationJobModel, server.IdempotencyRecordModel,
+                  server.CreditReservationModel, server.LegalConclusionModel, server.UserSessionModel,
+                  server.UserModel):
+        db.query(model).filter(model.user_id.in_(user_ids)).delete(synchronize_session=False)
+    db.commit()
+    db.close()
+
+
+@pytest.fixture
+def account(make_account):
+    """A user with one credit and a session"""
+    return make_account(credits=1)
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    """Factory of stand-in models answering llm.complete and llm.stream: fake_llm(**settings) -> FakeLlmClient.
+
+    Unless the settings say otherwise, the short answer comes at once.
+    """
+    import llm
+    from fake_llm import FakeLlmClient
+
+    def use(**settings) -> FakeLlmClient:
+        client = FakeLlmClient(**{"latency": 0, "tokens_per_second": 10000, "output_tokens": 50, **settings})
+        monkeypatch.setattr(llm, "client", client)
+        return client
+
+    return use
@@ -0,0 +1,82 @@
+"""
+Test suite for compression at rest (compression.py)
+Tests: codec round trips, compressibility probe, Accept-Encoding negotiation
+"""
+import os
+
+import pytest
+
+from compression import (
+    Compressor, compress, compress_piece, compress_piece_file, configured_encoding,
+    decompress_file, iter_decompressed, accepts_encoding, zstandard
+)
+
+ENCODINGS = ["gzip"] + (["zstd"] if zstandard else [])
+TEXT = "Attestation de témoin, fait à Lyon le 3 mars 2023.\n".encode() * 2000
+
+
+class TestCompression:
+    """Test codecs and the compressibility probe"""
+
+    @pytest.mark.parametrize("encoding", ENCODINGS)
+    def test_streamed_round_trip(self, tmp_path, encoding):
+        """Chunked compression reads back to the original bytes"""
+        compressor = Compressor(encoding)
+        stored = tmp_path / "piece.bin"
+        with open(stored, "wb") as f:
+            for start in range(0, len(TEXT), 10_000):
+                f.write(compressor.compress(TEXT[start:start + 10_000]))
+            f.write(compressor.flush())
+
+        assert stored.stat().st_size < len(TEXT) / 5
+        assert b"".join(iter_decompressed(stored, encoding, read_size=1000)) == TEXT
+        # Remote objects are read from a file object rather than a path
+        with open(stored, "rb") as f:
+            assert b"".join(iter_decompressed(f, encoding, read_size=1000)) == TEXT
+        print(f"✅ {encoding} round trip verified")
+
+    def test_probe_skips_incompressible(self):
+        """Random bytes and already compressed types are stored as uploaded"""
+        encoding, stored = compress_piece(os.urandom(100_000), "application/pdf", "gzip")
+        assert encoding is None and len(stored) == 100_000
+        assert compress_piece(TEXT, "image/jpeg", "gzip")[0] is None
+        # PDFs keep Range support
+        assert compress_piece(TEXT, "application/pdf", "gzip")[0] is None
+        assert compress_piece(TEXT, "text/plain", None)[0] is None
+
+        encoding, stored = compress_piece(TEXT, "text/plain", "gzip")
+        assert encoding == "gzip" and stored == compress(TEXT, "gzip")
+        print("✅ Compressibility probe verified")
+
+    def test_compress_file(self, tmp_path):
+        """Large files are compressed from disk"""
+        source, target, restored = tmp_path / "a.txt", tmp_path / "a.gz", tmp_path / "b.txt"
+        source.write_bytes(TEXT)
+
+        assert compress_piece_file(source, target, "text/plain", "gzip") == "gzip"
+        decompress_file(target, restored, "gzip")
+        assert restored.read_bytes() == TEXT
+        print("✅ File compression verified")
+
+    def test_configured_encoding(self):
+        """PIECE_COMPRESSION values"""
+        assert configured_encoding("off") is None
+        assert configured_encoding("gzip") == "gzip"
+        assert configured_encoding("auto") == ("zstd" if zstandard else "gzip")
+        with pytest.raises(ValueError):
+            configured_encoding("brotli")
+        print("✅ Configuration verified")
+
+    def test_accepts_encoding(self):
+        """Accept-Encoding negotiation honours q=0 and wildcards"""
+        assert accepts_encoding("gzip, deflate, br", "gzip")
+        assert accepts_encoding("br;q=1.0, zstd;q=0.5", "zstd")
+        assert not accepts_encoding("gzip;q=0, deflate", "gzip")
+        assert accepts_encoding("*", "zstd")
+        assert not accepts_encoding("identity", "gzip")
+        assert not accepts_encoding(None, "gzip")
+        print("✅ Accept-Encoding negotiation verified")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,85 @@
+"""
+Test suite for credit reservations around generation (server.py)
+Tests: parallel generations on a one-credit account, release on failure,
+       release of expired reservations
+Needs the PostgreSQL database of DATABASE_URL; the model is the local stand-in (fake_llm.py),
+and the app runs without its background tasks (no lifespan).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+from fastapi.testclient import TestClient
+
+REQUEST = {"type": "jaf", "parties": {}, "faits": "Test faits", "demandes": "Test demandes"}
+
+
+def credits_and_reservations(user_id: str) -> tuple:
+    db = server.SessionLocal()
+    try:
+        credits = db.query(server.UserModel.credits).filter(server.UserModel.user_id == user_id).scalar()
+        reservations = db.query(server.CreditReservationModel).filter(
+            server.CreditReservationModel.user_id == user_id
+        ).count()
+        return credits, reservations
+    finally:
+        db.close()
+
+
+class TestCreditReservations:
+    """Test that a credit pays for exactly one generation"""
+
+    def test_parallel_generations_one_credit(self, account, fake_llm):
+        """Of 10 simultaneous generations on a one-credit account, only one runs"""
+        user_id, headers = account
+        model = fake_llm(latency=0.5)
+
+        client = TestClient(server.app)
+        with ThreadPoolExecutor(10) as pool:
+            responses = list(pool.map(
+                lambda _: client.post("/api/generate/conclusion", json=REQUEST, headers=headers), range(10)
+            ))
+
+        statuses = sorted(response.status_code for response in responses)
+        assert statuses == [200] + [403] * 9, statuses
+        assert model.calls == 1
+        assert credits_and_reservations(user_id) == (0, 0)
+        print("✅ One credit, one generation")
+
+    def test_failure_releases_credit(self, account, fake_llm):
+        """A failed LLM call gives the reserved credit back"""
+        user_id, headers = account
+        fake_llm(failure_rate=1.0)
+
+        client = TestClient(server.app, raise_server_exceptions=False)
+        response = client.post("/api/generate/conclusion", json=REQUEST, headers=headers)
+
+        assert response.status_code == 500
+        assert credits_and_reservations(user_id) == (1, 0)
+        print("✅ Credit released after a failure")
+
+    def test_expired_reservation_released(self, account):
+        """The reaper gives back credits of reservations whose generation never finished"""
+        user_id, _ = account
+        db = server.SessionLocal()
+        reservation_id = server.reserve_credit(db, user_id)
+        db.close()
+        assert credits_and_reservations(user_id) == (0, 1)
+
+        # As if the TTL had passed
+        released = server.release_credit_reservations(server.and_(
+            server.CreditReservationModel.user_id == user_id,
+            server.CreditReservationModel.expires_at < datetime.now(timezone.utc) + timedelta(days=1)
+        ))
+        assert released == 1
+        assert credits_and_reservations(user_id) == (1, 0)
+        # Already released: a late release or commit does not give the credit twice
+        assert not server.release_credit_reservation(reservation_id)
+        assert credits_and_reservations(user_id) == (1, 0)
+        print("✅ Expired reservation released once")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
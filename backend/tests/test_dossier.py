@@ -0,0 +1,91 @@
+"""
+Test suite for dossier rendering (dossier.py)
+Tests: bordereau de pièces, merged PDF and image pieces, page stamps
+"""
+import io
+
+import pytest
+from PIL import Image
+from pypdf import PdfReader
+from reportlab.pdfgen import canvas
+
+from dossier import render_dossier
+
+
+def make_piece(tmp_path, numero, filename, mime_type, content):
+    path = tmp_path / filename
+    path.write_bytes(content)
+    return {
+        "numero": numero,
+        "nom": f"Pièce {numero}",
+        "description": "",
+        "original_filename": filename,
+        "file_size": len(content),
+        "mime_type": mime_type,
+        "sha256": None,
+        "path": str(path),
+    }
+
+
+@pytest.fixture
+def pieces(tmp_path):
+    pdf = io.BytesIO()
+    p = canvas.Canvas(pdf)
+    p.drawString(100, 700, "Premiere page")
+    p.showPage()
+    p.drawString(100, 700, "Seconde page")
+    p.save()
+
+    png = io.BytesIO()
+    Image.new("RGB", (400, 300), "blue").save(png, "PNG")
+
+    return [
+        make_piece(tmp_path, 1, "contrat.pdf", "application/pdf", pdf.getvalue()),
+        make_piece(tmp_path, 2, "photo.png", "image/png", png.getvalue()),
+        make_piece(tmp_path, 3, "notes.txt", "text/plain", b"texte brut"),
+    ]
+
+
+class TestRenderDossier:
+    """Test merged dossier output"""
+
+    def test_merges_and_stamps_pieces(self, tmp_path, pieces):
+        """PDF and image pieces are appended and stamped, others only listed"""
+        output = tmp_path / "dossier.pdf"
+        render_dossier(str(output), {"type": "jaf", "conclusion_text": "Plaise au tribunal"}, pieces)
+
+        reader = PdfReader(str(output))
+        texts = [page.extract_text() for page in reader.pages]
+        # conclusion + bordereau + 2 PDF pages + 1 image page
+        assert len(texts) == 5
+        assert "Plaise au tribunal" in texts[0]
+        assert "BORDEREAU" in texts[1] and "non jointe" in texts[1]
+        assert "Pièce n° 1 - 1/2" in texts[2] and "Premiere page" in texts[2]
+        assert "Pièce n° 1 - 2/2" in texts[3]
+        assert "Pièce n° 2 - 1/1" in texts[4]
+        print("✅ Dossier merged and stamped")
+
+    def test_bordereau_lists_hashes(self, tmp_path, pieces):
+        """Missing hashes are computed from the files"""
+        output = tmp_path / "dossier.pdf"
+        render_dossier(str(output), {"type": "jaf", "conclusion_text": ""}, pieces)
+
+        bordereau = PdfReader(str(output)).pages[1].extract_text()
+        for piece in pieces:
+            assert piece["sha256"] in bordereau
+        print("✅ Bordereau lists SHA-256 of every piece")
+
+    def test_unreadable_pdf_gets_placeholder(self, tmp_path):
+        """A corrupt PDF does not abort the dossier"""
+        output = tmp_path / "dossier.pdf"
+        broken = make_piece(tmp_path, 1, "broken.pdf", "application/pdf", b"%PDF-pas un pdf")
+        render_dossier(str(output), {"type": "jaf", "conclusion_text": ""}, [broken])
+
+        texts = [page.extract_text() for page in PdfReader(str(output)).pages]
+        assert len(texts) == 3
+        assert "illisible" in texts[2]
+        print("✅ Unreadable piece replaced by a placeholder page")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,56 @@
+"""
+Test suite for piece text extraction (extraction.py)
+Tests: PDF and plain-text extraction, size limit
+"""
+
+import pytest
+from reportlab.pdfgen import canvas
+
+import extraction
+from extraction import extract_text, is_extractable
+
+
+class TestExtractText:
+    """Test text extraction"""
+
+    def test_pdf_text(self, tmp_path):
+        """Text of every PDF page is extracted"""
+        source = tmp_path / "fiche.pdf"
+        p = canvas.Canvas(str(source))
+        p.drawString(100, 700, "Bulletin de salaire janvier 2023")
+        p.showPage()
+        p.drawString(100, 700, "Net a payer")
+        p.save()
+
+        content = extract_text(str(source), "application/pdf")
+        assert "Bulletin de salaire janvier 2023" in content
+        assert "Net a payer" in content
+        print("✅ PDF text extracted")
+
+    def test_plain_text(self, tmp_path):
+        """Text files are decoded, NUL characters dropped"""
+        source = tmp_path / "attestation.txt"
+        source.write_bytes("Attestation de témoin\x00".encode())
+
+        assert extract_text(str(source), "text/plain") == "Attestation de témoin"
+        print("✅ Plain text extracted")
+
+    def test_truncates_long_text(self, tmp_path, monkeypatch):
+        """Texts are capped to fit in a tsvector"""
+        monkeypatch.setattr(extraction, "MAX_EXTRACTED_CHARS", 10)
+        source = tmp_path / "long.txt"
+        source.write_text("x" * 100)
+
+        assert len(extract_text(str(source), "text/plain")) == 10
+        print("✅ Long text truncated")
+
+    def test_extractable_types(self):
+        """Images are not extracted (no OCR)"""
+        assert is_extractable("application/pdf")
+        assert is_extractable("text/plain")
+        assert not is_extractable("image/png")
+        print("✅ Extractable types verified")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
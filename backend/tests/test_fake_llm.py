@@ -0,0 +1,68 @@
+"""
+Test suite for the local stand-in model (fake_llm.py)
+Tests: deterministic answers, pacing, failure injection
+"""
+import asyncio
+
+import pytest
+
+from fake_llm import FakeLlmClient, FakeLlmError
+from llm import is_rate_limited
+from prompts import summary_prompt
+
+
+def collect(client: FakeLlmClient, user_prompt: str = "Faits") -> list:
+    async def scenario():
+        return [delta async for delta in client.stream("", "session", "Système", user_prompt, "model")]
+    return asyncio.run(scenario())
+
+
+class TestFakeLlm:
+    """Test the stand-in model"""
+
+    def test_same_prompt_same_answer(self):
+        """Answers depend on the prompt only"""
+        client = FakeLlmClient(latency=0, tokens_per_second=10000, output_tokens=30)
+        first = collect(client)
+        assert len(first) == 30
+        assert collect(client) == first
+        assert collect(client, "Autres faits") != first
+        assert asyncio.run(client.complete("", "s", "Système", "Faits", "model")) == "".join(first)
+        print("✅ Deterministic answers")
+
+    def test_summary_length_asked(self):
+        """Summaries are no longer than the number of words asked"""
+        client = FakeLlmClient(latency=0, tokens_per_second=10000, output_tokens=600)
+        assert len(collect(client, summary_prompt("Récit", 1, 1, 100))) == 75
+        print("✅ Summary length followed")
+
+    def test_latency_and_token_rate(self):
+        """Time to the last token is the latency plus the tokens at the given rate"""
+        client = FakeLlmClient(latency=0.05, tokens_per_second=200, output_tokens=20)
+        loop = asyncio.new_event_loop()
+        started = loop.time()
+        loop.run_until_complete(client.complete("", "s", "Système", "Faits", "model"))
+        elapsed = loop.time() - started
+        loop.close()
+        assert 0.14 <= elapsed < 0.5
+        print("✅ Latency and token rate simulated")
+
+    def test_failure_injection(self):
+        """Injected failures follow the rates, rate limits as HTTP 429"""
+        client = FakeLlmClient(latency=0, tokens_per_second=10000, output_tokens=1,
+                               failure_rate=0.3, rate_limit_rate=0.2, seed=1)
+        errors = []
+        for _ in range(200):
+            try:
+                collect(client)
+            except FakeLlmError as e:
+                errors.append(e)
+        rate_limited = [e for e in errors if is_rate_limited(e)]
+        assert client.calls == 200 and client.failures == len(errors)
+        assert 60 <= len(errors) <= 140
+        assert 20 <= len(rate_limited) <= 60
+        print("✅ Failures injected")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,164 @@
+"""
+Test suite for the storage garbage collector (gc_uploads.py)
+Tests: orphan files, dry run, resuming an interrupted run, expired resumable uploads
+Needs the PostgreSQL database of DATABASE_URL for the piece rows; files live in a
+temporary storage root. The rows pass is not run: it scans every piece of the database.
+"""
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+import pytest
+
+import gc_uploads
+import server
+from storage import LocalPieceStorage, shard_key
+
+# Old enough for the grace period
+OLD = time.time() - 7200
+
+
+@pytest.fixture
+def gc_root(tmp_path, monkeypatch):
+    """gc_uploads pointed at a temporary storage root; piece rows created through add_piece are removed afterwards"""
+    uploads = tmp_path / "pieces"
+    partial = tmp_path / "partial"
+    partial.mkdir()
+    monkeypatch.setattr(gc_uploads, "UPLOADS_DIR", uploads)
+    monkeypatch.setattr(gc_uploads, "PARTIAL_UPLOADS_DIR", partial)
+    monkeypatch.setattr(gc_uploads, "STATE_PATH", tmp_path / "gc_state.json")
+    monkeypatch.setattr(gc_uploads, "storage", LocalPieceStorage(uploads, secret="test-secret"))
+    conclusion_id = f"test-gc-{uuid.uuid4().hex[:8]}"
+
+    def write_file(name: str, content: bytes = b"contenu", mtime: float = OLD) -> str:
+        key = shard_key(name)
+        path = uploads / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        os.utime(path, (mtime, mtime))
+        return key
+
+    def add_piece(key: str):
+        db = server.SessionLocal()
+        numero = db.query(server.PieceModel).filter(server.PieceModel.conclusion_id == conclusion_id).count() + 1
+        db.add(server.PieceModel(
+            piece_id=f"piece_{uuid.uuid4().hex[:12]}", conclusion_id=conclusion_id, user_id="test-user-gc",
+            numero=numero, position=numero * server.PIECE_POSITION_GAP, nom="Pièce", filename=key,
+            original_filename="piece.pdf", file_size=7, mime_type="application/pdf"
+        ))
+        db.commit()
+        db.close()
+
+    yield uploads, partial, write_file, add_piece
+
+    db = server.SessionLocal()
+    db.query(server.PieceModel).filter(server.PieceModel.conclusion_id == conclusion_id).delete()
+    db.commit()
+    db.close()
+
+
+def new_state() -> dict:
+    return gc_uploads.load_state(resume=False)
+
+
+class TestGcUploads:
+    """Test the garbage collection passes"""
+
+    def test_orphan_files_removed(self, gc_root):
+        """Files without a row are removed, unless recent or still being written"""
+        uploads, _, write_file, add_piece = gc_root
+        known = write_file("concl_a_1.pdf")
+        add_piece(known)
+        orphan = write_file("concl_a_2.pdf")
+        recent = write_file("concl_a_3.pdf", mtime=time.time())
+        partial = write_file("concl_a_4.pdf.1234abcd.part")
+
+        state = new_state()
+        gc_uploads.collect_orphan_files(state, batch_size=100, grace_seconds=3600, dry_run=False)
+
+        assert state["report"] == {"orphan_files": 1, "orphan_bytes": 7}
+        assert not (uploads / orphan).exists()
+        assert all((uploads / key).exists() for key in (known, recent, partial))
+        print("✅ Orphan files removed")
+
+    def test_dry_run_changes_nothing(self, gc_root):
+        """A dry run reports orphans and expired uploads without touching them or saving progress"""
+        uploads, partial, write_file, _ = gc_root
+        orphan = write_file("concl_b_1.pdf")
+        expired = write_upload(partial, expires_in=timedelta(hours=-1))
+
+        state = new_state()
+        gc_uploads.collect_orphan_files(state, batch_size=100, grace_seconds=3600, dry_run=True)
+        gc_uploads.collect_expired_partial_uploads(state, dry_run=True)
+
+        assert state["report"] == {"orphan_files": 1, "orphan_bytes": 7, "expired_uploads": 1}
+        assert (uploads / orphan).exists()
+        assert (partial / f"{expired}.json").exists() and (partial / f"{expired}.part").exists()
+        assert not gc_uploads.STATE_PATH.exists()
+        print("✅ Dry run reports without changes")
+
+    def test_resume_after_interruption(self, gc_root, monkeypatch):
+        """An interrupted run continues where it stopped, without skipping unchecked files"""
+        uploads, _, write_file, add_piece = gc_root
+        orphans = []
+        for i in range(6):
+            key = write_file(f"concl_c_{i}.pdf")
+            if i % 2:
+                add_piece(key)
+            else:
+                orphans.append(key)
+
+        save_state = gc_uploads.save_state
+
+        def interrupted(state):
+            save_state(state)
+            raise KeyboardInterrupt
+        monkeypatch.setattr(gc_uploads, "save_state", interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            gc_uploads.collect_orphan_files(new_state(), batch_size=2, grace_seconds=3600, dry_run=False)
+        monkeypatch.setattr(gc_uploads, "save_state", save_state)
+
+        state = gc_uploads.load_state(resume=True)
+        assert state["files_seen"] <= 2
+        gc_uploads.collect_orphan_files(state, batch_size=2, grace_seconds=3600, dry_run=False)
+
+        assert state["report"]["orphan_files"] == len(orphans)
+        assert not any((uploads / key).exists() for key in orphans)
+        assert sum(1 for _ in gc_uploads.walk_files(str(uploads))) == 3
+        print("✅ Interrupted run resumed")
+
+    def test_expired_resumable_uploads(self, gc_root):
+        """Expired sessions are removed; finalized ones are kept a TTL longer"""
+        _, partial, _, _ = gc_root
+        expired = write_upload(partial, expires_in=timedelta(hours=-1))
+        active = write_upload(partial, expires_in=timedelta(hours=1))
+        finalized = write_upload(partial, expires_in=timedelta(hours=-1), piece_id="piece_x")
+        finalized_long_ago = write_upload(
+            partial, expires_in=-server.RESUMABLE_UPLOAD_TTL - timedelta(hours=1), piece_id="piece_y"
+        )
+
+        state = new_state()
+        gc_uploads.collect_expired_partial_uploads(state, dry_run=False)
+
+        assert state["report"] == {"expired_uploads": 2}
+        remaining = {path.stem for path in partial.iterdir()}
+        assert remaining == {active, finalized}
+        assert expired not in remaining and finalized_long_ago not in remaining
+        print("✅ Expired resumable uploads removed")
+
+
+def write_upload(partial: Path, expires_in: timedelta, piece_id: str = None) -> str:
+    upload_id = uuid.uuid4().hex
+    meta = {"upload_id": upload_id, "expires_at": (datetime.now(timezone.utc) + expires_in).isoformat()}
+    if piece_id:
+        meta["piece_id"] = piece_id
+    (partial / f"{upload_id}.json").write_text(json.dumps(meta))
+    (partial / f"{upload_id}.part").write_bytes(b"debut")
+    return upload_id
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,116 @@
+"""
+Test suite for generation events and their report (server.py)
+Tests: one event per generation with its outcome, credit effect and prompt type,
+       report per day and type, kept to operators and cached
+Needs the PostgreSQL database of DATABASE_URL; the model is the local stand-in (fake_llm.py),
+and the app runs without its background tasks (no lifespan): events are flushed by hand.
+"""
+import asyncio
+
+import pytest
+
+import server
+from fastapi.testclient import TestClient
+
+REQUEST = {"type": "penal", "parties": {}, "faits": "Test faits", "demandes": "Test demandes"}
+
+
+def events_of(user_id: str) -> list:
+    asyncio.run(server.flush_generation_events())
+    db = server.SessionLocal()
+    try:
+        return db.query(server.GenerationEventModel).filter(
+            server.GenerationEventModel.user_id == user_id
+        ).order_by(server.GenerationEventModel.id).all()
+    finally:
+        db.close()
+
+
+class TestGenerationEvents:
+    """Test the events written for each generation"""
+
+    def test_success_and_failure_recorded(self, make_account, fake_llm):
+        """A generation and a failed one each leave an event, with what they cost"""
+        user_id, headers = make_account(credits=2)
+        model = fake_llm()
+
+        client = TestClient(server.app, raise_server_exceptions=False)
+        assert client.post("/api/generate/conclusion", json=REQUEST, headers=headers).status_code == 200
+        model.failure_rate = 1.0
+        assert client.post("/api/generate/conclusion", json=REQUEST, headers=headers).status_code == 500
+
+        succeeded, failed = events_of(user_id)
+        assert (succeeded.kind, succeeded.type, succeeded.outcome, succeeded.credits_charged) == (
+            "conclusion", "penal", "succeeded", 1
+        )
+        assert succeeded.prompt_tokens > 0 and succeeded.output_tokens > 0
+        assert succeeded.upstream_seconds is not None and succeeded.model
+        assert (failed.outcome, failed.credits_charged) == ("failed", 0)
+        assert "fake failure" in failed.error
+        print("✅ Success and failure recorded")
+
+    def test_type_recorded_as_prompt_type(self, account, fake_llm):
+        """Any type sent is recorded as the prompt family it was generated with"""
+        user_id, headers = account
+        fake_llm()
+
+        response = TestClient(server.app).post(
+            "/api/generate/conclusion", json={**REQUEST, "type": "x" * 80}, headers=headers
+        )
+        assert response.status_code == 200
+        [event] = events_of(user_id)
+        assert event.type == "penal"
+        print("✅ Type recorded as prompt type")
+
+    def test_report(self, account, fake_llm, monkeypatch):
+        """The report counts the generations of the day with their outcomes; operators only"""
+        user_id, headers = account
+        fake_llm()
+        monkeypatch.setattr(server, "METRICS_TOKEN", "metrics-secret")
+        monkeypatch.setattr(server, "generation_report_cache", {})
+        operator = {"X-Metrics-Token": "metrics-secret"}
+
+        client = TestClient(server.app)
+        assert client.get("/api/metrics/generations", headers=headers).status_code == 403
+        asyncio.run(server.flush_generation_events())
+        before = server.compute_generation_report(1)["report"]
+        assert client.post("/api/generate/conclusion", json=REQUEST, headers=headers).status_code == 200
+        events_of(user_id)
+
+        response = client.get("/api/metrics/generations", params={"days": 1}, headers=operator)
+        assert response.status_code == 200
+        [penal] = [row for row in response.json()["report"] if row["type"] == "penal"]
+        [previous] = [row for row in before if row["type"] == "penal"] or [{"generations": 0, "outcomes": {}}]
+        assert penal["generations"] == previous["generations"] + 1
+        assert penal["outcomes"]["succeeded"] == previous["outcomes"].get("succeeded", 0) + 1
+        assert penal["duration_p50"] is not None
+        print("✅ Report per day and type")
+
+    def test_report_cached(self, account, fake_llm, monkeypatch):
+        """The report is computed once per GENERATION_REPORT_CACHE_SECONDS"""
+        _, headers = account
+        fake_llm()
+        monkeypatch.setattr(server, "METRICS_TOKEN", "metrics-secret")
+        monkeypatch.setattr(server, "generation_report_cache", {})
+        computed = []
+        compute = server.compute_generation_report
+        monkeypatch.setattr(server, "compute_generation_report", lambda days: computed.append(days) or compute(days))
+        client = TestClient(server.app)
+
+        def report():
+            return client.get("/api/metrics/generations", params={"days": 1}, headers={"X-Metrics-Token": "metrics-secret"})
+
+        first = report()
+        assert client.post("/api/generate/conclusion", json=REQUEST, headers=headers).status_code == 200
+        asyncio.run(server.flush_generation_events())
+        second = report()
+        assert second.json() == first.json() and computed == [1]
+
+        monkeypatch.setattr(server, "GENERATION_REPORT_CACHE_SECONDS", 0)
+        report()
+        assert computed == [1, 1]
+        print("✅ Report cached")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,186 @@
+"""
+Test suite for queued generation jobs (server.py)
+Tests: POST/GET /api/generate/jobs, claiming, retry with backoff,
+       lease expiry, no second charge for a job taken over
+Needs the PostgreSQL database of DATABASE_URL, with no runnable job of other users:
+claim_generation_job takes the oldest one of the whole queue. The LLM stream is
+replaced by a fake, and jobs are claimed and run by hand (no lifespan, no workers).
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import llm
+import server
+from fastapi.testclient import TestClient
+
+REQUEST = {"type": "jaf", "parties": {}, "faits": "Test faits", "demandes": "Test demandes"}
+
+
+@pytest.fixture(autouse=True)
+def empty_queue():
+    db = server.SessionLocal()
+    try:
+        runnable = db.query(server.GenerationJobModel).filter(
+            server.GenerationJobModel.status.in_(["queued", "running"])
+        ).count()
+    finally:
+        db.close()
+    if runnable:
+        pytest.skip("the generation queue holds jobs of other users")
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    """llm.stream fake; append exceptions to make the next calls fail"""
+    failures = []
+
+    async def fake_stream(*args, **kwargs):
+        if failures:
+            raise failures.pop(0)
+        yield "Conclusion "
+        yield "générée"
+    monkeypatch.setattr(llm, "stream", fake_stream)
+    return failures
+
+
+def submit(headers: dict) -> dict:
+    response = TestClient(server.app).post("/api/generate/jobs", json=REQUEST, headers=headers)
+    assert response.status_code == 202
+    return response.json()
+
+
+def job_row(job_id: str):
+    db = server.SessionLocal()
+    try:
+        return db.query(server.GenerationJobModel).filter(server.GenerationJobModel.job_id == job_id).one()
+    finally:
+        db.close()
+
+
+def set_job(job_id: str, **values):
+    db = server.SessionLocal()
+    db.query(server.GenerationJobModel).filter(server.GenerationJobModel.job_id == job_id).update(values)
+    db.commit()
+    db.close()
+
+
+def user_state(user_id: str, conclusion_id: str) -> tuple:
+    db = server.SessionLocal()
+    try:
+        credits = db.query(server.UserModel.credits).filter(server.UserModel.user_id == user_id).scalar()
+        conclusion = db.query(server.LegalConclusionModel).filter(
+            server.LegalConclusionModel.conclusion_id == conclusion_id
+        ).one()
+        reservations = db.query(server.CreditReservationModel).filter(
+            server.CreditReservationModel.user_id == user_id
+        ).count()
+        return credits, conclusion.status, conclusion.conclusion_text, reservations
+    finally:
+        db.close()
+
+
+def claim():
+    return server.claim_generation_job()
+
+
+def run(job):
+    asyncio.run(server.run_generation_job(job))
+
+
+class TestGenerationJobs:
+    """Test the generation queue"""
+
+    def test_submit_claim_and_poll(self, make_account, answers):
+        """A submitted job is queued, claimed once, run, then reported with its text"""
+        user_id, headers = make_account(credits=1)
+        submitted = submit(headers)
+        client = TestClient(server.app)
+
+        polled = client.get(f"/api/generate/jobs/{submitted['job_id']}", headers=headers).json()
+        assert (polled["status"], polled["attempts"], polled["queue_position"]) == ("queued", 0, 1)
+
+        job = claim()
+        assert (job.job_id, job.attempts) == (submitted["job_id"], 1)
+        assert claim() is None, "a running job is not claimed twice"
+        run(job)
+
+        polled = client.get(f"/api/generate/jobs/{submitted['job_id']}", headers=headers).json()
+        assert polled["status"] == "succeeded" and polled["conclusion_text"] == "Conclusion générée"
+        assert polled["usage"]["prompt_tokens"] > 0 and polled["finished_at"]
+        assert user_state(user_id, submitted["conclusion_id"]) == (0, "draft", "Conclusion générée", 0)
+        assert client.get("/api/generate/jobs/job_inconnu", headers=headers).status_code == 404
+        print("✅ Job submitted, claimed and polled")
+
+    def test_retry_with_backoff(self, make_account, answers):
+        """Failed attempts are queued again with a doubling delay, then the job fails"""
+        user_id, headers = make_account(credits=1)
+        submitted = submit(headers)
+        answers.extend(RuntimeError("upstream unavailable") for _ in range(server.GENERATION_JOB_MAX_ATTEMPTS))
+
+        for attempt in range(1, server.GENERATION_JOB_MAX_ATTEMPTS):
+            before = datetime.now(timezone.utc)
+            run(claim())
+            row = job_row(submitted["job_id"])
+            assert (row.status, row.attempts) == ("queued", attempt)
+            assert "upstream unavailable" in row.last_error
+            delay = server.GENERATION_JOB_RETRY_DELAY * 2 ** (attempt - 1)
+            assert before + timedelta(seconds=delay) <= row.run_after <= datetime.now(timezone.utc) + timedelta(seconds=delay)
+            # Not runnable before its retry time
+            assert claim() is None
+            assert user_state(user_id, submitted["conclusion_id"]) == (1, "generating", "", 0)
+            set_job(submitted["job_id"], run_after=datetime.now(timezone.utc))
+
+        run(claim())
+        row = job_row(submitted["job_id"])
+        assert (row.status, row.attempts) == ("failed", server.GENERATION_JOB_MAX_ATTEMPTS)
+        assert user_state(user_id, submitted["conclusion_id"])[:2] == (1, "generation_failed")
+        print("✅ Retries with backoff, then failure")
+
+    def test_lease_expiry(self, make_account, answers):
+        """A job whose worker vanished is claimed again, or failed when out of attempts"""
+        _, headers = make_account(credits=1)
+        submitted = submit(headers)
+
+        claim()
+        set_job(submitted["job_id"], lease_expires_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+        job = claim()
+        assert (job.job_id, job.attempts) == (submitted["job_id"], 2)
+
+        set_job(
+            submitted["job_id"], attempts=server.GENERATION_JOB_MAX_ATTEMPTS,
+            lease_expires_at=datetime.now(timezone.utc) - timedelta(seconds=1)
+        )
+        assert claim() is None
+        row = job_row(submitted["job_id"])
+        assert row.status == "failed" and row.finished_at
+        print("✅ Expired leases reclaimed or failed")
+
+    def test_taken_over_job_charged_once(self, make_account, answers):
+        """A run whose lease expired neither writes nor charges; a finished job is never run again"""
+        user_id, headers = make_account(credits=2)
+        submitted = submit(headers)
+
+        stale = claim()
+        set_job(submitted["job_id"], lease_expires_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+        current = claim()
+
+        # The first worker comes back after the job was handed to another one
+        run(stale)
+        row = job_row(submitted["job_id"])
+        assert (row.status, row.attempts) == ("running", 2)
+        assert user_state(user_id, submitted["conclusion_id"]) == (2, "generating", "", 0)
+
+        run(current)
+        assert job_row(submitted["job_id"]).status == "succeeded"
+        assert user_state(user_id, submitted["conclusion_id"]) == (1, "draft", "Conclusion générée", 0)
+
+        # Succeeded with the conclusion: an expired lease no longer makes it runnable
+        set_job(submitted["job_id"], lease_expires_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+        assert claim() is None
+        print("✅ Job taken over charged once")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,197 @@
+"""
+Test suite for streamed generation (server.py)
+Tests: POST /api/generate/conclusion/stream events, saved text and credit,
+       failure mid-stream, retry on the fallback model after a rate limit,
+       authentication connection back in the pool before the endpoint runs
+Needs the PostgreSQL database of DATABASE_URL; the LLM stream is replaced by a fake,
+and the app runs without its background tasks (no lifespan).
+"""
+import json
+
+import pytest
+
+import llm
+import server
+from fastapi.testclient import TestClient
+from governor import LlmGovernor
+
+REQUEST = {"type": "jaf", "parties": {}, "faits": "Test faits", "demandes": "Test demandes"}
+DELTAS = ["Conclusion ", "générée ", "en trois morceaux"]
+
+
+def read_events(response) -> list:
+    """(event, data) pairs of a server-sent events body, keepalive comments left out"""
+    events = []
+    for block in response.text.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def conclusion_state(user_id: str, conclusion_id: str) -> tuple:
+    db = server.SessionLocal()
+    try:
+        conclusion = db.query(server.LegalConclusionModel).filter(
+            server.LegalConclusionModel.conclusion_id == conclusion_id
+        ).one()
+        credits = db.query(server.UserModel.credits).filter(server.UserModel.user_id == user_id).scalar()
+        reservations = db.query(server.CreditReservationModel).filter(
+            server.CreditReservationModel.user_id == user_id
+        ).count()
+        return conclusion.status, conclusion.conclusion_text, credits, reservations
+    finally:
+        db.close()
+
+
+class TestGenerationStream:
+    """Test the server-sent events of a streamed generation"""
+
+    def test_stream_saves_text_and_spends_credit(self, account, monkeypatch):
+        """start, one delta per chunk, then done; the text is saved and the credit spent"""
+        user_id, headers = account
+
+        async def fake_stream(*args, **kwargs):
+            for delta in DELTAS:
+                yield delta
+        monkeypatch.setattr(llm, "stream", fake_stream)
+
+        response = TestClient(server.app).post("/api/generate/conclusion/stream", json=REQUEST, headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+
+        events = read_events(response)
+        assert [event for event, _ in events] == ["start", "delta", "delta", "delta", "done"]
+        conclusion_id = events[0][1]["conclusion_id"]
+        assert [data["text"] for event, data in events if event == "delta"] == DELTAS
+        done = events[-1][1]
+        assert (done["conclusion_id"], done["credits_used"], done["credits_remaining"]) == (conclusion_id, 1, 0)
+
+        assert conclusion_state(user_id, conclusion_id) == ("draft", "".join(DELTAS), 0, 0)
+        print("✅ Streamed generation saved and paid")
+
+    def test_stream_failure_releases_credit(self, account, monkeypatch):
+        """A stream that breaks ends with an error event; the partial text is kept and the credit given back"""
+        user_id, headers = account
+
+        async def broken_stream(*args, **kwargs):
+            yield DELTAS[0]
+            raise RuntimeError("connection reset")
+        monkeypatch.setattr(llm, "stream", broken_stream)
+
+        response = TestClient(server.app).post("/api/generate/conclusion/stream", json=REQUEST, headers=headers)
+        assert response.status_code == 200
+
+        events = read_events(response)
+        assert [event for event, _ in events] == ["start", "delta", "error"]
+        conclusion_id = events[0][1]["conclusion_id"]
+        assert "génération" in events[-1][1]["detail"]
+
+        assert conclusion_state(user_id, conclusion_id) == ("generation_failed", DELTAS[0], 1, 0)
+        print("✅ Failed stream released its credit")
+
+
+class TestConnectionRelease:
+    """Test that a request waiting for the event loop holds no database connection"""
+
+    def test_connection_returned_before_endpoint(self, account, monkeypatch):
+        """The connection used to authenticate is back in the pool when the endpoint body starts"""
+        _, headers = account
+        checked_out = []
+        admit = server.admit_generation
+
+        def recording_admit(user_id: str):
+            checked_out.append(server.engine.pool.checkedout())
+            admit(user_id)
+        monkeypatch.setattr(server, "admit_generation", recording_admit)
+
+        async def fake_stream(*args, **kwargs):
+            yield DELTAS[0]
+        monkeypatch.setattr(llm, "stream", fake_stream)
+
+        before = server.engine.pool.checkedout()
+        response = TestClient(server.app).post("/api/generate/conclusion/stream", json=REQUEST, headers=headers)
+        assert [event for event, _ in read_events(response)][-1] == "done"
+        assert checked_out == [before]
+        print("✅ Authentication gave its connection back")
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+@pytest.fixture
+def governor(monkeypatch):
+    """A fresh governor with a fallback model, so that cool-downs do not outlive the test"""
+    gov = LlmGovernor(
+        [("primary", 2), ("fallback", 2)], max_queue=10, max_queue_per_user=10,
+        is_saturation_error=llm.is_rate_limited
+    )
+    monkeypatch.setattr(server, "generation_governor", gov)
+    return gov
+
+
+class TestRateLimitFallback:
+    """Test that a rate-limited call is sent once to the fallback model"""
+
+    def test_stream_retried_before_any_text(self, account, governor, monkeypatch):
+        """A 429 before the first delta sends the generation to the fallback model"""
+        user_id, headers = account
+        models = []
+
+        async def limited_stream(*args, model, **kwargs):
+            models.append(model)
+            if model == "primary":
+                raise RateLimited("429 Too Many Requests")
+            for delta in DELTAS:
+                yield delta
+        monkeypatch.setattr(llm, "stream", limited_stream)
+
+        response = TestClient(server.app).post("/api/generate/conclusion/stream", json=REQUEST, headers=headers)
+        events = read_events(response)
+        assert [event for event, _ in events][-1] == "done"
+        assert models == ["primary", "fallback"] and governor.saturations == 1
+        assert conclusion_state(user_id, events[0][1]["conclusion_id"])[:3] == ("draft", "".join(DELTAS), 0)
+        print("✅ Rate-limited stream retried on the fallback model")
+
+    def test_stream_not_retried_after_text(self, account, governor, monkeypatch):
+        """Once text was sent, a 429 fails the generation rather than starting over"""
+        user_id, headers = account
+        models = []
+
+        async def limited_stream(*args, model, **kwargs):
+            models.append(model)
+            yield DELTAS[0]
+            raise RateLimited("429 Too Many Requests")
+        monkeypatch.setattr(llm, "stream", limited_stream)
+
+        response = TestClient(server.app).post("/api/generate/conclusion/stream", json=REQUEST, headers=headers)
+        assert [event for event, _ in read_events(response)] == ["start", "delta", "error"]
+        assert models == ["primary"]
+        print("✅ Stream with text not retried")
+
+    def test_complete_retried_once(self, make_account, governor, monkeypatch):
+        """A non-streamed generation is retried once, and fails when no other model is left"""
+        _, headers = make_account(credits=2)
+        models = []
+
+        async def limited_complete(*args, model, **kwargs):
+            models.append(model)
+            if len(models) != 2:
+                raise RateLimited("429 Too Many Requests")
+            return "Conclusion générée"
+        monkeypatch.setattr(llm, "complete", limited_complete)
+
+        client = TestClient(server.app, raise_server_exceptions=False)
+        response = client.post("/api/generate/conclusion", json=REQUEST, headers=headers)
+        assert response.status_code == 200 and response.json()["usage"]["model"] == "primary,fallback"
+        assert models == ["primary", "fallback"]
+
+        # Primary still cooling down: a 429 of the fallback has nowhere else to go
+        assert client.post("/api/generate/conclusion", json=REQUEST, headers=headers).status_code == 500
+        assert models == ["primary", "fallback", "fallback"]
+        print("✅ Completion retried once on the fallback model")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,193 @@
+"""
+Test suite for the LLM concurrency governor (governor.py)
+Tests: concurrency cap, fair queuing between users, queue limits,
+       fallback model, cool-down after rate limits
+"""
+import asyncio
+
+import pytest
+
+from governor import LlmGovernor, Saturated
+
+run = asyncio.run
+
+
+def governor(primary=2, fallback=0, max_queue=10, max_queue_per_user=10, **kwargs) -> LlmGovernor:
+    models = [("primary", primary)] + ([("fallback", fallback)] if fallback else [])
+    return LlmGovernor(models, max_queue=max_queue, max_queue_per_user=max_queue_per_user, **kwargs)
+
+
+class TestConcurrency:
+    """Test the concurrency cap and the queue"""
+
+    def test_cap_respected(self):
+        """No more calls run at once than the cap allows"""
+        async def scenario():
+            gov = governor(primary=3)
+            running, peak = 0, 0
+
+            async def call(user_id):
+                nonlocal running, peak
+                async with gov.slot(user_id):
+                    running += 1
+                    peak = max(peak, running)
+                    await asyncio.sleep(0.01)
+                    running -= 1
+
+            await asyncio.gather(*(call(f"u{i % 4}") for i in range(10)))
+            return gov, peak
+
+        gov, peak = run(scenario())
+        assert peak == 3
+        assert gov.admitted == 10 and gov.queued == 0
+        assert gov.in_flight == {"primary": 0}
+        print("✅ Concurrency cap respected")
+
+    def test_fair_between_users(self):
+        """A user queuing many calls does not pass before the other users' calls"""
+        async def scenario():
+            gov = governor(primary=1)
+            order = []
+            release = asyncio.Event()
+
+            async def call(user_id):
+                async with gov.slot(user_id):
+                    order.append(user_id)
+                    await release.wait()
+
+            blocker = asyncio.create_task(call("first"))
+            await asyncio.sleep(0)
+            heavy = [asyncio.create_task(call("heavy")) for _ in range(4)]
+            await asyncio.sleep(0)
+            light = [asyncio.create_task(call("light")) for _ in range(2)]
+            await asyncio.sleep(0)
+            assert gov.queued == 6
+            release.set()
+            await asyncio.gather(blocker, *heavy, *light)
+            return order
+
+        assert run(scenario()) == ["first", "heavy", "light", "heavy", "light", "heavy", "heavy"]
+        print("✅ Slots handed out round-robin")
+
+    def test_queue_limits(self):
+        """Beyond the queue limits calls are refused with a Retry-After"""
+        async def scenario():
+            gov = governor(primary=1, max_queue=2, max_queue_per_user=1)
+            release = asyncio.Event()
+
+            async def call(user_id, queue_limit=True):
+                async with gov.slot(user_id, queue_limit):
+                    await release.wait()
+
+            tasks = [asyncio.create_task(call(u)) for u in ("a", "b", "c")]
+            await asyncio.sleep(0)
+            assert gov.queued == 2
+
+            with pytest.raises(Saturated) as per_user:
+                gov.check_admission("b")
+            with pytest.raises(Saturated):
+                async with gov.slot("d"):
+                    pass
+            # Without the limit, the call waits for its turn
+            unlimited = asyncio.create_task(call("d", queue_limit=False))
+            await asyncio.sleep(0)
+            assert gov.queued == 3
+
+            release.set()
+            await asyncio.gather(*tasks, unlimited)
+            return gov, per_user.value
+
+        gov, error = run(scenario())
+        assert error.retry_after >= 1
+        assert gov.rejected == 2 and gov.admitted == 4
+        print("✅ Queue limits enforced")
+
+    def test_cancelled_waiter_leaves_queue(self):
+        """A caller giving up while queued frees its place"""
+        async def scenario():
+            gov = governor(primary=1)
+            release = asyncio.Event()
+
+            async def call(user_id):
+                async with gov.slot(user_id):
+                    await release.wait()
+
+            holder = asyncio.create_task(call("a"))
+            waiter = asyncio.create_task(call("b"))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            queued = gov.queued
+            release.set()
+            await holder
+            return gov, queued
+
+        gov, queued = run(scenario())
+        assert queued == 0 and not gov.turns
+        assert gov.in_flight == {"primary": 0}
+        print("✅ Cancelled waiter removed from the queue")
+
+
+class TestFallback:
+    """Test the fallback model"""
+
+    def test_fallback_when_primary_full(self):
+        """Calls go to the fallback model only while the primary one is full"""
+        async def scenario():
+            gov = governor(primary=1, fallback=1)
+            models = []
+            release = asyncio.Event()
+
+            async def call():
+                async with gov.slot("u") as model:
+                    models.append(model)
+                    await release.wait()
+
+            tasks = [asyncio.create_task(call()) for _ in range(3)]
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(*tasks)
+            return gov, models
+
+        gov, models = run(scenario())
+        assert models[:2] == ["primary", "fallback"]
+        assert gov.fallbacks >= 1
+        print("✅ Fallback model used while the primary is full")
+
+    def test_rate_limit_cools_model_down(self):
+        """After a rate-limit error, the next calls use the fallback model"""
+        async def scenario():
+            gov = governor(primary=2, fallback=1, is_saturation_error=lambda e: "429" in str(e), cooldown=60)
+            with pytest.raises(RuntimeError):
+                async with gov.slot("u") as model:
+                    assert model == "primary"
+                    raise RuntimeError("HTTP 429 Too Many Requests")
+            async with gov.slot("u") as model:
+                return gov, model
+
+        gov, model = run(scenario())
+        assert model == "fallback"
+        assert gov.saturations == 1
+        print("✅ Rate-limited model cooled down")
+
+    def test_can_fall_back(self):
+        """A refused call can go to another model, unless every other one is cooling down"""
+        async def scenario():
+            gov = governor(primary=1, fallback=1, is_saturation_error=lambda e: "429" in str(e), cooldown=60)
+            alone = governor(primary=1, is_saturation_error=lambda e: "429" in str(e), cooldown=60)
+            assert not alone.can_fall_back("primary")
+            assert gov.can_fall_back("primary")
+            for name in ("primary", "fallback"):
+                with pytest.raises(RuntimeError):
+                    async with gov.slot("u") as model:
+                        assert model == name
+                        raise RuntimeError("HTTP 429 Too Many Requests")
+            return gov, gov.can_fall_back("fallback")
+
+        gov, can_fall_back = run(scenario())
+        assert not can_fall_back and gov.saturations == 2
+        print("✅ Fallback possible only to a model not cooling down")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
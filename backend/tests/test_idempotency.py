@@ -0,0 +1,221 @@
+"""
+Test suite for idempotent generation and the metrics access (server.py)
+Tests: parallel requests sharing one Idempotency-Key, replay after completion,
+       same key with another body, cancelled owner, failed and expired requests, /api/metrics guard
+Needs the PostgreSQL database of DATABASE_URL; the LLM call is replaced by a fake,
+and the app runs without its background tasks (no lifespan).
+"""
+import asyncio
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import httpx
+import pytest
+
+import llm
+import server
+from fastapi.testclient import TestClient
+
+REQUEST = {"type": "jaf", "parties": {}, "faits": "Test faits", "demandes": "Test demandes"}
+
+
+@pytest.fixture
+def llm_calls(monkeypatch):
+    """llm.complete fake answering after a pause; the list holds one entry per call"""
+    calls = []
+
+    async def slow_complete(*args, **kwargs):
+        calls.append(1)
+        await asyncio.sleep(0.3)
+        return f"Conclusion générée n°{len(calls)}"
+    monkeypatch.setattr(llm, "complete", slow_complete)
+    return calls
+
+
+def credits_of(user_id: str) -> int:
+    db = server.SessionLocal()
+    try:
+        return db.query(server.UserModel.credits).filter(server.UserModel.user_id == user_id).scalar()
+    finally:
+        db.close()
+
+
+def records_of(user_id: str) -> list:
+    db = server.SessionLocal()
+    try:
+        return db.query(server.IdempotencyRecordModel).filter(
+            server.IdempotencyRecordModel.user_id == user_id
+        ).all()
+    finally:
+        db.close()
+
+
+async def post_together(headers: dict, bodies: list) -> list:
+    """The requests sent at once to the app, on one event loop as in production"""
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(*(
+            client.post("/api/generate/conclusion", json=body, headers=headers) for body in bodies
+        ))
+
+
+class TestIdempotentGeneration:
+    """Test that an Idempotency-Key makes one generation of repeated requests"""
+
+    def test_parallel_requests_one_call(self, make_account, llm_calls):
+        """Simultaneous requests with the same key share one LLM call and one credit"""
+        user_id, headers = make_account(credits=2)
+        headers = {**headers, "Idempotency-Key": f"key-{uuid.uuid4().hex}"}
+
+        responses = asyncio.run(post_together(headers, [REQUEST] * 6))
+
+        assert [r.status_code for r in responses] == [200] * 6
+        assert all(r.json() == responses[0].json() for r in responses)
+        assert len(llm_calls) == 1
+        assert credits_of(user_id) == 1
+        [record] = records_of(user_id)
+        assert record.status == "completed" and record.response == responses[0].json()
+        print("✅ Parallel requests shared one generation")
+
+    def test_parallel_across_instances(self, make_account):
+        """Instances that do not share memory wait for the recorded response instead of producing it again"""
+        user_id, _ = make_account(credits=0)
+        produced = []
+
+        async def produce():
+            produced.append(1)
+            await asyncio.sleep(3 * server.IDEMPOTENCY_POLL_INTERVAL)
+            return {"conclusion_text": "Une seule fois"}
+
+        async def instances():
+            # run_recorded is what each instance runs once its own single-flight missed
+            return await asyncio.gather(*(
+                server.run_recorded(user_id, "key-instances", "0" * 64, produce) for _ in range(4)
+            ))
+
+        assert asyncio.run(instances()) == [{"conclusion_text": "Une seule fois"}] * 4
+        assert len(produced) == 1
+        print("✅ Instances coalesced through the database")
+
+    def test_owner_cancelled(self, make_account):
+        """A request that joined the flight of a cancelled one still gets its answer"""
+        user_id, _ = make_account(credits=0)
+        data = server.GenerateConclusionRequest(**REQUEST)
+        produced = []
+
+        async def produce():
+            produced.append(1)
+            await asyncio.sleep(0.3)
+            return {"conclusion_text": f"Réponse n°{len(produced)}"}
+
+        async def requests():
+            owner = asyncio.create_task(server.run_idempotent(user_id, "key-cancelled", "conclusion", data, produce))
+            await asyncio.sleep(0.05)
+            joiner = asyncio.create_task(server.run_idempotent(user_id, "key-cancelled", "conclusion", data, produce))
+            await asyncio.sleep(0.05)
+            # Client gone, timeout or shutdown
+            owner.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await owner
+            return await joiner
+
+        assert asyncio.run(requests()) == {"conclusion_text": "Réponse n°2"}
+        [record] = records_of(user_id)
+        assert record.status == "completed" and record.response == {"conclusion_text": "Réponse n°2"}
+        print("✅ Joined request answered after its owner was cancelled")
+
+    def test_replay_after_completion(self, make_account, llm_calls):
+        """A repeated request gets the recorded response without a new call or charge"""
+        user_id, headers = make_account(credits=2)
+        headers = {**headers, "Idempotency-Key": f"key-{uuid.uuid4().hex}"}
+        client = TestClient(server.app)
+
+        first = client.post("/api/generate/conclusion", json=REQUEST, headers=headers)
+        replays = server.generation_metrics["idempotency_replays"]
+        second = client.post("/api/generate/conclusion", json=REQUEST, headers=headers)
+
+        assert first.status_code == second.status_code == 200
+        assert second.json() == first.json()
+        assert len(llm_calls) == 1 and credits_of(user_id) == 1
+        assert server.generation_metrics["idempotency_replays"] == replays + 1
+        print("✅ Completed request replayed")
+
+    def test_same_key_other_body(self, make_account, llm_calls):
+        """A key reused with another body is another request, each replayed on its own"""
+        user_id, headers = make_account(credits=2)
+        headers = {**headers, "Idempotency-Key": f"key-{uuid.uuid4().hex}"}
+        other = {**REQUEST, "faits": "Autres faits"}
+        client = TestClient(server.app)
+
+        first = client.post("/api/generate/conclusion", json=REQUEST, headers=headers).json()
+        second = client.post("/api/generate/conclusion", json=other, headers=headers).json()
+        assert first["conclusion_text"] != second["conclusion_text"]
+        assert len(llm_calls) == 2 and credits_of(user_id) == 0
+
+        assert client.post("/api/generate/conclusion", json=other, headers=headers).json() == second
+        assert client.post("/api/generate/conclusion", json=REQUEST, headers=headers).json() == first
+        assert len(llm_calls) == 2 and len(records_of(user_id)) == 2
+        print("✅ Same key with another body kept apart")
+
+    def test_failure_forgotten(self, make_account, monkeypatch):
+        """A failed request leaves no record: the same key can be sent again"""
+        user_id, headers = make_account(credits=1)
+        headers = {**headers, "Idempotency-Key": f"key-{uuid.uuid4().hex}"}
+        answers = iter([RuntimeError("upstream unavailable"), "Conclusion générée"])
+
+        async def complete(*args, **kwargs):
+            answer = next(answers)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        monkeypatch.setattr(llm, "complete", complete)
+
+        client = TestClient(server.app, raise_server_exceptions=False)
+        assert client.post("/api/generate/conclusion", json=REQUEST, headers=headers).status_code == 500
+        assert records_of(user_id) == [] and credits_of(user_id) == 1
+        retried = client.post("/api/generate/conclusion", json=REQUEST, headers=headers)
+        assert retried.status_code == 200 and retried.json()["conclusion_text"] == "Conclusion générée"
+        print("✅ Failed request can be retried")
+
+    def test_claim_expired_record(self, make_account):
+        """A record left in progress by a dead instance is taken over once expired"""
+        user_id, _ = make_account(credits=0)
+        request_hash = "1" * 64
+
+        assert server.claim_idempotency_record(user_id, "key-expired", request_hash) is None
+        assert server.claim_idempotency_record(user_id, "key-expired", request_hash) == {
+            "status": "in_progress", "response": None
+        }
+        db = server.SessionLocal()
+        db.query(server.IdempotencyRecordModel).filter(server.IdempotencyRecordModel.user_id == user_id).update(
+            {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}
+        )
+        db.commit()
+        db.close()
+        assert server.claim_idempotency_record(user_id, "key-expired", request_hash) is None
+        assert len(records_of(user_id)) == 1
+        print("✅ Expired record taken over")
+
+
+class TestMetricsAccess:
+    """Test that the metrics are kept to operators"""
+
+    def test_metrics_guard(self, make_account, monkeypatch):
+        """Anonymous callers, other users and wrong tokens are refused"""
+        monkeypatch.setattr(server, "METRICS_TOKEN", "metrics-secret")
+        user_id, headers = make_account(credits=0)
+        client = TestClient(server.app)
+
+        assert client.get("/api/metrics").status_code == 401
+        assert client.get("/api/metrics", headers=headers).status_code == 403
+        assert client.get("/api/metrics", headers={"X-Metrics-Token": "wrong"}).status_code == 401
+        assert client.get("/api/metrics", headers={"X-Metrics-Token": "metrics-secret"}).status_code == 200
+
+        monkeypatch.setattr(server, "OPERATOR_EMAILS", {f"{user_id}@example.com"})
+        response = client.get("/api/metrics", headers=headers)
+        assert response.status_code == 200 and "generation" in response.json()
+        print("✅ Metrics restricted to operators")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,87 @@
+"""
+Test suite for photo normalization (normalization.py)
+Tests: EXIF orientation, downscaling to the target DPI, metadata removal
+"""
+import io
+
+import pytest
+from PIL import Image
+
+from normalization import normalize_image, is_photo, target_size, register_heif_opener
+
+
+def jpeg_bytes(size, exif=None, mode="RGB") -> bytes:
+    output = io.BytesIO()
+    image = Image.linear_gradient("L").resize(size).convert(mode)
+    image.save(output, "JPEG", quality=95, **({"exif": exif} if exif else {}))
+    return output.getvalue()
+
+
+class TestNormalizeImage:
+    """Test photo normalization"""
+
+    def test_rotates_and_strips_metadata(self):
+        """The EXIF orientation is applied, then EXIF (including GPS) is dropped"""
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotated 90° clockwise
+        exif[0x010F] = "PhoneMaker"
+        exif.get_ifd(0x8825)[2] = (45.0, 45.0, 0.0)  # GPS latitude
+        content = jpeg_bytes((400, 300), exif=exif.tobytes())
+
+        with Image.open(io.BytesIO(normalize_image(content, 200, 80))) as image:
+            assert image.format == "JPEG"
+            assert image.size == (300, 400)
+            assert not image.getexif()
+            assert image.info.get("dpi") == (200, 200)
+        print("✅ Orientation applied and metadata removed")
+
+    def test_downscales_to_page_size(self):
+        """A 12 Mpx landscape photo is reduced to an A4 page at the target DPI"""
+        content = jpeg_bytes((4000, 3000))
+
+        normalized = normalize_image(content, 100, 80)
+        with Image.open(io.BytesIO(normalized)) as image:
+            bound = target_size(100, landscape=True)
+            assert image.width <= bound[0] and image.height <= bound[1]
+            assert image.width == bound[0] or image.height == bound[1]
+            assert abs(image.width / image.height - 4 / 3) < 0.01
+        assert len(normalized) < len(content)
+        print("✅ Photo downscaled")
+
+    def test_small_images_not_enlarged(self):
+        """Images already below the target size keep their dimensions"""
+        with Image.open(io.BytesIO(normalize_image(jpeg_bytes((200, 100)), 200, 80))) as image:
+            assert image.size == (200, 100)
+        print("✅ Small image kept at its size")
+
+    def test_transparency_flattened(self):
+        """Transparent images are flattened on white, JPEG has no alpha"""
+        output = io.BytesIO()
+        Image.new("RGBA", (50, 50), (255, 0, 0, 0)).save(output, "PNG")
+
+        with Image.open(io.BytesIO(normalize_image(output.getvalue(), 200, 80))) as image:
+            assert image.mode == "RGB"
+            assert image.getpixel((25, 25)) == pytest.approx((255, 255, 255), abs=2)
+        print("✅ Transparency flattened")
+
+    @pytest.mark.skipif(register_heif_opener is None, reason="pillow-heif not installed")
+    def test_heic_converted(self):
+        """HEIC photos are decoded and saved as JPEG"""
+        output = io.BytesIO()
+        Image.new("RGB", (64, 48), "blue").save(output, "HEIF")
+
+        with Image.open(io.BytesIO(normalize_image(output.getvalue(), 200, 80))) as image:
+            assert image.format == "JPEG" and image.size == (64, 48)
+        print("✅ HEIC converted")
+
+    def test_photo_types(self):
+        """Only camera formats are normalized"""
+        assert is_photo("image/jpeg")
+        assert is_photo("image/heic")
+        assert not is_photo("image/png")
+        assert not is_photo("application/pdf")
+        print("✅ Photo types verified")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -2,12 +2,18 @@
 Test suite for Pieces (Pièces jointes) API endpoints
 Tests: POST/GET/PUT/DELETE /api/conclusions/{id}/pieces
        PUT /api/conclusions/{id}/pieces/reorder
-       GET /api/pieces/{id}/download
+       POST /api/conclusions/{id}/pieces/batch
+       GET /api/pieces/search
+       GET /api/usage/storage
+       GET /api/pieces/{id}/download (caching, ranges, compression)
+       POST/GET/PATCH /api/uploads/{id} (resumable uploads)
 """
 import pytest
 import requests
 import os
 import io
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
 SESSION_TOKEN = "test_session_pieces_1770651174398"
@@ -358,6 +364,52 @@ class TestPiecesReorder:
         
         print("✅ Pieces reorder verified")
 
+    def test_move_single_piece(self, api_client):
+        """Test moving one piece after another and to the top"""
+        conclusion_response = api_client.post(f"{BASE_URL}/api/conclusions", json={
+            "type": "jaf",
+            "parties": {"tribunal": "Move Test"},
+            "faits": "Move test faits",
+            "demandes": "Move test demandes"
+        })
+        assert conclusion_response.status_code in [200, 201]
+        conclusion_id = conclusion_response.json()["conclusion_id"]
+        created_conclusions.append(conclusion_id)
+
+        piece_ids = []
+        for i in range(4):
+            files = {"file": (f"move_{i}.txt", io.BytesIO(f"Move test {i}".encode()), "text/plain")}
+            response = requests.post(
+                f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces",
+                files=files,
+                data={"nom": f"TEST_Move Piece {i}", "description": ""},
+                headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+                cookies={"session_token": SESSION_TOKEN}
+            )
+            assert response.status_code == 201, f"Upload {i} failed: {response.text}"
+            piece_ids.append(response.json()["piece_id"])
+
+        # Move the first piece after the third one
+        response = api_client.put(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/{piece_ids[0]}/move",
+            json={"after_piece_id": piece_ids[2]}
+        )
+        assert response.status_code == 200, f"Move failed: {response.text}"
+        assert response.json()["numero"] == 3
+
+        # Move the last piece to the top
+        response = api_client.put(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/{piece_ids[3]}/move",
+            json={"after_piece_id": None}
+        )
+        assert response.status_code == 200
+        assert response.json()["numero"] == 1
+
+        pieces = api_client.get(f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces").json()
+        assert [p["piece_id"] for p in pieces] == [piece_ids[3], piece_ids[1], piece_ids[2], piece_ids[0]]
+        assert [p["numero"] for p in pieces] == [1, 2, 3, 4], "Numbers should stay dense"
+        print("✅ Single piece move verified")
+
 
 class TestPiecesDownload:
     """Test piece download endpoint"""
@@ -413,6 +465,154 @@ class TestPiecesDownload:
         print("✅ Download non-existent piece returns 404")
 
 
+class TestPiecesDownloadCaching:
+    """Test ETag, conditional and range requests on piece download"""
+
+    @pytest.fixture(scope="class")
+    def uploaded_piece(self, test_conclusion):
+        files = {"file": ("range_test.txt", io.BytesIO(b"0123456789"), "text/plain")}
+        response = requests.post(
+            f"{BASE_URL}/api/conclusions/{test_conclusion['conclusion_id']}/pieces",
+            files=files,
+            data={"nom": "TEST_Range", "description": ""},
+            headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+            cookies={"session_token": SESSION_TOKEN}
+        )
+        assert response.status_code == 201
+        piece = response.json()
+        created_pieces.append(piece["piece_id"])
+        return piece
+
+    def download(self, piece, **headers):
+        return requests.get(
+            f"{BASE_URL}/api/pieces/{piece['piece_id']}/download",
+            headers={"Authorization": f"Bearer {SESSION_TOKEN}", **headers},
+            cookies={"session_token": SESSION_TOKEN}
+        )
+
+    def test_etag_and_not_modified(self, uploaded_piece):
+        """Test strong ETag and If-None-Match -> 304"""
+        response = self.download(uploaded_piece)
+        assert response.status_code == 200
+        etag = response.headers.get("etag", "")
+        assert etag.startswith('"') and not etag.startswith("W/"), "Expected a strong ETag"
+        assert "private" in response.headers.get("cache-control", "")
+
+        not_modified = self.download(uploaded_piece, **{"If-None-Match": etag})
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+        print("✅ ETag and 304 Not Modified verified")
+
+    def test_range_requests(self, uploaded_piece):
+        """Test 206 Partial Content and 416 responses"""
+        partial = self.download(uploaded_piece, Range="bytes=2-4")
+        assert partial.status_code == 206
+        assert partial.content == b"234"
+        assert partial.headers["content-range"] == "bytes 2-4/10"
+
+        suffix = self.download(uploaded_piece, Range="bytes=-3")
+        assert suffix.status_code == 206
+        assert suffix.content == b"789"
+
+        unsatisfiable = self.download(uploaded_piece, Range="bytes=50-")
+        assert unsatisfiable.status_code == 416
+        assert unsatisfiable.headers["content-range"] == "bytes */10"
+
+        stale = self.download(uploaded_piece, Range="bytes=2-4", **{"If-Range": '"stale"'})
+        assert stale.status_code == 200
+        assert stale.content == b"0123456789"
+        print("✅ Range requests verified")
+
+
+class TestPiecesResumableUpload:
+    """Test resumable chunked upload protocol"""
+
+    def test_resumable_upload_with_interruption(self, api_client, test_conclusion):
+        """Test create session -> PATCH chunks -> resume at reported offset -> complete"""
+        conclusion_id = test_conclusion["conclusion_id"]
+        file_content = bytes(range(256)) * 400
+
+        create_response = api_client.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/uploads",
+            json={
+                "nom": "TEST_Resumable",
+                "description": "",
+                "filename": "resumable.bin",
+                "content_type": "application/octet-stream",
+                "file_size": len(file_content),
+                "sha256": hashlib.sha256(file_content).hexdigest()
+            }
+        )
+        assert create_response.status_code == 201, f"Create session failed: {create_response.text}"
+        upload_id = create_response.json()["upload_id"]
+        assert create_response.json()["offset"] == 0
+
+        headers = {"Authorization": f"Bearer {SESSION_TOKEN}", "Content-Type": "application/offset+octet-stream"}
+        first = requests.patch(
+            f"{BASE_URL}/api/uploads/{upload_id}",
+            data=file_content[:40000],
+            headers={**headers, "Upload-Offset": "0"}
+        )
+        assert first.status_code == 200
+        assert first.json()["offset"] == 40000
+
+        # A client that lost track of the offset is told where to resume
+        wrong = requests.patch(
+            f"{BASE_URL}/api/uploads/{upload_id}",
+            data=file_content[:100],
+            headers={**headers, "Upload-Offset": "0"}
+        )
+        assert wrong.status_code == 409
+        assert wrong.headers.get("upload-offset") == "40000"
+
+        status = api_client.get(f"{BASE_URL}/api/uploads/{upload_id}").json()
+        rest = requests.patch(
+            f"{BASE_URL}/api/uploads/{upload_id}",
+            data=file_content[status["offset"]:],
+            headers={**headers, "Upload-Offset": str(status["offset"])}
+        )
+        assert rest.status_code == 200
+        assert rest.json()["offset"] == len(file_content)
+
+        complete = api_client.post(f"{BASE_URL}/api/uploads/{upload_id}/complete")
+        assert complete.status_code == 201, f"Complete failed: {complete.text}"
+        piece = complete.json()
+        created_pieces.append(piece["piece_id"])
+        assert piece["file_size"] == len(file_content)
+
+        # Completing again is idempotent
+        again = api_client.post(f"{BASE_URL}/api/uploads/{upload_id}/complete")
+        assert again.status_code == 201
+        assert again.json()["piece_id"] == piece["piece_id"]
+        print("✅ Resumable upload verified")
+
+    def test_resumable_upload_digest_mismatch(self, api_client, test_conclusion):
+        """Test complete refuses a file whose SHA-256 differs from the announced one"""
+        conclusion_id = test_conclusion["conclusion_id"]
+        file_content = b"resumable digest mismatch"
+
+        create_response = api_client.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/uploads",
+            json={
+                "nom": "TEST_Bad Digest",
+                "filename": "bad.txt",
+                "file_size": len(file_content),
+                "sha256": "0" * 64
+            }
+        )
+        upload_id = create_response.json()["upload_id"]
+        requests.patch(
+            f"{BASE_URL}/api/uploads/{upload_id}",
+            data=file_content,
+            headers={"Authorization": f"Bearer {SESSION_TOKEN}", "Upload-Offset": "0"}
+        )
+
+        complete = api_client.post(f"{BASE_URL}/api/uploads/{upload_id}/complete")
+        assert complete.status_code == 422
+        api_client.delete(f"{BASE_URL}/api/uploads/{upload_id}")
+        print("✅ Digest mismatch rejected")
+
+
 class TestPiecesAutoNumbering:
     """Test automatic piece numbering"""
     
@@ -447,6 +647,309 @@ class TestPiecesAutoNumbering:
         assert piece["numero"] == expected_numero, f"Expected numero {expected_numero}, got {piece['numero']}"
         print(f"✅ Auto numbering verified: piece got numero {piece['numero']}")
 
+    def test_parallel_uploads_get_distinct_numbers(self, api_client):
+        """Test that pieces dropped at once are numbered without duplicates"""
+        conclusion_response = api_client.post(f"{BASE_URL}/api/conclusions", json={
+            "type": "jaf",
+            "parties": {"tribunal": "Parallel Test"},
+            "faits": "Parallel test faits",
+            "demandes": "Parallel test demandes"
+        })
+        assert conclusion_response.status_code in [200, 201]
+        conclusion_id = conclusion_response.json()["conclusion_id"]
+        created_conclusions.append(conclusion_id)
+
+        def upload(i):
+            files = {"file": (f"parallel_{i}.txt", io.BytesIO(f"Parallel {i}".encode()), "text/plain")}
+            return requests.post(
+                f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces",
+                files=files,
+                data={"nom": f"TEST_Parallel {i}", "description": ""},
+                headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+                cookies={"session_token": SESSION_TOKEN}
+            )
+
+        count = 20
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            responses = list(executor.map(upload, range(count)))
+
+        assert all(r.status_code == 201 for r in responses), [r.text for r in responses if r.status_code != 201]
+
+        pieces = api_client.get(f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces").json()
+        assert len(pieces) == count
+        assert sorted(p["numero"] for p in pieces) == list(range(1, count + 1)), "Numbers should be unique and dense"
+        print(f"✅ {count} parallel uploads numbered without duplicates")
+
+
+class TestPiecesDirectUpload:
+    """Test presigned direct upload/download flow"""
+
+    def test_direct_upload_and_download(self, api_client, test_conclusion):
+        """Test upload-url -> transfer to store -> complete -> download-url"""
+        conclusion_id = test_conclusion["conclusion_id"]
+        file_content = b"%PDF-1.4 direct upload test"
+
+        ticket_response = api_client.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/upload-url",
+            json={
+                "nom": "TEST_Direct Upload",
+                "description": "",
+                "filename": "direct.pdf",
+                "content_type": "application/pdf",
+                "file_size": len(file_content)
+            }
+        )
+        assert ticket_response.status_code == 200, f"upload-url failed: {ticket_response.text}"
+        ticket = ticket_response.json()
+
+        # Send bytes to the store without API credentials
+        if ticket["method"] == "POST":
+            transfer = requests.post(
+                ticket["url"],
+                data=ticket["fields"],
+                files={"file": ("direct.pdf", io.BytesIO(file_content), "application/pdf")}
+            )
+        else:
+            transfer = requests.put(ticket["url"], data=file_content, headers=ticket["headers"])
+        assert transfer.status_code in [200, 201, 204], f"Transfer failed: {transfer.text}"
+
+        complete_response = api_client.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/complete",
+            json={"upload_token": ticket["upload_token"]}
+        )
+        assert complete_response.status_code == 201, f"complete failed: {complete_response.text}"
+        piece = complete_response.json()
+        created_pieces.append(piece["piece_id"])
+        assert piece["file_size"] == len(file_content)
+        assert piece["original_filename"] == "direct.pdf"
+
+        if ticket["method"] == "PUT":
+            # The URL is still valid but cannot replace the content of the piece
+            replaced = requests.put(ticket["url"], data=b"%PDF-1.4 other", headers=ticket["headers"])
+            assert replaced.status_code == 409, f"Second transfer should be refused: {replaced.text}"
+
+        url_response = api_client.get(f"{BASE_URL}/api/pieces/{piece['piece_id']}/download-url")
+        assert url_response.status_code == 200
+        download = requests.get(url_response.json()["url"])
+        assert download.status_code == 200
+        assert download.content == file_content, "Downloaded content doesn't match"
+        print("✅ Direct upload and download verified")
+
+    def test_complete_rejects_forged_token(self, api_client, test_conclusion):
+        """Test complete with an invalid upload token"""
+        conclusion_id = test_conclusion["conclusion_id"]
+
+        response = api_client.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/complete",
+            json={"upload_token": "forged"}
+        )
+        assert response.status_code == 400, "Should reject forged upload token"
+        print("✅ Forged upload token rejected")
+
+    def test_upload_url_rejects_oversized(self, api_client, test_conclusion):
+        """Test upload-url with a declared size above the limit"""
+        conclusion_id = test_conclusion["conclusion_id"]
+
+        response = api_client.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/upload-url",
+            json={"nom": "TEST_Big", "filename": "big.pdf", "file_size": 11 * 1024 * 1024}
+        )
+        assert response.status_code == 400, "Should reject oversized declared file"
+        print("✅ Oversized direct upload rejected")
+
+
+class TestPiecesBatchUpload:
+    """Test multi-file batch upload"""
+
+    def test_batch_upload_reports_each_file(self, api_client):
+        """Test that a batch is numbered consecutively and oversized files are reported"""
+        conclusion_response = api_client.post(f"{BASE_URL}/api/conclusions", json={
+            "type": "jaf",
+            "parties": {"tribunal": "Batch Test"},
+            "faits": "Batch test faits",
+            "demandes": "Batch test demandes"
+        })
+        assert conclusion_response.status_code in [200, 201]
+        conclusion_id = conclusion_response.json()["conclusion_id"]
+        created_conclusions.append(conclusion_id)
+
+        files = [
+            ("files", ("batch_1.txt", io.BytesIO(b"Batch 1"), "text/plain")),
+            ("files", ("batch_big.bin", io.BytesIO(b"x" * (10 * 1024 * 1024 + 1)), "application/octet-stream")),
+            ("files", ("batch_2.txt", io.BytesIO(b"Batch 2"), "text/plain")),
+        ]
+        response = requests.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/batch",
+            files=files,
+            data={"noms": ["TEST_Batch 1", "TEST_Batch big", "TEST_Batch 2"]},
+            headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+            cookies={"session_token": SESSION_TOKEN}
+        )
+        assert response.status_code == 201, f"Batch upload failed: {response.text}"
+        result = response.json()
+
+        assert result["uploaded"] == 2 and result["failed"] == 1
+        assert [r["success"] for r in result["results"]] == [True, False, True]
+        assert "10 Mo" in result["results"][1]["error"]
+        assert [r["piece"]["numero"] for r in result["results"] if r["success"]] == [1, 2]
+        assert result["results"][2]["piece"]["nom"] == "TEST_Batch 2"
+
+        pieces = api_client.get(f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces").json()
+        assert [p["original_filename"] for p in pieces] == ["batch_1.txt", "batch_2.txt"]
+        print("✅ Batch upload verified with per-file results")
+
+
+class TestPiecesSearch:
+    """Test piece search"""
+
+    def test_search_by_name(self, api_client, test_conclusion):
+        """Test that pieces are found by name, scoped to the conclusion"""
+        conclusion_id = test_conclusion["conclusion_id"]
+        response = requests.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces",
+            files={"file": ("bulletin.txt", io.BytesIO(b"Bulletin de salaire"), "text/plain")},
+            data={"nom": "TEST_Bulletin de paie mars", "description": ""},
+            headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+            cookies={"session_token": SESSION_TOKEN}
+        )
+        assert response.status_code == 201
+        piece_id = response.json()["piece_id"]
+
+        search = api_client.get(f"{BASE_URL}/api/pieces/search", params={"q": "paie", "conclusion_id": conclusion_id})
+        assert search.status_code == 200, f"Search failed: {search.text}"
+        results = search.json()
+        assert piece_id in [r["piece"]["piece_id"] for r in results]
+        assert all(r["piece"]["conclusion_id"] == conclusion_id for r in results)
+        print(f"✅ Search returned {len(results)} result(s)")
+
+    def test_search_rejects_empty_query(self, api_client):
+        """Test search with a blank query"""
+        response = api_client.get(f"{BASE_URL}/api/pieces/search", params={"q": " "})
+        assert response.status_code == 400
+        print("✅ Empty search rejected")
+
+
+class TestStorageUsage:
+    """Test per-user storage counters"""
+
+    def test_usage_follows_uploads_and_deletions(self, api_client, test_conclusion):
+        """Test that usage grows on upload and shrinks on delete"""
+        conclusion_id = test_conclusion["conclusion_id"]
+        before = api_client.get(f"{BASE_URL}/api/usage/storage")
+        assert before.status_code == 200
+        before = before.json()
+        assert before["quota_bytes"] > 0 and before["quota_files"] > 0
+
+        file_content = b"Usage accounting test content"
+        response = requests.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces",
+            files={"file": ("usage.txt", io.BytesIO(file_content), "text/plain")},
+            data={"nom": "TEST_Usage", "description": ""},
+            headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+            cookies={"session_token": SESSION_TOKEN}
+        )
+        assert response.status_code == 201
+        piece_id = response.json()["piece_id"]
+
+        during = api_client.get(f"{BASE_URL}/api/usage/storage").json()
+        assert during["bytes"] == before["bytes"] + len(file_content)
+        assert during["files"] == before["files"] + 1
+
+        api_client.delete(f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/{piece_id}")
+        after = api_client.get(f"{BASE_URL}/api/usage/storage").json()
+        assert after["bytes"] == before["bytes"] and after["files"] == before["files"]
+        print("✅ Storage usage counters verified")
+
+
+
+class TestPiecesCompression:
+    """Test compressed storage of text-like pieces"""
+
+    def test_compressed_piece_download(self, test_conclusion):
+        """Test that a compressed piece is sent encoded or decoded depending on Accept-Encoding"""
+        conclusion_id = test_conclusion["conclusion_id"]
+        file_content = b"Attestation de temoin, fait a Lyon le 3 mars 2023.\n" * 5000
+        auth = {"Authorization": f"Bearer {SESSION_TOKEN}"}
+        response = requests.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces",
+            files={"file": ("attestation.txt", io.BytesIO(file_content), "text/plain")},
+            data={"nom": "TEST_Compression", "description": ""},
+            headers=auth,
+            cookies={"session_token": SESSION_TOKEN}
+        )
+        assert response.status_code == 201
+        piece_id = response.json()["piece_id"]
+        url = f"{BASE_URL}/api/pieces/{piece_id}/download"
+
+        plain = requests.get(url, headers={**auth, "Accept-Encoding": "identity"}, cookies={"session_token": SESSION_TOKEN})
+        assert plain.status_code == 200
+        assert "content-encoding" not in plain.headers
+        assert plain.content == file_content
+
+        encoded = requests.get(url, headers={**auth, "Accept-Encoding": "zstd, gzip"},
+                               cookies={"session_token": SESSION_TOKEN}, stream=True)
+        assert encoded.status_code == 200
+        assert encoded.headers.get("content-encoding") in ("zstd", "gzip")
+        assert "Accept-Encoding" in encoded.headers.get("vary", "")
+        assert encoded.headers["etag"] != plain.headers["etag"]
+        assert len(encoded.raw.read(decode_content=False)) < len(file_content) / 5
+        print("✅ Compressed piece download verified")
+
+
+
+class TestPiecesPhotoNormalization:
+    """Test normalization of photographed documents at upload"""
+
+    def test_photo_normalized_unless_original_kept(self, test_conclusion):
+        """Test that photos are downscaled and stripped, or stored as is on request"""
+        from PIL import Image
+        conclusion_id = test_conclusion["conclusion_id"]
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        photo = io.BytesIO()
+        Image.effect_noise((4032, 3024), 40).convert("RGB").save(photo, "JPEG", quality=95, exif=exif.tobytes())
+        photo = photo.getvalue()
+
+        def send(extra):
+            response = requests.post(
+                f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces",
+                files={"file": ("IMG_0001.JPG", io.BytesIO(photo), "image/jpeg")},
+                data={"nom": "TEST_Photo", **extra},
+                headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+                cookies={"session_token": SESSION_TOKEN}
+            )
+            assert response.status_code == 201
+            return response.json()
+
+        normalized = send({})
+        assert normalized["file_size"] < len(photo)
+        assert normalized["original_filename"] == "IMG_0001.jpg"
+        download = requests.get(
+            f"{BASE_URL}/api/pieces/{normalized['piece_id']}/download",
+            headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+            cookies={"session_token": SESSION_TOKEN}
+        )
+        with Image.open(io.BytesIO(download.content)) as image:
+            assert image.height > image.width, "EXIF orientation applied"
+            assert not image.getexif()
+
+        kept = send({"conserver_original": "true"})
+        assert kept["file_size"] == len(photo)
+        assert kept["original_filename"] == "IMG_0001.JPG"
+
+        # Batch uploads key the stored file after normalization, like single uploads
+        batch = requests.post(
+            f"{BASE_URL}/api/conclusions/{conclusion_id}/pieces/batch",
+            files=[("files", ("IMG_0002.JPG", io.BytesIO(photo), "image/jpeg"))],
+            headers={"Authorization": f"Bearer {SESSION_TOKEN}"},
+            cookies={"session_token": SESSION_TOKEN}
+        )
+        assert batch.status_code == 201
+        batch_piece = batch.json()["results"][0]["piece"]
+        assert batch_piece["original_filename"] == "IMG_0002.jpg"
+        assert batch_piece["filename"].endswith(".jpg")
+        print("✅ Photo normalization verified")
+
 
 # Cleanup fixture
 @pytest.fixture(scope="module", autouse=True)
@@ -0,0 +1,56 @@
+"""
+Test suite for piece previews (previews.py)
+Tests: image thumbnails, PDF first-page rendering
+"""
+
+import pytest
+from PIL import Image
+from reportlab.pdfgen import canvas
+
+from previews import has_preview, render_preview, PREVIEW_SIZE
+
+
+class TestRenderPreview:
+    """Test preview rendering"""
+
+    def test_image_thumbnail_keeps_ratio(self, tmp_path):
+        """Large images are scaled down within the preview box"""
+        source = tmp_path / "photo.jpg"
+        Image.new("RGB", (1600, 1200), "red").save(source, "JPEG")
+
+        output = tmp_path / "photo.webp"
+        render_preview(str(source), "image/jpeg", str(output))
+
+        with Image.open(output) as preview:
+            assert preview.format == "WEBP"
+            assert preview.size == (PREVIEW_SIZE[0], PREVIEW_SIZE[0] * 3 // 4)
+        print("✅ Image thumbnail generated")
+
+    def test_pdf_first_page(self, tmp_path):
+        """Only the first page of a PDF is rasterized"""
+        source = tmp_path / "doc.pdf"
+        p = canvas.Canvas(str(source))
+        p.drawString(100, 700, "Page 1")
+        p.showPage()
+        p.drawString(100, 700, "Page 2")
+        p.save()
+
+        output = tmp_path / "doc.webp"
+        render_preview(str(source), "application/pdf", str(output))
+
+        with Image.open(output) as preview:
+            assert max(preview.size) == max(PREVIEW_SIZE)
+            assert preview.height > preview.width, "A4 portrait page"
+        print("✅ PDF first page rendered")
+
+    def test_supported_types(self):
+        """Only images and PDFs get a preview"""
+        assert has_preview("application/pdf")
+        assert has_preview("image/png")
+        assert not has_preview("text/plain")
+        assert not has_preview(None)
+        print("✅ Preview types verified")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
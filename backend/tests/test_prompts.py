@@ -0,0 +1,208 @@
+"""
+Test suite for generation prompts (prompts.py)
+Tests: compilation, version identifiers, bounded prompt cache,
+       token estimates, map-reduce summarization of long facts, sections
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from prompts import (
+    assemble_sections, build_user_prompt, compile_system_prompt, condense, document_excerpt, estimate_tokens,
+    replace_section,
+    section_prompt, section_spans, split_chunks, PromptCache, SUMMARIZED_FAITS_HEADING, SUMMARY_CHUNK_TOKENS,
+    TEMPLATES_VERSION
+)
+
+FAITS_SENTENCE = "Le 3 mars 2021, M. Dupont a quitté le domicile conjugal situé à Lyon. "
+
+
+def article(numero: str, contenu: str = "Texte de l'article"):
+    return SimpleNamespace(numero=numero, titre=f"Titre {numero}", contenu=contenu)
+
+
+class TestCompileSystemPrompt:
+    """Test system prompt compilation"""
+
+    def test_articles_quoted(self):
+        """The articles are quoted in the prompt of their type"""
+        compiled = compile_system_prompt("jaf", [article("371"), article("373-2")])
+        assert "droit de la famille" in compiled.system_prompt
+        assert "Article 371 - Titre 371:\nTexte de l'article" in compiled.system_prompt
+        assert "Article 373-2" in compiled.system_prompt
+        assert compiled.type_label == "Juge aux Affaires Familiales (JAF)"
+        print("✅ Articles quoted in the prompt")
+
+    def test_other_types_use_penal_prompt(self):
+        """Every type other than jaf gets the penal prompt"""
+        compiled = compile_system_prompt("correctionnel", [])
+        assert "droit pénal" in compiled.system_prompt
+        assert compiled.version.startswith("penal-")
+        print("✅ Penal prompt used for other types")
+
+    def test_version_follows_content(self):
+        """Same articles, same version; any article change, another version"""
+        first = compile_system_prompt("jaf", [article("371")])
+        assert compile_system_prompt("jaf", [article("371")]).version == first.version
+        assert compile_system_prompt("jaf", [article("371", "Texte modifié")]).version != first.version
+        assert first.version.split("-")[1] == TEMPLATES_VERSION
+        print("✅ Version follows the prompt content")
+
+
+class TestPromptCache:
+    """Test the compiled prompt cache"""
+
+    def test_least_recently_used_evicted(self):
+        """The cache keeps at most maxsize prompts, dropping the least recently used"""
+        cache = PromptCache(maxsize=2)
+        for key in ("a", "b"):
+            cache.put(key, compile_system_prompt("jaf", []))
+        assert cache.get("a") is not None
+        cache.put("c", compile_system_prompt("penal", []))
+
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("c") is not None
+        assert (cache.hits, cache.misses) == (3, 1)
+        print("✅ Least recently used prompt evicted")
+
+
+class TestTokenBudget:
+    """Test token estimates and the condensing of long facts"""
+
+    def test_estimate_tokens(self):
+        """Words count about one token per 4 characters, punctuation one each"""
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("Le juge") == 2
+        assert estimate_tokens("Bonjour, madame.") == 6
+        assert estimate_tokens(FAITS_SENTENCE * 10) == 10 * estimate_tokens(FAITS_SENTENCE)
+        print("✅ Tokens estimated")
+
+    def test_split_chunks(self):
+        """Chunks stay under the limit, end on sentences and keep the whole text"""
+        text = "\n\n".join([FAITS_SENTENCE * 20] * 3)
+        chunks = split_chunks(text, 100)
+        assert len(chunks) > 3
+        assert all(estimate_tokens(chunk) <= 100 for chunk in chunks)
+        assert all(chunk.rstrip().endswith(".") for chunk in chunks)
+        assert estimate_tokens("".join(chunks)) == estimate_tokens(text)
+        print("✅ Facts split between sentences")
+
+    def test_split_chunks_without_punctuation(self):
+        """A paragraph without sentence ends is cut between words, a word without spaces inside"""
+        words = ("mot " * 400).split()
+        text = " ".join(words) + " " + "x" * 1000 + " fin"
+        chunks = split_chunks(text, 100)
+        assert all(estimate_tokens(chunk) <= 100 for chunk in chunks)
+        assert " ".join(chunks).split()[:400] == words
+        assert "".join("".join(chunks).split()) == "".join(text.split())
+        print("✅ Unpunctuated facts split between words")
+
+    def test_user_prompt_heading(self):
+        """Summarized facts are announced as such in the prompt"""
+        prompt = build_user_prompt("affaire pénale", {"demandeur": "A"}, "Les faits {x}", "Les demandes")
+        assert "FAITS (tels que décrits par l'utilisateur):\nLes faits {x}" in prompt
+        assert '"demandeur": "A"' in prompt
+        assert SUMMARIZED_FAITS_HEADING in build_user_prompt("affaire pénale", {}, "", "", summarized=True)
+        print("✅ User prompt built")
+
+    def test_short_facts_untouched(self):
+        """Facts within the budget are not summarized"""
+        async def summarize(prompt, max_tokens):
+            raise AssertionError("no summary expected")
+
+        text, calls = asyncio.run(condense(FAITS_SENTENCE, 1000, summarize))
+        assert (text, calls) == (FAITS_SENTENCE, 0)
+        print("✅ Short facts kept as written")
+
+    def test_long_facts_summarized_in_parallel(self):
+        """Long facts are summarized chunk by chunk, concurrently, then joined in order"""
+        text = FAITS_SENTENCE * (3 * SUMMARY_CHUNK_TOKENS // estimate_tokens(FAITS_SENTENCE))
+        running, peak = 0, 0
+
+        async def summarize(prompt, max_tokens):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            part = prompt.split("(partie ")[1].split(" ")[0]
+            return f"Résumé {part}."
+
+        summary, calls = asyncio.run(condense(text, 500, summarize))
+        assert calls == len(split_chunks(text, SUMMARY_CHUNK_TOKENS)) >= 3
+        assert peak == calls
+        assert summary == "\n\n".join(f"Résumé {i}." for i in range(1, calls + 1))
+        print("✅ Long facts summarized in parallel")
+
+    def test_summaries_reduced_again(self):
+        """Summaries still over the budget are summarized again"""
+        text = FAITS_SENTENCE * 200
+        rounds = []
+
+        async def summarize(prompt, max_tokens):
+            rounds.append(max_tokens)
+            # Too long the first time round
+            return FAITS_SENTENCE * (200 if len(rounds) == 1 else 1)
+
+        summary, calls = asyncio.run(condense(text, 300, summarize))
+        assert estimate_tokens(summary) <= 300
+        assert calls == 2
+        print("✅ Summaries reduced until within budget")
+
+
+class TestSections:
+    """Test section-wise prompts and the editing of one section"""
+
+    SECTION_TEXTS = {"en_tete": "Tribunal", "faits": "Faits 1\n\nFaits 2", "argumentation": "Arguments", "dispositif": "Demandes"}
+
+    def test_section_prompt(self):
+        """A section prompt asks for that section only, on the shared context"""
+        prompt = section_prompt("penal", "dispositif", "CONTEXTE")
+        assert prompt.startswith("CONTEXTE")
+        assert "UNIQUEMENT la section « DEMANDES »" in prompt
+        assert "(EN-TÊTE, RAPPEL DES FAITS, ARGUMENTATION)" in prompt
+        rewrite = section_prompt("jaf", "faits", "CONTEXTE", document="DOCUMENT", remarks="Plus court")
+        assert "DOCUMENT" in rewrite and rewrite.endswith("Plus court")
+        print("✅ Section prompt built")
+
+    def test_assembled_sections_replaced(self):
+        """Each section of an assembled document can be replaced, the others kept"""
+        document = assemble_sections("jaf", self.SECTION_TEXTS)
+        assert list(section_spans("jaf", document)) == ["en_tete", "faits", "argumentation", "dispositif"]
+        for key in self.SECTION_TEXTS:
+            replaced = replace_section("jaf", document, key, "Nouveau texte\n")
+            assert replaced == assemble_sections("jaf", {**self.SECTION_TEXTS, key: "Nouveau texte"})
+        print("✅ Sections replaced one by one")
+
+    def test_titles_of_single_call_documents(self):
+        """Titles written by the model in one call are found, not mentions of them in the text"""
+        document = (
+            "## 1. En-tête\nTribunal\n\n**2. EXPOSÉ DES FAITS :**\nVoir l'argumentation.\nEN-TÊTE\n\n"
+            "III - Argumentation\nArguments\n\n4) DISPOSITIF\nDemandes\n5. Formule de clôture"
+        )
+        spans = section_spans("jaf", document)
+        assert list(spans) == ["en_tete", "faits", "argumentation", "dispositif"]
+        start, end = spans["faits"]
+        assert document[start:end] == "Voir l'argumentation.\nEN-TÊTE\n\n"
+        assert replace_section("jaf", "Sans titres", "faits", "x") is None
+        print("✅ Titles found in single-call documents")
+
+    def test_document_excerpt(self):
+        """A long document is shortened for a rewrite, the section rewritten keeping the most"""
+        document = assemble_sections("jaf", {key: FAITS_SENTENCE * 200 for key in self.SECTION_TEXTS})
+        assert document_excerpt("jaf", document, "faits", estimate_tokens(document)) == document
+
+        excerpt = document_excerpt("jaf", document, "faits", 1000)
+        assert estimate_tokens(excerpt) <= 1000
+        spans = section_spans("jaf", excerpt)
+        assert list(spans) == ["en_tete", "faits", "argumentation", "dispositif"]
+        lengths = {key: estimate_tokens(excerpt[start:end]) for key, (start, end) in spans.items()}
+        assert lengths["faits"] > 400 and all(lengths[key] < 200 for key in lengths if key != "faits")
+        assert excerpt[spans["faits"][0]:spans["faits"][1]].strip().endswith("[…]")
+        print("✅ Long document shortened around the rewritten section")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
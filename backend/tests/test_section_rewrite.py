@@ -0,0 +1,79 @@
+"""
+Test suite for rewriting one section of a conclusion (server.py)
+Tests: POST /api/generate/section prompt budget with a long document and long facts,
+       section replaced in place, prompt version of the conclusion kept
+Needs the PostgreSQL database of DATABASE_URL; the LLM call is replaced by a fake,
+and the app runs without its background tasks (no lifespan).
+"""
+import uuid
+
+import pytest
+
+import llm
+import server
+from fastapi.testclient import TestClient
+from prompts import SUMMARY_SYSTEM_PROMPT, assemble_sections, estimate_tokens, section_spans
+
+SENTENCE = "Le 3 mars 2021, M. Dupont a quitté le domicile conjugal situé à Lyon. "
+SECTION_KEYS = ["en_tete", "faits", "argumentation", "dispositif"]
+
+
+@pytest.fixture
+def conclusion(make_account):
+    """A generated conclusion far longer than the prompt budget, with long facts"""
+    user_id, headers = make_account(credits=1)
+    conclusion_id = f"concl_{uuid.uuid4().hex[:12]}"
+    db = server.SessionLocal()
+    db.add(server.LegalConclusionModel(
+        conclusion_id=conclusion_id, user_id=user_id, type="jaf", parties={},
+        faits=SENTENCE * 300, demandes="Résidence des enfants",
+        conclusion_text=assemble_sections("jaf", {key: SENTENCE * 500 for key in SECTION_KEYS}),
+        status="draft", prompt_version="jaf-ancienne-version"
+    ))
+    db.commit()
+    db.close()
+    return user_id, headers, conclusion_id
+
+
+class TestSectionRewrite:
+    """Test that a section rewrite stays within the prompt budget"""
+
+    def test_rewrite_within_budget(self, conclusion, monkeypatch):
+        """The current document counts in the budget; the conclusion keeps its prompt version"""
+        user_id, headers, conclusion_id = conclusion
+        monkeypatch.setattr(server, "PROMPT_TOKEN_BUDGET", 6000)
+        monkeypatch.setattr(server, "SECTION_DOCUMENT_TOKENS", 3000)
+        prompts = []
+
+        async def fake_complete(api_key, session_id, system_prompt, user_prompt, model=None):
+            if system_prompt == SUMMARY_SYSTEM_PROMPT:
+                return "Résumé des faits."
+            prompts.append(estimate_tokens(system_prompt) + estimate_tokens(user_prompt))
+            return "Nouvel exposé des faits."
+        monkeypatch.setattr(llm, "complete", fake_complete)
+
+        response = TestClient(server.app).post("/api/generate/section", json={
+            "conclusion_id": conclusion_id, "section": "faits", "remarks": "Plus court"
+        }, headers=headers)
+        assert response.status_code == 200, response.text
+        result = response.json()
+
+        # Without the document in the count, the facts alone would have been fitted to the budget
+        assert result["usage"]["summarized"]
+        assert prompts and prompts[0] <= 6000
+        assert result["usage"]["prompt_tokens"] == prompts[0]
+
+        start, end = section_spans("jaf", result["conclusion_text"])["faits"]
+        assert result["conclusion_text"][start:end].strip() == "Nouvel exposé des faits."
+        db = server.SessionLocal()
+        stored = db.query(server.LegalConclusionModel).filter(
+            server.LegalConclusionModel.conclusion_id == conclusion_id
+        ).one()
+        db.close()
+        assert stored.conclusion_text == result["conclusion_text"]
+        assert stored.prompt_version == "jaf-ancienne-version"
+        print("✅ Section rewritten within the prompt budget")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
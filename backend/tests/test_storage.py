@@ -0,0 +1,143 @@
+"""
+Test suite for piece storage backends (storage.py)
+Tests: LocalPieceStorage read/write/delete, sharded layout and signed transfer URLs
+       S3PieceStorage against a moto stand-in
+"""
+import asyncio
+import time
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from storage import LocalPieceStorage, ObjectExistsError, S3PieceStorage, StorageError, shard_key, alternate_key
+
+
+run = asyncio.run
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    return LocalPieceStorage(tmp_path / "pieces", secret="test-secret")
+
+
+class TestLocalStorage:
+    """Test local filesystem backend"""
+
+    def test_write_read_delete(self, local_storage):
+        """Test a full object lifecycle"""
+        run(local_storage.write("concl_x_1.txt", b"contenu"))
+        assert run(local_storage.size("concl_x_1.txt")) == 7
+        assert run(local_storage.read("concl_x_1.txt")) == b"contenu"
+
+        with local_storage.open_read("concl_x_1.txt") as f:
+            assert f.read() == b"contenu"
+
+        run(local_storage.delete("concl_x_1.txt"))
+        assert run(local_storage.size("concl_x_1.txt")) is None
+        # Deleting twice is a no-op
+        run(local_storage.delete("concl_x_1.txt"))
+        print("✅ Local storage lifecycle verified")
+
+    def test_rejects_path_traversal(self, local_storage):
+        """Keys cannot escape the storage root"""
+        with pytest.raises(StorageError):
+            local_storage.path("../../etc/passwd")
+        print("✅ Path traversal rejected")
+
+    def test_write_stream_enforces_max_size(self, local_storage):
+        """Streams above max_size are refused and leave nothing behind"""
+        async def chunks():
+            for _ in range(4):
+                yield b"x" * 10
+
+        with pytest.raises(StorageError):
+            run(local_storage.write_stream("big.bin", chunks(), max_size=25))
+        assert run(local_storage.size("big.bin")) is None
+        assert run(local_storage.write_stream("ok.bin", chunks(), max_size=40)) == 40
+        print("✅ Streamed upload size limit verified")
+
+    def test_exclusive_write_stream(self, local_storage):
+        """An exclusive write never replaces an existing object"""
+        async def chunks(data):
+            yield data
+
+        run(local_storage.write_stream("piece.pdf", chunks(b"premier"), max_size=100, exclusive=True))
+        with pytest.raises(ObjectExistsError):
+            run(local_storage.write_stream("piece.pdf", chunks(b"second"), max_size=100, exclusive=True))
+        assert run(local_storage.read("piece.pdf")) == b"premier"
+        assert [p.name for p in local_storage.root.iterdir()] == ["piece.pdf"]
+        print("✅ Exclusive streamed upload verified")
+
+    def test_sharded_layout(self, local_storage):
+        """Keys are spread over two directory levels, flat keys still resolve"""
+        key = shard_key("concl_x_1.txt")
+        assert key.count("/") == 2 and key.endswith("/concl_x_1.txt")
+        assert alternate_key(key) == "concl_x_1.txt"
+        assert alternate_key("concl_x_1.txt") == key
+
+        # A row still holding the flat key finds the moved file, and the reverse
+        run(local_storage.write(key, b"contenu"))
+        assert run(local_storage.read("concl_x_1.txt")) == b"contenu"
+        run(local_storage.write("concl_y_2.txt", b"ancien"))
+        assert run(local_storage.read(shard_key("concl_y_2.txt"))) == b"ancien"
+        print("✅ Sharded layout verified")
+
+    def test_presigned_urls(self, local_storage):
+        """Signatures cover the key, operation and parameters"""
+        upload = local_storage.presign_upload("a.pdf", "application/pdf", 100)
+        assert upload["method"] == "PUT"
+        url = urlsplit(upload["url"])
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        assert url.path == "/api/storage/a.pdf"
+        assert local_storage.verify("put", "a.pdf", int(params["expires"]), params["sig"], params["max_size"])
+        assert not local_storage.verify("put", "b.pdf", int(params["expires"]), params["sig"], params["max_size"])
+        assert not local_storage.verify("put", "a.pdf", int(params["expires"]), params["sig"], "999999")
+        assert not local_storage.verify("get", "a.pdf", int(params["expires"]), params["sig"], params["max_size"])
+
+        expired = int(time.time()) - 1
+        assert not local_storage.verify("put", "a.pdf", expired, local_storage.sign("put", "a.pdf", expired, "100"), "100")
+        print("✅ Local presigned URLs verified")
+
+
+class TestS3Storage:
+    """Test S3-compatible backend with moto"""
+
+    @pytest.fixture
+    def s3_storage(self, monkeypatch):
+        moto = pytest.importorskip("moto")
+        import boto3
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        with moto.mock_aws():
+            client = boto3.client("s3", region_name="eu-west-3")
+            client.create_bucket(Bucket="pieces-test", CreateBucketConfiguration={"LocationConstraint": "eu-west-3"})
+            yield S3PieceStorage("pieces-test", client=client)
+
+    def test_write_read_delete(self, s3_storage):
+        """Test a full object lifecycle"""
+        run(s3_storage.write("concl_x_1.txt", b"contenu"))
+        assert run(s3_storage.size("concl_x_1.txt")) == 7
+        assert run(s3_storage.read("concl_x_1.txt")) == b"contenu"
+        body = s3_storage.open_read("concl_x_1.txt")
+        assert body.read(3) + body.read() == b"contenu"
+        body.close()
+
+        run(s3_storage.delete("concl_x_1.txt"))
+        assert run(s3_storage.size("concl_x_1.txt")) is None
+        print("✅ S3 storage lifecycle verified")
+
+    def test_presigned_urls(self, s3_storage):
+        """Presigned transfers target the bucket, not the API"""
+        upload = s3_storage.presign_upload("a.pdf", "application/pdf", 100)
+        assert upload["method"] == "POST"
+        assert upload["fields"]["key"] == "pieces/a.pdf"
+
+        url = s3_storage.presign_download("a.pdf", "pièce 1.pdf", "application/pdf")
+        assert "pieces-test" in url and "pieces/a.pdf" in url
+        assert "Signature" in url or "X-Amz-Signature" in url
+        print("✅ S3 presigned URLs verified")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,231 @@
+"""
+Test suite for the storage cleanup queue (server.py)
+Tests: DELETE piece and conclusion queue their files and release storage usage,
+       drain removes files and rows, failures released with their error,
+       expired leases claimed again, rows out of attempts dropped
+Needs the PostgreSQL database of DATABASE_URL with an empty storage_cleanup_queue:
+a drain takes every queued row. Files live in a temporary storage root, and the
+app runs without its background tasks (no lifespan): the queue is drained by hand.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+from fastapi.testclient import TestClient
+from storage import LocalPieceStorage, shard_key
+
+SIZES = [7, 11]
+
+
+@pytest.fixture(autouse=True)
+def empty_queue():
+    db = server.SessionLocal()
+    try:
+        queued = db.query(server.StorageCleanupModel).count()
+    finally:
+        db.close()
+    if queued:
+        pytest.skip("the storage cleanup queue holds files of other users")
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """server.storage pointed at a temporary root"""
+    local = LocalPieceStorage(tmp_path / "pieces", secret="test-secret")
+    monkeypatch.setattr(server, "storage", local)
+    return local
+
+
+@pytest.fixture
+def conclusion(make_account, store):
+    """A conclusion with one stored piece per SIZES, counted in the usage of its user.
+
+    Yields (user_id, headers, conclusion_id, [(piece_id, key)]); queue rows left with
+    these keys are removed afterwards.
+    """
+    user_id, headers = make_account(credits=0)
+    conclusion_id = f"concl_{uuid.uuid4().hex[:12]}"
+    pieces = []
+    db = server.SessionLocal()
+    db.add(server.LegalConclusionModel(
+        conclusion_id=conclusion_id, user_id=user_id, type="jaf", parties={}, faits="", demandes="",
+        conclusion_text="", status="draft", pieces_files=len(SIZES), pieces_bytes=sum(SIZES)
+    ))
+    for numero, size in enumerate(SIZES, start=1):
+        piece_id = f"piece_{uuid.uuid4().hex[:12]}"
+        key = shard_key(f"{conclusion_id}_{numero}.pdf")
+        asyncio.run(store.write(key, b"x" * size))
+        db.add(server.PieceModel(
+            piece_id=piece_id, conclusion_id=conclusion_id, user_id=user_id, numero=numero,
+            position=numero * server.PIECE_POSITION_GAP, nom=f"Pièce {numero}", filename=key,
+            original_filename="piece.pdf", file_size=size, mime_type="application/pdf"
+        ))
+        pieces.append((piece_id, key))
+    db.query(server.UserModel).filter(server.UserModel.user_id == user_id).update(
+        {"storage_files": len(SIZES), "storage_bytes": sum(SIZES)}
+    )
+    db.commit()
+    db.close()
+
+    yield user_id, headers, conclusion_id, pieces
+
+    db = server.SessionLocal()
+    keys = [key for _, key in pieces]
+    db.query(server.StorageCleanupModel).filter(server.StorageCleanupModel.key.in_(keys)).delete(
+        synchronize_session=False
+    )
+    db.query(server.PieceModel).filter(server.PieceModel.conclusion_id == conclusion_id).delete()
+    db.commit()
+    db.close()
+
+
+def queued(keys: list) -> list:
+    db = server.SessionLocal()
+    try:
+        return db.query(server.StorageCleanupModel).filter(
+            server.StorageCleanupModel.key.in_(keys)
+        ).order_by(server.StorageCleanupModel.id).all()
+    finally:
+        db.close()
+
+
+def enqueue(key: str, **values) -> int:
+    db = server.SessionLocal()
+    row = server.StorageCleanupModel(key=key, **values)
+    db.add(row)
+    db.commit()
+    row_id = row.id
+    db.close()
+    return row_id
+
+
+def usage(user_id: str, conclusion_id: str) -> tuple:
+    """((user files, user bytes), (conclusion files, conclusion bytes) or None once deleted)"""
+    db = server.SessionLocal()
+    try:
+        user = db.query(server.UserModel).filter(server.UserModel.user_id == user_id).one()
+        conclusion = db.query(server.LegalConclusionModel).filter(
+            server.LegalConclusionModel.conclusion_id == conclusion_id
+        ).first()
+        return (
+            (user.storage_files, user.storage_bytes),
+            (conclusion.pieces_files, conclusion.pieces_bytes) if conclusion else None
+        )
+    finally:
+        db.close()
+
+
+def drain() -> int:
+    return asyncio.run(server.drain_storage_cleanup_queue())
+
+
+class TestDeleteQueuesFiles:
+    """Test that deletions queue their files and release the storage usage"""
+
+    def test_delete_piece(self, conclusion, store):
+        """One queue row for the piece's file; user and conclusion counters lowered by its size"""
+        user_id, headers, conclusion_id, pieces = conclusion
+        (piece_id, key), (_, other_key) = pieces
+
+        response = TestClient(server.app).delete(f"/api/conclusions/{conclusion_id}/pieces/{piece_id}", headers=headers)
+        assert response.status_code == 200
+
+        [row] = queued([key, other_key])
+        assert (row.key, row.attempts, row.locked_until) == (key, 0, None)
+        assert usage(user_id, conclusion_id) == ((1, SIZES[1]), (1, SIZES[1]))
+        # Removed by the worker, not by the request
+        assert asyncio.run(store.size(key)) == SIZES[0]
+        print("✅ Deleted piece queued once")
+
+    def test_delete_conclusion(self, conclusion):
+        """Every file queued; their summed sizes subtracted from the user's usage"""
+        user_id, headers, conclusion_id, pieces = conclusion
+        keys = [key for _, key in pieces]
+
+        response = TestClient(server.app).delete(f"/api/conclusions/{conclusion_id}", headers=headers)
+        assert response.status_code == 200
+
+        assert sorted(row.key for row in queued(keys)) == sorted(keys)
+        assert usage(user_id, conclusion_id) == ((0, 0), None)
+        print("✅ Deleted conclusion queued all its files")
+
+
+class TestDrain:
+    """Test the cleanup worker's passes over the queue"""
+
+    def test_drain_removes_files_and_rows(self, conclusion, store):
+        """Queued files are removed, then their rows"""
+        _, headers, conclusion_id, pieces = conclusion
+        keys = [key for _, key in pieces]
+        assert TestClient(server.app).delete(f"/api/conclusions/{conclusion_id}", headers=headers).status_code == 200
+
+        assert drain() == len(keys)
+        assert queued(keys) == []
+        assert all(asyncio.run(store.size(key)) is None for key in keys)
+        assert drain() == 0
+        print("✅ Queue drained")
+
+    def test_failed_delete_released(self, conclusion, store, monkeypatch):
+        """A file that cannot be removed keeps its row, released with the error for a later pass"""
+        _, _, _, [(_, key), _] = conclusion
+        enqueue(key)
+        delete = store.delete
+
+        async def failing_delete(key: str):
+            raise OSError("disque indisponible")
+        monkeypatch.setattr(store, "delete", failing_delete)
+
+        assert drain() == 0
+        [row] = queued([key])
+        assert (row.attempts, row.locked_until) == (1, None)
+        assert "disque indisponible" in row.last_error
+        assert asyncio.run(store.size(key)) == SIZES[0]
+
+        monkeypatch.setattr(store, "delete", delete)
+        assert drain() == 1 and queued([key]) == []
+        print("✅ Failed removal released with its error")
+
+    def test_expired_lease_claimed_again(self, conclusion):
+        """A leased row is not claimed twice, until its lease expires with the worker that held it"""
+        _, _, _, [(_, key), _] = conclusion
+        row_id = enqueue(key)
+
+        assert server.claim_storage_cleanup_batch() == [(row_id, key)]
+        assert server.claim_storage_cleanup_batch() == []
+
+        db = server.SessionLocal()
+        db.query(server.StorageCleanupModel).filter(server.StorageCleanupModel.id == row_id).update(
+            {"locked_until": datetime.now(timezone.utc) - timedelta(seconds=1)}
+        )
+        db.commit()
+        db.close()
+        assert server.claim_storage_cleanup_batch() == [(row_id, key)]
+        [row] = queued([key])
+        assert row.attempts == 2 and row.locked_until > datetime.now(timezone.utc)
+        print("✅ Expired lease claimed again")
+
+    def test_exhausted_rows_dropped(self, conclusion, store, caplog):
+        """Rows out of attempts are dropped and logged; their file is left to the garbage collector"""
+        _, _, _, [(_, key), (_, leased_key)] = conclusion
+        enqueue(key, attempts=server.STORAGE_CLEANUP_MAX_ATTEMPTS, last_error="OSError: disque indisponible")
+        # Still leased: its worker may yet succeed
+        enqueue(
+            leased_key, attempts=server.STORAGE_CLEANUP_MAX_ATTEMPTS,
+            locked_until=datetime.now(timezone.utc) + timedelta(minutes=1)
+        )
+
+        with caplog.at_level(logging.ERROR, logger=server.logger.name):
+            assert drain() == 0
+        assert [row.key for row in queued([key, leased_key])] == [leased_key]
+        assert asyncio.run(store.size(key)) == SIZES[0]
+        [record] = [r for r in caplog.records if key in r.getMessage()]
+        assert "disque indisponible" in record.getMessage()
+        print("✅ Exhausted rows dropped and logged")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useRef, useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import axios from 'axios';
 import { Button } from '../components/ui/button';
@@ -74,6 +74,9 @@ const NewConclusion = () => {
     }
   };
 
+  // Same key on a retry: the server replays the first generation instead of paying twice
+  const idempotencyKey = useRef(crypto.randomUUID());
+
   const handleGenerate = async () => {
     if (!formData.faits.trim() || !formData.demandes.trim()) {
       toast.error('Veuillez remplir les faits et les demandes');
@@ -86,7 +89,7 @@ const NewConclusion = () => {
       const generateResponse = await axios.post(
         `${BACKEND_URL}/api/generate/conclusion`,
         formData,
-        { withCredentials: true }
+        { withCredentials: true, headers: { 'Idempotency-Key': idempotencyKey.current } }
       );
 
       const conclusionText = generateResponse.data.conclusion_text;
@@ -95,7 +98,8 @@ const NewConclusion = () => {
         `${BACKEND_URL}/api/conclusions`,
         {
           ...formData,
-          conclusion_text: conclusionText
+          conclusion_text: conclusionText,
+          prompt_version: generateResponse.data.prompt_version
         },
         { withCredentials: true }
       );
@@ -113,6 +117,10 @@ const NewConclusion = () => {
         setTimeout(() => {
           navigate('/tarifs');
         }, 2000);
+      } else if (error.response?.status === 429) {
+        const retryAfter = error.response.headers['retry-after'];
+        toast.error(`Service très sollicité. Veuillez réessayer dans ${retryAfter || 'quelques'} secondes.`);
+        setGenerating(false);
       } else {
         toast.error('Erreur lors de la génération de la conclusion');
         setGenerating(false);